@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import urllib.parse
+
+from . import buffers, common, spool
+
+# Version of the project export format the archives are written in
+EXPORT_VERSION = '0.2.4'
+LABEL_COLOR = '#428BCA'
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.svg', '.webp')
+
+
+def _dump(obj):
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False)
+
+
+def _label(title):
+    return {'title': title, 'color': LABEL_COLOR, 'type': 'ProjectLabel'}
+
+
+class ArchiveWriter:
+    """Writes the records of a SpoolTarget as a GitLab project export
+    archive, which is imported with a single projects/import request.
+
+    Issues are streamed to a staging directory as they are saved, the
+    tarball is only built by close()."""
+
+    def __init__(self, path):
+        self.path = path
+        self.staging = tempfile.mkdtemp(prefix='bztogl-archive-')
+        self.tree = os.path.join(self.staging, 'tree', 'project')
+        os.makedirs(self.tree)
+        self._lock = threading.Lock()
+        self._issues = open(os.path.join(self.tree, 'issues.ndjson'), 'w',
+                            encoding='utf-8')
+        self.issue_count = 0
+        self.labels = set()
+        self.milestones = {}
+        self.assignees = set()
+
+    def _milestone(self, title):
+        if title not in self.milestones:
+            self.milestones[title] = {'iid': len(self.milestones) + 1,
+                                      'title': title, 'state': 'active'}
+        return self.milestones[title]
+
+    def write(self, record):
+        if record['type'] != 'issue':
+            return
+        payload = record['issue']
+        notes = [{
+            'note': note['body'],
+            'noteable_type': 'Issue',
+            'created_at': note.get('created_at'),
+            'updated_at': note.get('created_at'),
+            'system': False,
+            'author': {'name': 'bztogl'},
+        } for note in record['notes']]
+
+        with self._lock:
+            self.issue_count += 1
+            issue = {
+                'iid': self.issue_count,
+                'title': payload['title'],
+                'description': payload['description'],
+                'created_at': payload['created_at'],
+                'updated_at': payload['created_at'],
+                'state': 'closed' if record['state_event'] == 'close'
+                         else 'opened',
+                'confidential': payload.get('confidential', False),
+                'label_links': [{'label': _label(label)}
+                                for label in payload['labels'] or []],
+                'notes': notes,
+            }
+            self.labels.update(payload['labels'] or [])
+            if payload.get('milestone'):
+                issue['milestone'] = self._milestone(payload['milestone'])
+            if record['assignee_id'] is not None:
+                issue['issue_assignees'] = [{'user_id': record['assignee_id']}]
+                self.assignees.add(record['assignee_id'])
+            self._issues.write(_dump(issue) + '\n')
+
+    def write_upload(self, filename, f):
+        """Stores the contents of @f in the archive and returns the URL
+        GitLab will serve it from once imported"""
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.staging,
+                                         delete=False) as fp:
+            while True:
+                chunk = f.read(buffers.COPY_CHUNK)
+                if not chunk:
+                    break
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                digest.update(chunk)
+                fp.write(chunk)
+        secret = digest.hexdigest()[:32]
+        filename = os.path.basename(filename) or 'attachment'
+
+        path = os.path.join(self.staging, 'uploads', secret, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(fp.name, path)
+        return '/uploads/{}/{}'.format(secret, urllib.parse.quote(filename))
+
+    def _write_ndjson(self, relation, objects):
+        with open(os.path.join(self.tree, relation + '.ndjson'), 'w',
+                  encoding='utf-8') as f:
+            for obj in objects:
+                f.write(_dump(obj) + '\n')
+
+    def close(self, project, members=()):
+        """Writes the archive for @project, with @members so that GitLab
+        can map the assignees to its users"""
+        with self._lock:
+            self._issues.close()
+
+        self._write_ndjson('labels', (_label(title)
+                                      for title in sorted(self.labels)))
+        self._write_ndjson('milestones', self.milestones.values())
+        self._write_ndjson('project_members', ({
+            'user_id': user.id,
+            'access_level': 30,
+            'source_type': 'Project',
+            'user': {'id': user.id, 'email': user.email,
+                     'username': user.username},
+        } for user in members))
+
+        with open(os.path.join(self.staging, 'VERSION'), 'w') as f:
+            f.write(EXPORT_VERSION)
+        with open(os.path.join(self.staging, 'tree', 'project.json'),
+                  'w') as f:
+            f.write(_dump({'description': project, 'visibility_level': 0}))
+
+        with tarfile.open(self.path, 'w:gz') as tar:
+            for name in sorted(os.listdir(self.staging)):
+                tar.add(os.path.join(self.staging, name), arcname=name)
+        shutil.rmtree(self.staging)
+
+
+class ArchiveTarget(spool.SpoolTarget):
+    """GitLab target which renders the issues into an ArchiveWriter"""
+
+    upload_bugzilla_attachment = common.GitLab.upload_bugzilla_attachment
+
+    def upload_file(self, filename, f):
+        url = self.spool.write_upload(filename, f)
+        markdown = '[{}]({})'.format(filename, url)
+        if filename.lower().endswith(IMAGE_EXTENSIONS):
+            markdown = '!' + markdown
+        return {'alt': filename, 'url': url, 'markdown': markdown}
+
+    def find_issue(self, title, creation_time):
+        # The project is only created when the archive is imported
+        return []
+
+    def find_patch(self, title, creation_time):
+        return []
+
+    def close(self):
+        members = [user for user in self.all_users or []
+                   if user.id in self.spool.assignees and user.email]
+        self.spool.close(self.target_project, members)
+        print("Wrote {} issues to {}".format(self.spool.issue_count,
+                                             self.spool.path))
@@ -0,0 +1,57 @@
+import fnmatch
+
+UPLOAD = 'upload'
+LINK = 'link'
+SKIP = 'skip'
+ACTIONS = (UPLOAD, LINK, SKIP)
+
+
+class AttachmentPolicy:
+    """Decides, from the metadata Bugzilla returned for an attachment,
+    whether it is uploaded to GitLab, linked to in Bugzilla or left out.
+
+    Attachments larger than @max_size bytes, or whose MIME type is not in
+    @allow (when given) or is in @deny, are linked to. Obsolete ones get
+    the @obsolete action. The MIME lists take shell-style patterns such as
+    'image/*'."""
+
+    def __init__(self, max_size=None, obsolete=UPLOAD, allow=None,
+                 deny=None):
+        self.max_size = max_size
+        self.obsolete = obsolete
+        self.allow = allow or []
+        self.deny = deny or []
+
+    def _mime_allowed(self, content_type):
+        if any(fnmatch.fnmatch(content_type, pattern)
+               for pattern in self.deny):
+            return False
+        return not self.allow or any(fnmatch.fnmatch(content_type, pattern)
+                                     for pattern in self.allow)
+
+    def decide(self, metadata):
+        action = UPLOAD
+        if metadata.get('is_obsolete'):
+            action = self.obsolete
+        if action == UPLOAD:
+            size = metadata.get('size')
+            if self.max_size is not None and size is not None and \
+                    size > self.max_size:
+                action = LINK
+            elif not self._mime_allowed(metadata.get('content_type', '')):
+                action = LINK
+        return action
+
+
+def attachment_url(bzurl, atid):
+    return '{}/attachment.cgi?id={}'.format(bzurl, atid)
+
+
+def link_markdown(bzurl, atid, metadata):
+    """The markdown standing for an upload of an attachment left in
+    Bugzilla"""
+    markdown = '[{}]({})'.format(metadata['file_name'],
+                                 attachment_url(bzurl, atid))
+    if metadata.get('size') is not None:
+        markdown += ' ({} bytes, not migrated)'.format(metadata['size'])
+    return markdown
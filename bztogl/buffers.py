@@ -0,0 +1,58 @@
+import contextlib
+import tempfile
+import threading
+
+# Attachments up to this size are buffered in memory, larger ones on disk
+SPILL_SIZE = 8 * 1024 * 1024
+# Bytes of attachment data all the concurrent transfers may hold in memory
+MEMORY_BUDGET = 64 * 1024 * 1024
+COPY_CHUNK = 256 * 1024
+
+
+class MemoryBudget:
+    """Bytes shared by the concurrent attachment transfers. A transfer
+    reserves its size for as long as it holds the data in memory and waits
+    while the others use up the budget, so that peak memory stays around
+    the limit whatever the number of workers."""
+
+    def __init__(self, limit=MEMORY_BUDGET):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, size):
+        # Transfers larger than the whole budget run on their own
+        size = min(size or 0, self.limit)
+        with self._cond:
+            while self.used and self.used + size > self.limit:
+                self._cond.wait()
+            self.used += size
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.used -= size
+                self._cond.notify_all()
+
+
+# Shared by every transfer of the process
+BUDGET = MemoryBudget()
+
+
+def spill_buffer(spill_size=SPILL_SIZE):
+    """Returns a file object kept in memory until @spill_size bytes are
+    written to it, and in a temporary file after that"""
+    return tempfile.SpooledTemporaryFile(max_size=spill_size)
+
+
+def copy(src, dst):
+    """Copies file object @src to @dst without reading it all at once,
+    returns the number of bytes copied"""
+    size = 0
+    while True:
+        chunk = src.read(COPY_CHUNK)
+        if not chunk:
+            return size
+        dst.write(chunk)
+        size += len(chunk)
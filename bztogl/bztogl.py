@@ -18,14 +18,15 @@ import argparse
 import itertools
 import os
 import re
+import socket
 import sys
-import urllib.parse
 
 import bugzilla
-import gitlab
 
-from . import common, milestones, template, users
+from . import archive, attachments, buffers, common, milestones, render
+from . import shards, snapshot, spool, sync, template, users
 
+OPEN_STATUSES = "NEW ASSIGNED REOPENED NEEDINFO UNCONFIRMED".split()
 NEEDINFO_LABEL = "2. Needs Information"
 KEYWORD_MAP = {
     "accessibility": "8. Accessibility",
@@ -55,172 +56,136 @@ COMPONENT_MAP = {
 }
 
 
-def processbug(bgo, bzurl, instance, resolution, target, user_cache,
-               milestone_cache, bzbug):
-    print("Processing bug #%d: %s" % (bzbug.id, bzbug.summary))
-    # bzbug.cc
-    # bzbug.id
-    # bzbug.summary
-    # bzbug.creator
-    # bzbug.creationtime
-    # bzbug.target_milestone
-    # bzbug.blocks
-    # bzbug.depends_on
-    # bzbug.see_also
-    # bzbug.assigned_to
-
-    def get_attachments_metadata(self):
+def get_attachments_metadata(bzbug):
+    if "attachments" in bzbug.__dict__:
+        attachments = bzbug.attachments
+    else:
         # pylint: disable=protected-access
-        proxy = self.bugzilla._proxy
+        proxy = bzbug.bugzilla._proxy
         # pylint: enable=protected-access
+        rawret = proxy.Bug.attachments(
+            {"ids": [bzbug.bug_id], "exclude_fields": ["data"]})
+        attachments = rawret["bugs"][str(bzbug.bug_id)]
+
+    index = {}
+    for at in attachments:
+        # Leave the bug's own attachment list as it is
+        at = dict(at)
+        atid = at.pop('id')
+        index[atid] = at
+    return index
+
+
+def migrate_attachment(bgo, bzurl, target, comment, metadata, policy):
+    atid = comment['attachment_id']
+    filename = metadata[atid]['file_name']
+    action = policy.decide(metadata[atid])
+    if action == attachments.SKIP:
+        print("    Attachment {} found, skipping".format(filename))
+        return ''
+    if action == attachments.LINK:
+        print("    Attachment {} found, linking".format(filename))
+        ret = {'markdown': attachments.link_markdown(bzurl, atid,
+                                                     metadata[atid])}
+        return template.render_attachment(atid, metadata[atid], ret)
 
-        if "attachments" in self.__dict__:
-            attachments = self.attachments
-        else:
-            rawret = proxy.Bug.attachments(
-                {"ids": [self.bug_id], "exclude_fields": ["data"]})
-            attachments = rawret["bugs"][str(self.bug_id)]
-
-        index = {}
-        for at in attachments:
-            atid = at.pop('id')
-            index[atid] = at
-        return index
-
-    def gitlab_upload_file(target, filename, f, sudo=None):
-        url = "{}api/v3/projects/{}/uploads".format(target.gl_url,
-                                                    target.get_project().id)
-        target.gl.session.headers = {"PRIVATE-TOKEN": target.token}
-        #if sudo:
-            #target.gl.session.headers['sudo'] = '{}'.format(sudo)
-        ret = target.gl.session.post(url, files={
-            'file': (urllib.parse.quote(filename), f)
-        })
-        if ret.status_code != 201:
-            raise Exception("Could not upload file: {}".format(ret.text))
-        return ret.json()
-
-    def migrate_attachment(comment, metadata):
-        atid = comment['attachment_id']
+    print("    Attachment {} found, migrating".format(filename))
+    ret = target.upload_bugzilla_attachment(bgo, atid, filename,
+                                            metadata[atid].get('size'))
 
-        if 'author' in comment:
-            author = user_cache[comment['author']]
-        else:
-            author = user_cache[comment['creator']]
-        filename = metadata[atid]['file_name']
-        print("    Attachment {} found, migrating".format(filename))
-        attfile = bgo.openattachment(atid)
-        ret = gitlab_upload_file(target, filename, attfile)#, sudo=author.id)
+    return template.render_attachment(atid, metadata[atid], ret)
 
-        return template.render_attachment(atid, metadata[atid], ret)
 
-    def remove_first_lines(text, numlines):
-        return '\n'.join(text.split('\n')[numlines:])
-
-    def convert_review_comments_to_markdown(text):
-        paragraphs = text.split('\n\n')
-        converted_paragraphs = []
-        for paragraph in paragraphs:
-            # Quick check if this is a diff block
-            if paragraph[:2] not in ('::', '@@'):
-                converted_paragraphs.append(paragraph)
-                continue
-
-            # Slow check if this is a diff block
-            lines = paragraph.split('\n')
-            if not all([line[0] in ':@+- ' for line in lines]):
-                converted_paragraphs.append(paragraph)
-                continue
-
-            converted_paragraphs.append('```diff\n{}\n```'.format(paragraph))
-
-        return '\n\n'.join(converted_paragraphs)
-
-    def is_yorba_import(comment):
-        body = comment['text']
-        is_yorba = (
-            'Original URL: http://redmine.yorba.org/issues/' in body and
-            'Searchable id: yorba-bug-' in body
+def remove_first_lines(text, numlines):
+    return '\n'.join(text.split('\n')[numlines:])
+
+
+def convert_review_comments_to_markdown(text):
+    paragraphs = text.split('\n\n')
+    converted_paragraphs = []
+    for paragraph in paragraphs:
+        # Quick check if this is a diff block
+        if paragraph[:2] not in ('::', '@@'):
+            converted_paragraphs.append(paragraph)
+            continue
+
+        # Slow check if this is a diff block
+        lines = paragraph.split('\n')
+        if not all([line[0] in ':@+- ' for line in lines]):
+            converted_paragraphs.append(paragraph)
+            continue
+
+        converted_paragraphs.append('```diff\n{}\n```'.format(paragraph))
+
+    return '\n\n'.join(converted_paragraphs)
+
+
+def is_yorba_import(comment):
+    body = comment['text']
+    is_yorba = (
+        'Original URL: http://redmine.yorba.org/issues/' in body and
+        'Searchable id: yorba-bug-' in body
+    )
+    if is_yorba:
+        body = re.sub(r'####\n\n#', '---\n\nComment ', body)
+        body = re.sub(
+            r'\n(Original [a-zA-Z ]+: [a-zA-Z0-9.:\/ ]+)', r'\n\1  ', body
+        )
+        body = re.sub(
+            r'\n(Searchable id: [a-zA-Z0-9-]+)', r'\n\1  ', body
         )
-        if is_yorba:
-            body = re.sub(r'####\n\n#', '---\n\nComment ', body)
-            body = re.sub(
-                r'\n(Original [a-zA-Z ]+: [a-zA-Z0-9.:\/ ]+)', r'\n\1  ', body
-            )
-            body = re.sub(
-                r'\n(Searchable id: [a-zA-Z0-9-]+)', r'\n\1  ', body
-            )
-            body = re.sub(r'\n(related to [a-zA-Z]+ - )', r'\n * \1', body)
-            body = re.sub(r'\n(duplicated by [a-zA-Z]+ - )', r'\n * \1', body)
-            body = re.sub(r'\n(blocked by [a-zA-Z]+ - )', r'\n * \1', body)
-            comment['text'] = body
-
-        return is_yorba
-
-    def analyze_bugzilla_comment(comment, attachment_metadata):
-        body = comment['text']
-
-        if re.match(r'Created attachment ([0-9]+)\n', body):
-            # Remove two lines of attachment description and blank line
-            body = remove_first_lines(body, 3)
-            if attachment_metadata[comment['attachment_id']]['is_patch']:
-                return 'hammer_and_wrench', 'submitted a patch', body
-            return 'paperclip', 'uploaded an attachment', body
-
-        match = re.match(r'Review of attachment ([0-9]+):\n', body)
-        if match:
-            body = remove_first_lines(body, 2)
-            body = convert_review_comments_to_markdown(body)
-            return 'mag', 'reviewed patch {}'.format(match.group(1)), body
-
-        match = re.match(r'Comment on attachment ([0-9]+)\n', body)
-        if match:
-            body = remove_first_lines(body, 3)
-
-            # git-bz will push a single commit as a comment on the patch
-            if re.match(r'Attachment [0-9]+ pushed as [0-9a-f]+ -', body):
-                return 'arrow_heading_up', 'committed a patch', body
-
-            kind = 'attachment'
-            if attachment_metadata[comment['attachment_id']]['is_patch']:
-                kind = 'patch'
-            action = 'commented on {} {}'.format(kind, match.group(1))
-            return 'speech_balloon', action, body
-
-        # git-bz pushing multiple commits is just a plain comment. Add
-        # formatting so that the lines don't run together
+        body = re.sub(r'\n(related to [a-zA-Z]+ - )', r'\n * \1', body)
+        body = re.sub(r'\n(duplicated by [a-zA-Z]+ - )', r'\n * \1', body)
+        body = re.sub(r'\n(blocked by [a-zA-Z]+ - )', r'\n * \1', body)
+        comment['text'] = body
+
+    return is_yorba
+
+
+def analyze_bugzilla_comment(comment, attachment_metadata):
+    body = comment['text']
+
+    if re.match(r'Created attachment ([0-9]+)\n', body):
+        # Remove two lines of attachment description and blank line
+        body = remove_first_lines(body, 3)
+        if attachment_metadata[comment['attachment_id']]['is_patch']:
+            return 'hammer_and_wrench', 'submitted a patch', body
+        return 'paperclip', 'uploaded an attachment', body
+
+    match = re.match(r'Review of attachment ([0-9]+):\n', body)
+    if match:
+        body = remove_first_lines(body, 2)
+        body = convert_review_comments_to_markdown(body)
+        return 'mag', 'reviewed patch {}'.format(match.group(1)), body
+
+    match = re.match(r'Comment on attachment ([0-9]+)\n', body)
+    if match:
+        body = remove_first_lines(body, 3)
+
+        # git-bz will push a single commit as a comment on the patch
         if re.match(r'Attachment [0-9]+ pushed as [0-9a-f]+ -', body):
-            body = body.replace('\n', '  \n')
-            return 'arrow_heading_up', 'committed some patches', body
+            return 'arrow_heading_up', 'committed a patch', body
 
-        if re.match(r'\*\*\* Bug [0-9]+ has been marked as a duplicate of '
-                    'this bug. \*\*\*', body):
-            return 'link', 'closed a related bug', body
+        kind = 'attachment'
+        if attachment_metadata[comment['attachment_id']]['is_patch']:
+            kind = 'patch'
+        action = 'commented on {} {}'.format(kind, match.group(1))
+        return 'speech_balloon', action, body
 
-        return 'speech_balloon', 'said', body
+    # git-bz pushing multiple commits is just a plain comment. Add
+    # formatting so that the lines don't run together
+    if re.match(r'Attachment [0-9]+ pushed as [0-9a-f]+ -', body):
+        body = body.replace('\n', '  \n')
+        return 'arrow_heading_up', 'committed some patches', body
 
-    attachment_metadata = get_attachments_metadata(bzbug)
-    comments = bzbug.getcomments()
+    if re.match(r'\*\*\* Bug [0-9]+ has been marked as a duplicate of '
+                'this bug. \*\*\*', body):
+        return 'link', 'closed a related bug', body
 
-    firstcomment = None if len(comments) < 1 else comments[0]
-    is_yorba = is_yorba_import(firstcomment)
-    desctext = None
-    if firstcomment and 'author' in firstcomment:
-        author = firstcomment['author']
-    elif firstcomment and 'creator' in firstcomment:
-        author = firstcomment['creator']
-    else:
-        author = None
-    if is_yorba or author == bzbug.creator:
-        desctext = firstcomment['text']
-        if 'attachment_id' in firstcomment:
-            desctext += '\n' + migrate_attachment(firstcomment,
-                                                  attachment_metadata)
-        comments = comments[1:]
+    return 'speech_balloon', 'said', body
 
-    description = \
-        template.render_issue_description(bzurl, bzbug, desctext, user_cache)
 
+def bug_labels(target, bzbug):
     labels = ['bugzilla']
     if bzbug.status == 'NEEDINFO':
         labels += [NEEDINFO_LABEL]
@@ -235,40 +200,44 @@ def processbug(bgo, bzurl, instance, resolution, target, user_cache,
     for kw in bzbug.keywords:
         if kw in KEYWORD_MAP:
             labels += [KEYWORD_MAP[kw]]
+    return labels
 
-    milestone = None
-    bz_milestone = bzbug.target_milestone
-    if bz_milestone and bz_milestone != '---':
-        milestone = milestone_cache[bz_milestone]
 
-    if user_cache[bzbug.creator]:
-        sudo = user_cache[bzbug.creator].id
-    else:
-        sudo = None
-    issue = target.create_issue(bzbug.id, bzbug.summary, description,
-                                labels, milestone,
-                                str(bzbug.creation_time))
-                                #sudo=sudo)
+def render_comments(comments, bzurl, attachment_metadata):
+    """Returns the emoji, action and markdown body of each of @comments,
+    possibly in a render.RenderPool process"""
+    rendered = []
+    for comment in comments:
+        emoji, action, body = analyze_bugzilla_comment(comment,
+                                                       attachment_metadata)
+        if body:
+            body = template.autolink_texts([body], bzurl)[0]
+        rendered.append((emoji, action, body))
+    return rendered
 
-    # Assign bug to actual account if exists
-    assignee = user_cache[bzbug.assigned_to]
-    if assignee and assignee.id is not None:
-        issue.assignee_id = assignee.id
+
+def comment_size(comment):
+    return len(comment['text'])
+
+
+def migrate_comments(bgo, bzurl, target, user_cache, issue, comments,
+                     attachment_metadata, render_pool, attachment_policy):
+    rendered = render_pool.render(render_comments, comments, bzurl,
+                                  attachment_metadata, size=comment_size)
 
     print("Migrating comments: ")
     c = 0
-    for comment in comments:
+    for comment, (emoji, action, body) in zip(comments, rendered):
         c = c + 1
         print("  [{}/{}]".format(c, len(comments)))
         comment_attachment = ""
         # Only migrate attachment if this is the comment where it was created
         if 'attachment_id' in comment and \
                 comment['text'].startswith('Created attachment'):
-            comment_attachment = migrate_attachment(comment,
-                                                    attachment_metadata)
+            comment_attachment = migrate_attachment(
+                bgo, bzurl, target, comment, attachment_metadata,
+                attachment_policy)
 
-        emoji, action, body = analyze_bugzilla_comment(comment,
-                                                       attachment_metadata)
         if 'author' in comment:
             if user_cache[comment['author']]:
                 author = user_cache[comment['author']].display_name()
@@ -284,39 +253,133 @@ def processbug(bgo, bzurl, instance, resolution, target, user_cache,
                 author = comment['creator']
                 sudo = None
         gitlab_comment = template.render_comment(bzurl, emoji, author, action,
-                                                 body, comment_attachment)
+                                                 body, comment_attachment,
+                                                 autolink=False)
 
         issue.notes.create({
             'body': gitlab_comment,
             'created_at': str(comment['creation_time'])
         })#, sudo=sudo)
 
+
+# The bug fields read while migrating, anything else is left out of the
+# Bugzilla queries
+BUG_FIELDS = [
+    'id',
+    'product',
+    'component',
+    'status',
+    'summary',
+    'creator',
+    'creation_time',
+    'last_change_time',
+    'assigned_to',
+    'cc',
+    'keywords',
+    'version',
+    'target_milestone',
+    'depends_on',
+    'blocks',
+    'see_also',
+    'groups',
+]
+
+
+def processbug(bgo, bzurl, instance, resolution, target, user_cache,
+               milestone_cache, bzbug, sync_state=None, render_pool=None,
+               attachment_policy=None):
+    """Migrates @bzbug to a new GitLab issue and returns it. With a
+    @sync_state the issue is recorded there and the bug is left open in
+    Bugzilla, to be synced again later."""
+    if render_pool is None:
+        render_pool = render.RenderPool()
+    if attachment_policy is None:
+        attachment_policy = attachments.AttachmentPolicy()
+    print("Processing bug #%d: %s" % (bzbug.id, bzbug.summary))
+    # bzbug.cc
+    # bzbug.id
+    # bzbug.summary
+    # bzbug.creator
+    # bzbug.creationtime
+    # bzbug.target_milestone
+    # bzbug.blocks
+    # bzbug.depends_on
+    # bzbug.see_also
+    # bzbug.assigned_to
+
+    attachment_metadata = get_attachments_metadata(bzbug)
+    allcomments = comments = bzbug.getcomments()
+    user_cache.prefetch(itertools.chain(
+        [bzbug.creator, bzbug.assigned_to], bzbug.cc,
+        (c.get('creator', c.get('author')) for c in comments)))
+
+    firstcomment = None if len(comments) < 1 else comments[0]
+    is_yorba = is_yorba_import(firstcomment)
+    desctext = None
+    if firstcomment and 'author' in firstcomment:
+        author = firstcomment['author']
+    elif firstcomment and 'creator' in firstcomment:
+        author = firstcomment['creator']
+    else:
+        author = None
+    if is_yorba or author == bzbug.creator:
+        desctext = firstcomment['text']
+        if 'attachment_id' in firstcomment:
+            desctext += '\n' + migrate_attachment(
+                bgo, bzurl, target, firstcomment, attachment_metadata,
+                attachment_policy)
+        comments = comments[1:]
+
+    desctext, = render_pool.render(template.autolink_texts, [desctext or ''],
+                                   bzurl)
+    description = template.render_issue_description(
+        bzurl, bzbug, desctext, user_cache, autolink=False)
+
+    labels = bug_labels(target, bzbug)
+
+    milestone = None
+    bz_milestone = bzbug.target_milestone
+    if bz_milestone and bz_milestone != '---':
+        milestone = milestone_cache[bz_milestone]
+
+    # Assign bug to actual account if exists
+    assignee = user_cache[bzbug.assigned_to]
+    if assignee and assignee.id is not None:
+        assignee_id = assignee.id
+    else:
+        assignee_id = None
+
+    # Bugs restricted to Bugzilla groups are only visible to their members
+    issue = target.create_issue(bzbug.id, bzbug.summary, description,
+                                labels, milestone,
+                                str(bzbug.creation_time),
+                                assignee_id=assignee_id,
+                                confidential=bool(getattr(bzbug, 'groups',
+                                                          None)))
+
+    migrate_comments(bgo, bzurl, target, user_cache, issue, comments,
+                     attachment_metadata, render_pool, attachment_policy)
+
     # Do last, so that previous actions don't all send an email
     for cc_email in itertools.chain(bzbug.cc, [bzbug.creator]):
         subscriber = user_cache[cc_email]
         if subscriber and subscriber.id is not None:
-            try:
-                issue.subscribe(sudo=subscriber.username)
-            except gitlab.GitlabSubscribeError as e:
-                if e.response_code in (201, 304):
-                    # 201 == workaround for python-gitlab bug
-                    # https://github.com/python-gitlab/python-gitlab/pull/382
-                    # 304 == already subscribed
-                    continue
-                if e.response_code == 403:
-                    print("WARNING: Subscribing users requires admin. "
-                          "Subscribers will not be migrated.")
-                    break
-                raise e
-
-    # Workaround python-gitlab bug by providing redundant state_event
-    # https://github.com/python-gitlab/python-gitlab/pull/389
-    issue.save(state_event='reopen')
+            if not common.subscribe_user(issue, subscriber.username):
+                break
+
+    target.finish_issue(issue, 'reopen')
+
+    if sync_state is not None:
+        sync_state.record(bzbug, issue.iid, allcomments, labels)
+
+    if target.dry_run:
+        print("Spooled GitLab issue for bugzilla bug {}".format(bzbug.id))
+        return issue
 
     print("New GitLab issue created from bugzilla bug "
           "{}: {}".format(bzbug.id, issue.web_url))
 
-    if bzbug.bugzilla.logged_in:
+    if sync_state is None and bzbug.bugzilla.logged_in:
         bz = bzbug.bugzilla
         print("Adding a comment in bugzilla and closing the bug there")
         # TODO: Create a resolution for this specific case? MIGRATED or FWDED?
@@ -325,6 +388,48 @@ def processbug(bgo, bzurl, instance, resolution, target, user_cache,
             status='RESOLVED',
             resolution=resolution))
 
+    return issue
+
+
+def syncbug(bgo, bzurl, target, user_cache, sync_state, bzbug,
+            render_pool=None, attachment_policy=None):
+    """Brings the GitLab issue @bzbug was migrated to up to date: the
+    comments made since the last sync are appended and the labels and
+    state are updated"""
+    entry = sync_state[bzbug.id]
+    print("Syncing bug #%d to issue #%d: %s" %
+          (bzbug.id, entry['iid'], bzbug.summary))
+    issue = target.get_project().issues.get(entry['iid'])
+    if render_pool is None:
+        render_pool = render.RenderPool()
+    if attachment_policy is None:
+        attachment_policy = attachments.AttachmentPolicy()
+
+    allcomments = bzbug.getcomments()
+    comments = [comment for comment in allcomments
+                if comment['id'] > entry['last_comment']]
+    if comments:
+        migrate_comments(bgo, bzurl, target, user_cache, issue, comments,
+                         get_attachments_metadata(bzbug), render_pool,
+                         attachment_policy)
+
+    # Only replace the labels bztogl put there, keep those added in GitLab
+    labels = bug_labels(target, bzbug)
+    issue_labels = [label for label in issue.labels
+                    if label not in entry['labels']] + labels
+    labels_changed = sorted(issue_labels) != sorted(issue.labels)
+    issue.labels = issue_labels
+
+    if bzbug.status in OPEN_STATUSES:
+        state, state_event = 'opened', 'reopen'
+    else:
+        state, state_event = 'closed', 'close'
+    # Bugs changed in other ways don't cost a write
+    if comments or labels_changed or issue.state != state:
+        issue.save(state_event=state_event)
+
+    sync_state.record(bzbug, issue.iid, allcomments, labels)
+
 
 def options():
     parser = argparse.ArgumentParser(
@@ -353,7 +458,85 @@ def options():
                               $user_namespace/$bugzilla_product will be used")
     parser.add_argument('--fdo', action='store_true',
                         help="import for freedesktop.org rather than GNOME")
-    return parser.parse_args()
+    parser.add_argument('--dry-run', action='store_true',
+                        help="render the issues but don't create them, \
+                              write the GitLab payloads to --spool instead")
+    parser.add_argument('--spool', metavar="FILE",
+                        help="NDJSON file the --dry-run payloads are \
+                              appended to")
+    parser.add_argument('--snapshot', metavar="DIR",
+                        help="read the bugs from a snapshot written by \
+                              'bztogl export' instead of Bugzilla")
+    parser.add_argument('--since', metavar="DATE",
+                        help="only migrate the bugs changed since DATE, \
+                              with --sync overrides the recorded watermark")
+    parser.add_argument('--sync', metavar="FILE",
+                        help="record the migrated bugs in FILE and on later \
+                              runs only sync the bugs changed since, leaving \
+                              them open in Bugzilla")
+    parser.add_argument('--shards-db', metavar="FILE",
+                        help="share the migration with other bztogl \
+                              processes through the lease table in the \
+                              SQLite database FILE")
+    parser.add_argument('--shards', type=int, default=16,
+                        help="number of shards the bugs are split into \
+                              with --shards-db")
+    parser.add_argument('--worker-id',
+                        help="name of this process in the lease table, \
+                              host:pid by default")
+    parser.add_argument('--lease-time', type=int, default=shards.LEASE_TIME,
+                        help="seconds after which the shard of a worker \
+                              which stopped can be reclaimed")
+    parser.add_argument('--render-jobs', type=int, default=0,
+                        help="number of processes rendering long comments, \
+                              they are rendered in-process by default")
+    parser.add_argument('--render-threshold', type=int,
+                        default=render.RENDER_THRESHOLD, metavar="CHARS",
+                        help="length from which a comment is rendered by \
+                              the --render-jobs processes")
+    parser.add_argument('--attachment-max-size', type=int, metavar="BYTES",
+                        help="link to larger attachments in Bugzilla \
+                              instead of uploading them")
+    parser.add_argument('--obsolete-attachments', choices=attachments.ACTIONS,
+                        default=attachments.UPLOAD,
+                        help="whether obsolete attachments are uploaded, \
+                              linked to in Bugzilla or left out")
+    parser.add_argument('--attachment-allow', action='append',
+                        metavar="MIME",
+                        help="only upload attachments of this MIME type, \
+                              like 'image/*', can be repeated")
+    parser.add_argument('--attachment-deny', action='append',
+                        metavar="MIME",
+                        help="link to attachments of this MIME type \
+                              instead of uploading them, can be repeated")
+    parser.add_argument('--attachment-memory', type=int, metavar="BYTES",
+                        default=buffers.MEMORY_BUDGET,
+                        help="attachment data held in memory at once by \
+                              all the transfers together")
+    parser.add_argument('--archive', metavar="FILE",
+                        help="write the issues to a GitLab project export \
+                              archive to be loaded with \
+                              bztogl-import-archive, instead of creating them")
+    parser.add_argument('--users-directory', metavar="FILE",
+                        help="keep the list of GitLab users in FILE and \
+                              reuse it for a day")
+    parser.add_argument('--graphql', action='store_true',
+                        help="batch the lookups of GitLab users, labels and \
+                              existing issues into GraphQL requests")
+    parser.add_argument('--graphql-batch', type=int,
+                        default=common.GRAPHQL_BATCH, metavar="LOOKUPS",
+                        help="lookups sent in a single GraphQL request")
+    args = parser.parse_args()
+    if args.dry_run and not args.spool:
+        parser.error("--dry-run requires --spool")
+    if args.dry_run and args.archive:
+        parser.error("--dry-run and --archive can't be used together")
+    if args.sync and (args.dry_run or args.archive):
+        parser.error("--sync needs the issues to be created in GitLab")
+    if args.shards_db and (args.sync or args.dry_run or args.archive):
+        parser.error("--shards-db can't be used with --sync, --dry-run or "
+                     "--archive")
+    return args
 
 
 def check_if_target_project_exists(target):
@@ -368,65 +551,211 @@ def check_if_target_project_exists(target):
         exit(1)
 
 
-def main():
-    args = options()
-
-    if args.fdo:
-        if args.production:
+def instance_urls(fdo, production):
+    """Returns the GitLab, Bugzilla and git URLs, the instance name and the
+    Bugzilla resolution used for migrated bugs"""
+    if fdo:
+        if production:
             glurl = "https://gitlab.freedesktop.org/"
         else:
             glurl = "http://localhost:8080/"
-        bzurl = "https://bugs.freedesktop.org"
-        giturl = "https://anongit.freedesktop.org/git/"
-        instance = "freedesktop.org"
-        bzresolution = 'MOVED'
+        return (glurl, "https://bugs.freedesktop.org",
+                "https://anongit.freedesktop.org/git/", "freedesktop.org",
+                'MOVED')
+
+    if production:
+        glurl = "https://gitlab.gnome.org/"
     else:
-        if args.production:
-            glurl = "https://gitlab.gnome.org/"
-        else:
-            glurl = "https://gitlab-test.gnome.org/"
-        bzurl = "https://bugzilla.gnome.org"
-        giturl = "https://git.gnome.org/browse/"
-        instance = "GNOME"
-        bzresolution = 'OBSOLETE'
+        glurl = "https://gitlab-test.gnome.org/"
+    return (glurl, "https://bugzilla.gnome.org",
+            "https://git.gnome.org/browse/", "GNOME", 'OBSOLETE')
 
-    target = common.GitLab(glurl, giturl, args.token, args.product,
-                           args.target_project, args.automate)
 
-    target.connect()
+def connect_bugzilla(bzurl, bz_user, bz_password):
+    print("Connecting to %s" % bzurl)
+    if bz_user and bz_password:
+        return bugzilla.Bugzilla(bzurl, bz_user, bz_password)
+
+    print("WARNING: Bugzilla credentials were not provided, BZ bugs won't "
+          "be closed and subscribers won't notice the migration")
+    return bugzilla.Bugzilla(bzurl, tokenfile=None)
+
+
+def query_open_bugs(bgo, product, component):
+    query = bgo.build_query(product=product, component=component,
+                            include_fields=BUG_FIELDS)
+    if component:
+        print("Querying for open bugs for the '%s' product, '%s' component" %
+              (product, component))
+    else:
+        print("Querying for open bugs for the '%s' product, all components" %
+              product)
+    query["status"] = OPEN_STATUSES
+    bzbugs = bgo.query(query)
+    print("{} bugs found".format(len(bzbugs)))
+    return bzbugs
+
+
+def query_changed_bugs(bgo, product, component, since):
+    """Returns the bugs changed since @since, whatever their status"""
+    query = bgo.build_query(product=product, component=component,
+                            include_fields=BUG_FIELDS)
+    print("Querying for bugs changed since %s" % since)
+    query["last_change_time"] = since
+    bzbugs = bgo.query(query)
+    print("{} bugs found".format(len(bzbugs)))
+    return bzbugs
+
+
+def warm_caches(target, bgo, product, bzbugs):
+    """Returns the caches shard workers share: the GitLab users by e-mail,
+    and the labels and milestones of @bzbugs, created in GitLab"""
+    user_cache = users.UserCache(target, bgo, product)
+    milestone_cache = milestones.MilestoneCache(target)
+
+    labels = sorted(set(label for bzbug in bzbugs
+                        for label in bug_labels(target, bzbug)))
+    target.create_labels(labels)
+    titles = set(bzbug.target_milestone for bzbug in bzbugs
+                 if bzbug.target_milestone and
+                 bzbug.target_milestone != '---')
+
+    return {
+        'gitlab_emails': user_cache.gitlab_emails,
+        'labels': labels,
+        'milestones': {title: milestone_cache[title].id for title in titles},
+    }
+
+
+def migrate_shards(args, bgo, bzurl, instance, resolution, target, bzbugs,
+                   render_pool, attachment_policy):
+    # --since also returns the bugs closed since, which are not migrated
+    bzbugs = [bzbug for bzbug in bzbugs if bzbug.status in OPEN_STATUSES]
+    leases = shards.LeaseTable(args.shards_db, args.lease_time)
+    owner = args.worker_id or \
+        '{}:{}'.format(socket.gethostname(), os.getpid())
+    leases.add_shards(shards.shard_ranges([bzbug.id for bzbug in bzbugs],
+                                          args.shards))
+
+    caches = shards.shared_caches(
+        leases, owner, lambda: warm_caches(target, bgo, args.product, bzbugs))
+    user_cache = users.UserCache(target, bgo, args.product,
+                                 caches['gitlab_emails'])
+    milestone_cache = milestones.MilestoneCache(target, caches['milestones'])
+    target.labels.update(dict.fromkeys(caches['labels'], True))
+
+    shards.run_worker(leases, owner, bzbugs, lambda bzbug: processbug(
+        bgo, bzurl, instance, resolution, target, user_cache,
+        milestone_cache, bzbug, render_pool=render_pool,
+        attachment_policy=attachment_policy))
+    leases.close()
+
+
+def export_options(argv):
+    parser = argparse.ArgumentParser(
+        prog='bztogl export',
+        description="Save the open bugs of a Bugzilla product to a local \
+                     snapshot that bztogl --snapshot can migrate from")
+    parser.add_argument('--product', help="bugzilla product name",
+                        required=True)
+    parser.add_argument('--component', help="bugzilla component name")
+    parser.add_argument('--bz-user', help="bugzilla username")
+    parser.add_argument('--bz-password', help="bugzilla password")
+    parser.add_argument('--fdo', action='store_true',
+                        help="export from freedesktop.org rather than GNOME")
+    parser.add_argument('--output', metavar="DIR", required=True,
+                        help="directory the snapshot is written to")
+    return parser.parse_args(argv)
+
 
-    if not args.recreate and args.target_project is not None:
+def export_main(argv):
+    args = export_options(argv)
+
+    bzurl = instance_urls(args.fdo, False)[1]
+    bgo = connect_bugzilla(bzurl, args.bz_user, args.bz_password)
+    bzbugs = query_open_bugs(bgo, args.product, args.component)
+    snapshot.export_product(bgo, args.product, bzbugs, args.output)
+    print("Snapshot written to %s" % args.output)
+
+
+def main():
+    if sys.argv[1:2] == ['export']:
+        export_main(sys.argv[2:])
+        return
+
+    args = options()
+
+    glurl, bzurl, giturl, instance, bzresolution = \
+        instance_urls(args.fdo, args.production)
+
+    if args.dry_run:
+        target = spool.SpoolTarget(spool.SpoolWriter(args.spool), glurl,
+                                   giturl, args.token, args.product,
+                                   args.target_project, args.automate,
+                                   args.users_directory)
+    elif args.archive:
+        target = archive.ArchiveTarget(archive.ArchiveWriter(args.archive),
+                                       glurl, giturl, args.token,
+                                       args.product, args.target_project,
+                                       args.automate, args.users_directory)
+    else:
+        target = common.GitLab(glurl, giturl, args.token, args.product,
+                               args.target_project, args.automate,
+                               args.users_directory)
+
+    target.connect()
+    if args.graphql and not target.dry_run:
+        target.enable_graphql(args.graphql_batch)
+
+    if args.dry_run:
+        print("Dry run: GitLab payloads will be written to " + args.spool)
+    elif args.archive:
+        print("GitLab issues will be written to " + args.archive)
+    elif not args.recreate and args.target_project is not None:
         check_if_target_project_exists(target)
 
-    if not args.target_project and args.recreate:
+    if not args.target_project and args.recreate and not target.dry_run:
         target.import_project()
 
     if args.only_import:
         return
 
-    print("Connecting to %s" % bzurl)
-    if args.bz_user and args.bz_password:
-        bgo = bugzilla.Bugzilla(bzurl, args.bz_user, args.bz_password)
+    if args.snapshot:
+        print("Reading Bugzilla snapshot from %s" % args.snapshot)
+        bgo = snapshot.BugzillaSnapshot(args.snapshot)
     else:
-        print("WARNING: Bugzilla credentials were not provided, BZ bugs won't "
-              "be closed and subscribers won't notice the migration")
-        bgo = bugzilla.Bugzilla(bzurl, tokenfile=None)
+        bgo = connect_bugzilla(bzurl, args.bz_user, args.bz_password)
 
-    query = bgo.build_query(product=args.product, component=args.component)
-    if args.component:
-        print("Querying for open bugs for the '%s' product, '%s' component" %
-              (args.product, args.component))
+    sync_state = None
+    since = args.since
+    if args.sync:
+        sync_state = sync.SyncState(args.sync)
+        since = since or sync_state.watermark
+
+    if since:
+        bzbugs = query_changed_bugs(bgo, args.product, args.component, since)
     else:
-        print("Querying for open bugs for the '%s' product, all components" %
-              args.product)
-    query["status"] = "NEW ASSIGNED REOPENED NEEDINFO UNCONFIRMED".split()
-    bzbugs = bgo.query(query)
-    print("{} bugs found".format(len(bzbugs)))
+        bzbugs = query_open_bugs(bgo, args.product, args.component)
+    if sync_state is not None:
+        # Oldest change first, so that the watermark never skips over a bug
+        # if the run is interrupted
+        bzbugs.sort(key=lambda bzbug: str(bzbug.last_change_time))
     count = 0
+    buffers.BUDGET.limit = args.attachment_memory
+    render_pool = render.RenderPool(args.render_jobs, args.render_threshold)
+    attachment_policy = attachments.AttachmentPolicy(
+        args.attachment_max_size, args.obsolete_attachments,
+        args.attachment_allow, args.attachment_deny)
 
     # There are products without Bugzilla tracking
-    if len(bzbugs) != 0:
-        milestone_cache = milestones.MilestoneCache(target)
+    if len(bzbugs) != 0 and args.shards_db:
+        migrate_shards(args, bgo, bzurl, instance, bzresolution, target,
+                       bzbugs, render_pool, attachment_policy)
+    elif len(bzbugs) != 0:
+        if target.dry_run:
+            milestone_cache = spool.MilestoneTitles()
+        else:
+            milestone_cache = milestones.MilestoneCache(target)
         user_cache = users.UserCache(target, bgo, args.product)
 
         # TODO: Check if there were bugs from this module already filed (i.e.
@@ -437,8 +766,25 @@ def main():
             #if bzbug.id == 106300:
                 #sys.stdout.write('    SKIPPED!')
                 #continue
-            processbug(bgo, bzurl, instance, bzresolution, target, user_cache,
-                       milestone_cache, bzbug)
+            if sync_state is not None and bzbug.id in sync_state:
+                syncbug(bgo, bzurl, target, user_cache, sync_state, bzbug,
+                        render_pool, attachment_policy)
+            elif bzbug.status in OPEN_STATUSES:
+                processbug(bgo, bzurl, instance, bzresolution, target,
+                           user_cache, milestone_cache, bzbug, sync_state,
+                           render_pool, attachment_policy)
+            else:
+                print("Skipping bug #%d, it was closed before being "
+                      "migrated" % bzbug.id)
+                if sync_state is not None:
+                    sync_state.advance(bzbug.last_change_time)
+
+            if sync_state is not None:
+                sync_state.save()
+
+    render_pool.close()
+    if target.dry_run:
+        target.close()
 
     if os.path.exists('users_cache'):
         print('IMPORTANT: Remove the file \'users_cache\' after use, it \
@@ -1,13 +1,201 @@
+import concurrent.futures
 import json
+import os
+import threading
 import time
 import urllib.parse
+import urllib.request
 
 import gitlab
 
+from . import buffers
+
+
+def subscribe_user(issue, username):
+    """Subscribes @username to @issue, returns False if subscribing other
+    users is not allowed with the current token."""
+    try:
+        issue.subscribe(sudo=username)
+    except gitlab.GitlabSubscribeError as e:
+        if e.response_code in (201, 304):
+            # 201 == workaround for python-gitlab bug
+            # https://github.com/python-gitlab/python-gitlab/pull/382
+            # 304 == already subscribed
+            return True
+        if e.response_code == 403:
+            print("WARNING: Subscribing users requires admin. "
+                  "Subscribers will not be migrated.")
+            return False
+        raise e
+    return True
+
+
+class Journal:
+    """Append-only record of the IDs of the items already migrated, so that
+    an interrupted parallel migration can be resumed"""
+
+    def __init__(self, path):
+        self.path = path
+        self._done = set()
+        self._lock = threading.Lock()
+
+        if path is None:
+            return
+        try:
+            with open(path) as f:
+                self._done = set(int(line) for line in f if line.strip())
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, id):
+        return id in self._done
+
+    def add(self, id):
+        with self._lock:
+            self._done.add(id)
+            if self.path is None:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write("%d\n" % id)
+
+
+USERS_PAGE_SIZE = 100
+# A saved user directory older than this is downloaded again
+USERS_DIRECTORY_MAX_AGE = 24 * 60 * 60
+
+
+class DirectoryUser:
+    """The fields of a GitLab user that the migration needs"""
+
+    __slots__ = ('username', 'id', 'name', 'email')
+
+    def __init__(self, username, id, name, email):
+        self.username = username
+        self.id = id
+        self.name = name
+        self.email = email
+
+    @classmethod
+    def from_gitlab(cls, user):
+        return cls(user.username, user.id, user.name,
+                   getattr(user, 'email', None))
+
+
+# Lookups sent in a single GraphQL request
+GRAPHQL_BATCH = 50
+GRAPHQL_TIMEOUT = 120
+
+
+class GraphQL:
+    """Client of the GitLab GraphQL API. Lookups are packed, each under its
+    own alias, into one request per batch instead of one REST request
+    each."""
+
+    def __init__(self, gitlab_url, token, batch=GRAPHQL_BATCH):
+        self.url = gitlab_url.rstrip('/') + '/api/graphql'
+        self.token = token
+        self.batch = batch
+
+    def query(self, query, variables=None):
+        """Sends @query and returns its data"""
+        request = urllib.request.Request(
+            self.url, method='POST',
+            data=json.dumps({'query': query,
+                             'variables': variables or {}}).encode('utf-8'),
+            headers={'Content-Type': 'application/json',
+                     'Authorization': 'Bearer ' + self.token})
+        with urllib.request.urlopen(request,
+                                    timeout=GRAPHQL_TIMEOUT) as response:
+            result = json.loads(response.read().decode('utf-8'))
+        if result.get('errors'):
+            raise Exception("GraphQL query failed: %s" %
+                            result['errors'][0]['message'])
+        return result['data']
+
+    def lookup(self, keys, field, arguments, selection, project=None):
+        """Resolves each of @keys with the @field query, and returns
+        {key: result}. @arguments are (name, GraphQL type, function
+        returning the value for a key) tuples. The field is queried on
+        @project if given."""
+        keys = list(keys)
+        results = {}
+        for i in range(0, len(keys), self.batch):
+            batch = keys[i:i + self.batch]
+            declarations = []
+            fields = []
+            variables = {}
+            for j, key in enumerate(batch):
+                alias = 'q%d' % j
+                args = []
+                for name, type, value in arguments:
+                    variable = '%s_%s' % (alias, name)
+                    declarations.append('$%s: %s' % (variable, type))
+                    args.append('%s: $%s' % (name, variable))
+                    variables[variable] = value(key)
+                fields.append('%s: %s(%s) { %s }' % (
+                    alias, field, ', '.join(args), selection))
+
+            body = ' '.join(fields)
+            if project is not None:
+                declarations.append('$project: ID!')
+                variables['project'] = project
+                body = 'project(fullPath: $project) { %s }' % body
+            data = self.query('query(%s) { %s }' % (', '.join(declarations),
+                                                    body), variables)
+            if project is not None:
+                data = data['project']
+                if data is None:
+                    raise Exception("Project %s not found" % project)
+            for j, key in enumerate(batch):
+                results[key] = data['q%d' % j]
+        return results
+
+    def users(self, user_ids):
+        """Returns {id: DirectoryUser, or None if there is no such user}"""
+        users = self.lookup(
+            user_ids, 'user',
+            [('id', 'UserID!', lambda id: 'gid://gitlab/User/%d' % id)],
+            'username name publicEmail')
+        return {id: DirectoryUser(user['username'], id, user['name'],
+                                  user['publicEmail'] or None)
+                if user else None
+                for id, user in users.items()}
+
+    def issues(self, project, items):
+        """Returns {(title, creation_time): matching issue iids} for the
+        (title, creation_time) @items"""
+        issues = self.lookup(
+            items, 'issues',
+            [('search', 'String', lambda item: item[0]),
+             ('createdAfter', 'Time', lambda item: item[1])],
+            'nodes { iid }', project)
+        return {item: [int(node['iid']) for node in found['nodes']]
+                for item, found in issues.items()}
+
+    def merge_requests(self, project, titles):
+        """Returns {title: matching merge request iids}"""
+        mergerequests = self.lookup(
+            titles, 'mergeRequests',
+            [('search', 'String', lambda title: title)],
+            'nodes { iid }', project)
+        return {title: [int(node['iid']) for node in found['nodes']]
+                for title, found in mergerequests.items()}
+
+    def labels(self, project, titles):
+        """Returns the labels of @titles which exist in @project"""
+        labels = self.lookup(
+            titles, 'label',
+            [('title', 'String!', lambda title: title)],
+            'title', project)
+        return set(title for title, label in labels.items() if label)
+
 
 class GitLab:
+    dry_run = False
+
     def __init__(self, gitlab_url, git_url, token, product,
-                 target_project=None, automate=False):
+                 target_project=None, automate=False, users_directory=None):
         self.gl = None
         self.gl_url = gitlab_url
         self.git_url = git_url
@@ -17,9 +205,17 @@ class GitLab:
         self.automate = automate
         self.all_users = None
         self.all_users_map = {}
+        self.all_users_emails = {}
+        self.users_directory = users_directory
         self.project = None
         self.milestones = {}
         self.labels = {}
+        # Guards the milestone and label caches when issues are created from
+        # several threads
+        self._lock = threading.Lock()
+        self.unprovisioned_users = set()
+        self._users_lock = threading.RLock()
+        self.graphql = None
 
     def connect(self):
         print("Connecting to %s" % self.gl_url)
@@ -32,43 +228,75 @@ class GitLab:
             print("Using target project '{}' since --target-project was not"
                   " provided".format(self.target_project))
 
+    def enable_graphql(self, batch=GRAPHQL_BATCH):
+        """Batches the lookups of issues, merge requests, users and labels
+        into GraphQL requests"""
+        self.graphql = GraphQL(self.gl_url, self.token, batch)
+
     def get_project(self):
         if not self.project:
             self.project = self.gl.projects.get(self.target_project)
         return self.project
 
+    def _create_labels(self, labels):
+        if self.graphql is not None:
+            missing = [label for label in labels if label not in self.labels]
+            if missing:
+                for label in self.graphql.labels(self.target_project,
+                                                 missing):
+                    self.labels[label] = True
+        for label in labels:
+            if not label in self.labels:
+                try:
+                   self.get_project().labels.create({'name': label, 'color': '#428BCA'})
+                except:
+                   print("label %s already exists" % (label))
+                self.labels[label] = True
+
+    def create_labels(self, labels):
+        """Creates the project labels in @labels which don't exist yet"""
+        with self._lock:
+            self._create_labels(labels)
+
     def create_issue(self, id, summary, description, labels,
-                     milestone, creation_time, sudo=None):
+                     milestone, creation_time, sudo=None, assignee_id=None,
+                     confidential=False):
         payload = {
             'title': summary,
             'description': description,
             'labels': labels,
             'created_at': creation_time
         }
-
-        if milestone:
-            if not milestone in self.milestones:
-                try:
-                    gl_milestone = self.get_project().milestones.create({'title': milestone})
-                except:
-                    print("milestone %s already exists" % (milestone))
-                    gl_milestones = self.get_project().milestones.list(search=milestone)
-                    gl_milestone = gl_milestones[0]
-                self.milestones[milestone] = gl_milestone
-            gl_milestone = self.milestones[milestone]
-            payload['milestone_id'] = gl_milestone.id
-
-        if labels:
-            for label in labels:
-                if not label in self.labels:
+        if assignee_id is not None:
+            payload['assignee_ids'] = [assignee_id]
+        if confidential:
+            payload['confidential'] = True
+
+        with self._lock:
+            if milestone:
+                if not milestone in self.milestones:
                     try:
-                       self.get_project().labels.create({'name': label, 'color': '#428BCA'})
+                        gl_milestone = self.get_project().milestones.create({'title': milestone})
                     except:
-                       print("label %s already exists" % (label))
-                       self.labels[label] = True
+                        print("milestone %s already exists" % (milestone))
+                        gl_milestones = self.get_project().milestones.list(search=milestone)
+                        gl_milestone = gl_milestones[0]
+                    self.milestones[milestone] = gl_milestone
+                gl_milestone = self.milestones[milestone]
+                payload['milestone_id'] = gl_milestone.id
+
+            if labels:
+                self._create_labels(labels)
 
         return self.get_project().issues.create(payload, sudo=sudo)
 
+    def finish_issue(self, issue, state_event):
+        """Brings a newly created @issue to its final state. Everything
+        else was already sent by create_issue(), but GitLab only creates
+        open issues, so only closing costs another request."""
+        if state_event == 'close':
+            issue.save(state_event=state_event)
+
     def create_mergerequest(self, id, summary, description, labels,
                      milestone, sudo=None):
         payload = {
@@ -79,26 +307,21 @@ class GitLab:
             'target_branch': 'master'
         }
 
-        if milestone:
-            if not milestone in self.milestones:
-                try:
-                    gl_milestone = self.get_project().milestones.create({'title': milestone})
-                except:
-                    print("milestone %s already exists" % (milestone))
-                    gl_milestones = self.get_project().milestones.list(search=milestone)
-                    gl_milestone = gl_milestones[0]
-                self.milestones[milestone] = gl_milestone
-            gl_milestone = self.milestones[milestone]
-            payload['milestone_id'] = gl_milestone.id
-
-        if labels:
-            for label in labels:
-                if not label in self.labels:
+        with self._lock:
+            if milestone:
+                if not milestone in self.milestones:
                     try:
-                       self.get_project().labels.create({'name': label, 'color': '#428BCA'})
+                        gl_milestone = self.get_project().milestones.create({'title': milestone})
                     except:
-                       print("label %s already exists" % (label))
-                       self.labels[label] = True
+                        print("milestone %s already exists" % (milestone))
+                        gl_milestones = self.get_project().milestones.list(search=milestone)
+                        gl_milestone = gl_milestones[0]
+                    self.milestones[milestone] = gl_milestone
+                gl_milestone = self.milestones[milestone]
+                payload['milestone_id'] = gl_milestone.id
+
+            if labels:
+                self._create_labels(labels)
 
         return self.get_project().mergerequests.create(payload, sudo=sudo)
 
@@ -108,15 +331,74 @@ class GitLab:
             'username': user_id,
             'name': user_id})
 
+    def _add_to_directory(self, user):
+        self.all_users.append(user)
+        self.all_users_map[user.username] = user
+        if user.email:
+            self.all_users_emails[user.email] = user
+
+    def _iter_users(self):
+        page = 1
+        while True:
+            users = self.gl.users.list(page=page, per_page=USERS_PAGE_SIZE)
+            for user in users:
+                yield DirectoryUser.from_gitlab(user)
+            if len(users) < USERS_PAGE_SIZE:
+                return
+            page += 1
+
+    def _load_users_directory(self):
+        try:
+            if time.time() - os.path.getmtime(self.users_directory) > \
+                    USERS_DIRECTORY_MAX_AGE:
+                print("%s is out of date" % self.users_directory)
+                return False
+            with open(self.users_directory) as f:
+                directory = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if directory['gitlab_url'] != self.gl_url:
+            return False
+
+        print("Loading users from %s" % self.users_directory)
+        for fields in directory['users']:
+            self._add_to_directory(DirectoryUser(*fields))
+        return True
+
+    def save_users_directory(self):
+        if not self.users_directory or self.all_users is None:
+            return
+        with self._users_lock:
+            directory = {
+                'gitlab_url': self.gl_url,
+                'users': [[u.username, u.id, u.name, u.email]
+                          for u in self.all_users],
+            }
+        with open(self.users_directory + '.tmp', 'w') as f:
+            json.dump(directory, f)
+        os.replace(self.users_directory + '.tmp', self.users_directory)
+
     def get_all_users(self):
-        if self.all_users is None:
-            self.all_users = self.gl.users.list(all=True)
-            for user in self.all_users:
-                print("adding user to cache %s" % (user.attributes['username']))
-                self.all_users_map[user.attributes['username']] = user
+        with self._users_lock:
+            if self.all_users is None:
+                self.all_users = []
+                if self.users_directory and self._load_users_directory():
+                    return self.all_users
+
+                for count, user in enumerate(self._iter_users(), 1):
+                    self._add_to_directory(user)
+                    if count % (10 * USERS_PAGE_SIZE) == 0:
+                        print("Downloaded %d users" % count)
+                print("Found %d GitLab users" % len(self.all_users))
+                self.save_users_directory()
 
         return self.all_users
 
+    def get_user_emails(self, user_id):
+        """Returns the secondary e-mail addresses of a user"""
+        user = self.gl.users.get(user_id, lazy=True)
+        return [email.email for email in user.emails.list()]
+
     def find_issue(self, title, creation_time):
         return self.get_project().issues.list(search=title, created_after=creation_time)
 
@@ -126,6 +408,36 @@ class GitLab:
     def find_user(self, user_id):
         return self.gl.users.get(user_id)
 
+    def find_issues(self, items):
+        """Returns {(title, creation_time): iids of the matching issues}
+        for the (title, creation_time) @items"""
+        if self.graphql is None:
+            return {item: [issue.iid for issue in self.find_issue(*item)]
+                    for item in items}
+        return self.graphql.issues(self.target_project, items)
+
+    def find_patches(self, items):
+        """Returns {(title, creation_time): iids of the matching merge
+        requests} for the (title, creation_time) @items"""
+        if self.graphql is None:
+            return {item: [mr.iid for mr in self.find_patch(*item)]
+                    for item in items}
+        found = self.graphql.merge_requests(self.target_project,
+                                            set(item[0] for item in items))
+        return {item: found[item[0]] for item in items}
+
+    def find_users(self, user_ids):
+        """Returns {id: user, or None if there is no such user}"""
+        if self.graphql is None:
+            users = {}
+            for id in user_ids:
+                try:
+                    users[id] = self.find_user(id)
+                except gitlab.GitlabGetError:
+                    users[id] = None
+            return users
+        return self.graphql.users(user_ids)
+
     def find_user_by_nick(self, nickname):
         if self.all_users == None:
             self.get_all_users()
@@ -134,6 +446,33 @@ class GitLab:
             return self.all_users_map[nickname]
         return None
 
+    def provision_users(self, nicknames, jobs=1):
+        """Creates the users in @nicknames which don't exist yet, @jobs at a
+        time. Users which couldn't be created are not tried again."""
+        self.get_all_users()
+        with self._users_lock:
+            missing = sorted(set(nicknames) - set(self.all_users_map) -
+                             self.unprovisioned_users)
+        if not missing:
+            return
+
+        print("Creating %d GitLab users" % len(missing))
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            futures = [(nickname, pool.submit(self.create_user, nickname))
+                       for nickname in missing]
+            for nickname, future in futures:
+                try:
+                    user = future.result()
+                except Exception as e:
+                    print("WARNING: Could not create user %s: %s" %
+                          (nickname, e))
+                    with self._users_lock:
+                        self.unprovisioned_users.add(nickname)
+                    continue
+                with self._users_lock:
+                    self._add_to_directory(DirectoryUser.from_gitlab(user))
+        self.save_users_directory()
+
     def remove_project(self, project):
         try:
             project.delete()
@@ -189,6 +528,30 @@ class GitLab:
             time.sleep(1)
             import_status = self.get_import_status(project)
 
+    def upload_bugzilla_attachment(self, bugzilla, atid, filename,
+                                   size=None):
+        # python-bugzilla downloads the whole attachment into memory
+        with buffers.BUDGET.reserve(size):
+            return self.upload_file(filename, bugzilla.openattachment(atid))
+
+    def import_archive(self, path):
+        """Creates the target project from the project export archive at
+        @path and waits for GitLab to import it"""
+        namespace, name = self.target_project.rsplit('/', 1)
+        with open(path, 'rb') as f:
+            output = self.gl.projects.import_project(f, path=name,
+                                                     namespace=namespace)
+
+        project_import = \
+            self.gl.projects.get(output['id'], lazy=True).imports.get()
+        while project_import.import_status not in ('finished', 'failed'):
+            time.sleep(5)
+            project_import.refresh()
+
+        if project_import.import_status == 'failed':
+            raise Exception("Could not import {}: {}".format(
+                path, project_import.import_error))
+
     def upload_file(self, filename, f):
         url = "{}api/v4/projects/{}/uploads".format(self.gl_url,
                                                     self.get_project().id)
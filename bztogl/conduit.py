@@ -0,0 +1,132 @@
+import functools
+import glob
+import gzip
+import json
+import os
+import threading
+
+import phabricator
+
+# Calls whose results are merged per object when loading a snapshot, so that
+# they can be answered for any subset of the objects which were recorded
+TRANSACTIONS_METHOD = 'maniphest.gettasktransactions'
+
+
+def _key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def _phids_only(params):
+    constraints = params.get('constraints') or {}
+    return list(constraints) == ['phids'] and \
+        set(params) <= {'constraints', 'limit', 'attachments'}
+
+
+class _Method:
+    def __init__(self, conduit, name):
+        self._conduit = conduit
+        self._name = name
+
+    def __getattr__(self, attr):
+        return _Method(self._conduit, self._name + '.' + attr)
+
+    def __call__(self, **params):
+        return self._conduit.call(self._name, params)
+
+
+class RecordingConduit:
+    """Forwards Conduit calls to Phabricator and records the responses as
+    a snapshot, one <method>.jsonl.gz file per Conduit method"""
+
+    def __init__(self, live, path):
+        self._live = live
+        self.path = path
+        self._files = {}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        # A new export replaces the previous one rather than adding to it
+        for filename in glob.glob(os.path.join(path, '*.jsonl.gz')):
+            os.remove(filename)
+
+    def __getattr__(self, name):
+        return _Method(self, name)
+
+    def call(self, method, params):
+        result = functools.reduce(getattr, method.split('.'),
+                                  self._live)(**params)
+        line = json.dumps({'params': params, 'result': result.response},
+                          sort_keys=True, ensure_ascii=False)
+
+        with self._lock:
+            if method not in self._files:
+                self._files[method] = gzip.open(
+                    os.path.join(self.path, method + '.jsonl.gz'), 'wt',
+                    encoding='utf-8')
+            self._files[method].write(line + '\n')
+        return result
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files = {}
+
+
+class SnapshotConduit:
+    """Answers Conduit calls from a snapshot written by RecordingConduit.
+
+    Calls which were not recorded, including every write, are sent to the
+    live Phabricator returned by @live."""
+
+    def __init__(self, path, live):
+        self.path = path
+        self._live = live
+        self._calls = {}
+        self._by_phid = {}
+        self._transactions = {}
+
+        for filename in glob.glob(os.path.join(path, '*.jsonl.gz')):
+            method = os.path.basename(filename)[:-len('.jsonl.gz')]
+            with gzip.open(filename, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    self._load(method, json.loads(line))
+
+    def _load(self, method, call):
+        params, result = call['params'], call['result']
+        self._calls[(method, _key(params))] = result
+
+        if method == TRANSACTIONS_METHOD:
+            self._transactions.update(result)
+        elif method.endswith('.search') and _phids_only(params):
+            index = self._by_phid.setdefault(method, {})
+            for entry in result['data']:
+                index[entry['phid']] = entry
+
+    def __getattr__(self, name):
+        return _Method(self, name)
+
+    def _lookup(self, method, params):
+        key = (method, _key(params))
+        if key in self._calls:
+            return self._calls[key]
+
+        if method == TRANSACTIONS_METHOD:
+            ids = [str(i) for i in params['ids']]
+            if all(i in self._transactions for i in ids):
+                return {i: self._transactions[i] for i in ids}
+        elif method in self._by_phid and _phids_only(params):
+            index = self._by_phid[method]
+            phids = params['constraints']['phids']
+            if all(phid in index for phid in phids):
+                return {'data': [index[phid] for phid in phids],
+                        'cursor': {'after': None}}
+        return None
+
+    def call(self, method, params):
+        response = self._lookup(method, params)
+        if response is not None:
+            return phabricator.Result(response)
+
+        print("%s is not in the snapshot, asking Phabricator" % method)
+        return functools.reduce(getattr, method.split('.'),
+                                self._live())(**params)
@@ -1,10 +1,18 @@
 class MilestoneCache:
 
-    def __init__(self, target):
+    def __init__(self, target, milestones=None):
         self._target = target
         self._milestone_cache = {}
 
-        self._retrieve_from_gitlab()
+        if milestones is None:
+            self._retrieve_from_gitlab()
+            return
+
+        # Milestone IDs by title, as warmed by another bztogl process
+        project = self._target.get_project()
+        for title, milestone_id in milestones.items():
+            self._milestone_cache[title] = \
+                project.milestones.get(milestone_id, lazy=True)
 
     def __getitem__(self, label):
         milestone = self._milestone_cache.get(label)
@@ -1,21 +1,37 @@
 import argparse
 import base64
+import concurrent.futures
 import datetime
+import itertools
 import json
 import os
 import re
 import sys
+import threading
 import time
 
 import phabricator
 
+from . import archive
 from . import bt
+from . import buffers
+from . import conduit
 from . import template
 from . import users
 from . import common
 
 ON_WINDOWS = os.name == 'nt'
 
+# Downloaded files larger than this are decoded to a temporary file
+# Must be a multiple of 4 to decode base64 piecewise
+BASE64_CHUNK = 4 * 256 * 1024
+
+# Tasks whose transactions are fetched by a single Conduit call
+TRANSACTION_BATCH = 100
+# Attempts at fetching a batch of transactions, and seconds between them
+TRANSACTION_ATTEMPTS = 3
+TRANSACTION_RETRY_DELAY = 5
+
 MIGR_TEMPLATE = """# GitLab Migration Automatic Message
 
 This bug has been migrated to freedesltop.org's GitLab instance and has been closed \
@@ -58,14 +74,73 @@ class Colors:
         cls.ENDC = '\033[0m'
 
 
+def first_reviewer(revision):
+    """Returns the PHID of the first reviewer of @revision, or None"""
+    # Conduit returns an empty PHID-keyed map as []
+    reviewers = revision["reviewers"]
+    if not reviewers or not isinstance(reviewers, dict):
+        return None
+    return next(iter(reviewers.values()))
+
+
 class PhabGitLab(common.GitLab):
     """GitLab pabricator importer"""
 
     def __init__(self, glurl, giturl, token, product, target_project=None,
-                 automate=False, close_tasks=False):
+                 automate=False, close_tasks=False, import_jobs=1,
+                 journal_dir=None, users_directory=None):
         super().__init__(glurl, giturl, token, product, target_project,
-                         automate)
+                         automate, users_directory)
         self.close_tasks = close_tasks
+        self.import_jobs = import_jobs
+        self.journal_dir = journal_dir
+
+    def _journal_path(self, kind):
+        return os.path.join(self.journal_dir, "%s.%s.journal" % (
+            self.target_project.replace("/", "_"), kind))
+
+    def journal(self, kind):
+        """Returns the journal of the @kind items already imported into the
+        target project"""
+        if not self.journal_dir:
+            return common.Journal(None)
+        return common.Journal(self._journal_path(kind))
+
+    def remove_project(self, project):
+        super().remove_project(project)
+        # The items journaled so far went away with the project
+        if not self.journal_dir:
+            return
+        for kind in ('tasks', 'revisions'):
+            try:
+                os.remove(self._journal_path(kind))
+            except FileNotFoundError:
+                pass
+
+    def provision_users(self, nicknames):
+        super().provision_users(nicknames, self.import_jobs)
+
+    def run_jobs(self, function, items, kind):
+        """Calls @function on every (id, item) of @items, from
+        self.import_jobs threads"""
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(self.import_jobs) as pool:
+            futures = [(item[0], pool.submit(function, item))
+                       for item in items]
+            for _id, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(Colors.FAIL + "Failed to import %s %s: %s" %
+                          (kind, _id, e) + Colors.ENDC)
+                    failed.append(_id)
+
+        if failed:
+            print("%d %ss failed to import: %s" % (
+                len(failed), kind, ", ".join(str(i) for i in failed)))
+            if self.journal_dir:
+                print("Imported %ss are journaled, run again to retry" %
+                      kind)
 
     def import_tasks_from_phab(self, phab, start_at):
         """Imports project tasks from phabricator"""
@@ -75,111 +150,103 @@ class PhabGitLab(common.GitLab):
         else:
             projname = self.project
 
-        for _id, task in phab.tasks.items():
-            if start_at and _id < start_at:
-                continue
-
-            description = \
-                template.render_issue_description(
-                    None, task, phab.escape_markdown(
-                        task["description"]), phab.users,
-                    task['uri'],
-                    bug_url_function=phab.task_url)
-
-            labels = ['phabricator']
-            milestone = None
-            for project in task.projects.values():
-                if project['fields']['milestone']:
-                    if project['fields']['parent']['phid'] in phab.used_projects:
-                        milestone = project['fields']["name"]
-                elif project['fields']["name"] != projname:
-                    labels.append(project['fields']["name"])
-
-            labels.append(task['priority'])
-
-            if not task["title"]:
-                print("WARNING task %s doesn't have a title!" % _id)
-                continue
-            creation_time = datetime.datetime.fromtimestamp(
-                int(task["dateCreated"])
-                ).strftime('%Y-%m-%d %H:%M:%S')
-
-            # Assign bug to actual account if exists
-            phabauthor = phab.users.get(task["authorPHID"])
-            if phabauthor:
-                author = self.find_user_by_nick(phabauthor.username)
-                if not author:
-                    try:
-                        author = self.create_user(phabauthor.username)
-                    except:
-                        pass
-                author = phabauthor.username
-            else:
-                author = None
-
-            phabowner = phab.users.get(task["ownerPHID"])
-            if phabowner:
-                assignee = self.find_user_by_nick(phabowner.username)
-                if not assignee:
-                    try:
-                        assignee = self.create_user(phabowner.username)
-                    except:
-                        pass
+        journal = self.journal('tasks')
+        tasks = [(_id, task) for _id, task in phab.tasks.items()
+                 if not (start_at and _id < start_at) and _id not in journal]
+
+        self.provision_users(
+            phab.users[phid].username for _id, task in tasks
+            for phid in (task["authorPHID"], task["ownerPHID"])
+            if phid in phab.users)
+
+        def import_task(item):
+            _id, task = item
+            self.import_task(phab, projname, _id, task)
+            journal.add(_id)
+
+        self.run_jobs(import_task, tasks, "task")
+
+    def import_task(self, phab, projname, _id, task):
+        description = \
+            template.render_issue_description(
+                None, task, phab.escape_markdown(
+                    task["description"]), phab.users,
+                task['uri'],
+                bug_url_function=phab.task_url)
+
+        labels = ['phabricator']
+        milestone = None
+        for project in task.projects.values():
+            if project['fields']['milestone']:
+                if project['fields']['parent']['phid'] in phab.used_projects:
+                    milestone = project['fields']["name"]
+            elif project['fields']["name"] != projname:
+                labels.append(project['fields']["name"])
+
+        labels.append(task['priority'])
+
+        if not task["title"]:
+            print("WARNING task %s doesn't have a title!" % _id)
+            return
+        creation_time = datetime.datetime.fromtimestamp(
+            int(task["dateCreated"])
+            ).strftime('%Y-%m-%d %H:%M:%S')
+
+        # Assign bug to actual account if exists
+        phabowner = phab.users.get(task["ownerPHID"])
+        assignee_id = None
+        if phabowner:
+            assignee = self.find_user_by_nick(phabowner.username)
+            if assignee:
+                assignee_id = assignee.id
+
+        issue = self.create_issue(_id, task["title"],
+                                  description, labels,
+                                  milestone,
+                                  creation_time,
+                                  assignee_id=assignee_id)
+
+        print("Created %s - %s: %s" %
+              (_id, issue.get_id(), issue.attributes['title']))
+
+        for comment in task.comments:
+            sudo = None
+            emoji, action, body = ('speech_balloon', 'said',
+                                   comment["comments"])
+            comment_author = comment["authorPHID"]
+            if comment_author.startswith("PHID-APPS"):
+                author = comment_author.rsplit("-")[2]
             else:
-                assignee = None
+                author = phab.users[comment_author].display_name()
+                if phabowner:
+                    sudo = self.find_user_by_nick(phab.users[comment_author].username)
+                    if sudo:
+                        sudo = sudo.id
+            assignee = None
+            gitlab_comment = template.render_comment(
+                None, emoji, author,
+                action, phab.escape_markdown(body),
+                "", bug_url_function=phab.task_url)
+
+            issue.notes.create({
+                'body': gitlab_comment,
+                'created_at': datetime.datetime.fromtimestamp(
+                    int(task["dateCreated"])
+                ).strftime('%Y-%m-%d %H:%M:%S')
+            })#, sudo=sudo)
 
-            issue = self.create_issue(_id, task["title"],
-                                      description, labels,
-                                      milestone,
-                                      creation_time#, sudo=author
-            )
+        state_event = 'reopen'
+        if task.resolved:
+            state_event = "close"
+        self.finish_issue(issue, state_event)
 
-            if assignee:
-                issue.assignee_id = assignee.id
-
-            print("Created %s - %s: %s" %
-                  (_id, issue.get_id(), issue.attributes['title']))
-
-            for comment in task.comments:
-                sudo = None
-                emoji, action, body = ('speech_balloon', 'said',
-                                       comment["comments"])
-                comment_author = comment["authorPHID"]
-                if comment_author.startswith("PHID-APPS"):
-                    author = comment_author.rsplit("-")[2]
-                else:
-                    author = phab.users[comment_author].display_name()
-                    if phabowner:
-                        sudo = self.find_user_by_nick(phab.users[comment_author].username)
-                        if sudo:
-                            sudo = sudo.id
-                assignee = None
-                gitlab_comment = template.render_comment(
-                    None, emoji, author,
-                    action, phab.escape_markdown(body),
-                    "", bug_url_function=phab.task_url)
-
-                issue.notes.create({
-                    'body': gitlab_comment,
-                    'created_at': datetime.datetime.fromtimestamp(
-                        int(task["dateCreated"])
-                    ).strftime('%Y-%m-%d %H:%M:%S')
-                })#, sudo=sudo)
-
-            state_event = 'reopen'
-            if task.resolved:
-                state_event = "close"
-            issue.state_event = state_event
-
-            issue.save(state_event=state_event)
-
-            if self.close_tasks:
-                phab.phabricator.maniphest.edit(
-                    objectIdentifier=str(_id),
-                    transactions=[{
-                        "type": "comment",
-                        "value": MIGR_TEMPLATE.format(issue.web_url)}])
-                phab.phabricator.maniphest.update(id=_id, status='resolved')
+        if self.close_tasks:
+            phab.phabricator.maniphest.edit(
+                objectIdentifier=str(_id),
+                transactions=[{
+                    "type": "comment",
+                    "value": MIGR_TEMPLATE.format(issue.web_url)}])
+            phab.phabricator.maniphest.update(id=_id, status='resolved')
 
     def import_revisions_from_phab(self, phab, start_at):
         """Imports project patches from phabricator"""
@@ -189,92 +256,97 @@ class PhabGitLab(common.GitLab):
         else:
             projname = self.project
 
-        for _id, revision in phab.revisions.items():
-            if start_at and _id < start_at:
-                continue
-
-            description = \
-                template.render_issue_description(
-                    None, revision, phab.escape_markdown(
-                        revision["summary"]), phab.users,
-                    revision['uri'],
-                    bug_url_function=phab.diff_url)
-
-            labels = ['phabricator']
-            milestone = None
-            for project in revision.projects.values():
-                if project['fields']['milestone']:
-                    if project['fields']['parent']['phid'] in phab.used_projects:
-                        milestone = project['fields']["name"]
-                elif project['fields']["name"] != projname:
-                    labels.append(project['fields']["name"])
-
-            if not revision["title"]:
-                print("WARNING revision %s doesn't have a title!" % _id)
-                continue
-            print("Creating revision %s: %s" % (revision['id'], revision['title']))
-
-            # Assign bug to actual account if exists
-            phabauthor = phab.users.get(revision["authorPHID"])
-            if phabauthor:
-                author = self.find_user_by_nick(phabauthor.username)
-                if not author:
-                    try:
-                        author = self.create_user(phabauthor.username)
-                    except:
-                        pass
-                author = phabauthor.username
-            else:
-                author = None
+        journal = self.journal('revisions')
+        revisions = [(_id, revision)
+                     for _id, revision in phab.revisions.items()
+                     if not (start_at and _id < start_at) and
+                     _id not in journal]
+
+        self.provision_users(
+            phab.users[phid].username for _id, revision in revisions
+            for phid in (revision["authorPHID"], first_reviewer(revision))
+            if phid in phab.users)
+
+        # Look up the commits of every merged revision at once
+        commitphids = sorted(set(revision['commits'][0]
+                                 for _id, revision in revisions
+                                 if revision.merged and revision['commits']))
+        commits = {}
+        for i in range(0, len(commitphids), 500):
+            commits.update(phab.phabricator.phid.query(
+                phids=commitphids[i:i + 500]))
+
+        # The steps of one merge request run in order in a single job, while
+        # different merge requests are imported in parallel
+        def import_revision(item):
+            _id, revision = item
+            self.import_revision(phab, projname, commits, _id, revision)
+            journal.add(_id)
+
+        self.run_jobs(import_revision, revisions, "revision")
+
+    def import_revision(self, phab, projname, commits, _id, revision):
+        description = \
+            template.render_issue_description(
+                None, revision, phab.escape_markdown(
+                    revision["summary"]), phab.users,
+                revision['uri'],
+                bug_url_function=phab.diff_url)
+
+        labels = ['phabricator']
+        milestone = None
+        for project in revision.projects.values():
+            if project['fields']['milestone']:
+                if project['fields']['parent']['phid'] in phab.used_projects:
+                    milestone = project['fields']["name"]
+            elif project['fields']["name"] != projname:
+                labels.append(project['fields']["name"])
+
+        if not revision["title"]:
+            print("WARNING revision %s doesn't have a title!" % _id)
+            return
+        print("Creating revision %s: %s" % (revision['id'], revision['title']))
 
-            assignee = None
-            phabowners = revision["reviewers"]
-            if phabowners:
-                phabowner = phab.users.get(list(phabowners.values())[0])
-                if phabowner:
-                    assignee = self.find_user_by_nick(phabowner.username)
-                    if not assignee:
-                        try:
-                            assignee = self.create_user(phabowner.username)
-                        except:
-                            pass
-            if not assignee:
-                assignee = None
-
-            if revision.diff != "":
-                desc = description + "\n```\n" + revision.diff + "\n```"
-            else:
-                desc = description
-            mergerequest = self.create_mergerequest(_id, revision["title"],
-                                      desc, labels,
-                                      milestone#, sudo=author
-            )
+        # Assign bug to actual account if exists
+        assignee = None
+        phabowner = phab.users.get(first_reviewer(revision))
+        if phabowner:
+            assignee = self.find_user_by_nick(phabowner.username)
 
-            if assignee:
-                mergerequest.assignee_id = assignee.id
-
-            print("Created %s - %s: %s" %
-                  (_id, mergerequest.get_id(), mergerequest.attributes['title']))
-
-            state_event = 'reopen'
-            if revision.merged:
-                # mergerequest.merge()
-                if revision['commits']:
-                    commits = phab.phabricator.phid.query(phids=revision['commits'])
-                    commit = list(commits.values())[0]
-                    info = commit['fullName']
-                    for callsign in phab.callsigns:
-                        msg = info.replace('r' + callsign, '', 1)
-                        if msg != info:
-                            mergerequest.notes.create({
-                                'body': msg,
-                            })
-                state_event = "close"
-            elif revision.abandoned:
-                state_event = "close"
-            mergerequest.state_event = state_event
-
-            mergerequest.save(state_event=state_event)
+        if revision.diff != "":
+            desc = description + "\n```\n" + revision.diff + "\n```"
+        else:
+            desc = description
+        mergerequest = self.create_mergerequest(_id, revision["title"],
+                                                desc, labels, milestone)
+
+        if assignee:
+            mergerequest.assignee_id = assignee.id
+
+        print("Created %s - %s: %s" %
+              (_id, mergerequest.get_id(), mergerequest.attributes['title']))
+
+        state_event = 'reopen'
+        if revision.merged:
+            # mergerequest.merge()
+            # Deleted or unreadable commits are not returned by phid.query
+            commit = None
+            if revision['commits']:
+                commit = commits.get(revision['commits'][0])
+            if commit:
+                info = commit['fullName']
+                for callsign in phab.callsigns:
+                    msg = info.replace('r' + callsign, '', 1)
+                    if msg != info:
+                        mergerequest.notes.create({
+                            'body': msg,
+                        })
+            state_event = "close"
+        elif revision.abandoned:
+            state_event = "close"
+        mergerequest.state_event = state_event
+
+        mergerequest.save(state_event=state_event)
 
 
 class Task:
@@ -330,6 +402,49 @@ class Task:
     def __getitem__(self, key):
         return self.entry[key]
 
+
+class DiffFetcher:
+    """Downloads raw diffs in the background, keeping them on disk by diff
+    ID when a cache directory is given"""
+
+    def __init__(self, phab, jobs, cache_dir=None):
+        self.phab = phab
+        self.cache_dir = cache_dir
+        self._executor = concurrent.futures.ThreadPoolExecutor(jobs)
+        self._futures = {}
+
+    def _cache_path(self, diffid):
+        return os.path.join(self.cache_dir, "diffs", "%s.diff" % diffid)
+
+    def _fetch(self, diffid):
+        if self.cache_dir:
+            try:
+                with open(self._cache_path(diffid), encoding='utf-8') as f:
+                    return f.read()
+            except FileNotFoundError:
+                pass
+
+        diff = self.phab.phabricator.differential.getrawdiff(
+            diffID=str(diffid)).response
+
+        if self.cache_dir:
+            path = self._cache_path(diffid)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(diff)
+            os.replace(path + '.tmp', path)
+        return diff
+
+    def fetch(self, diffid):
+        """Returns a future for the raw diff @diffid"""
+        if diffid not in self._futures:
+            self._futures[diffid] = self._executor.submit(self._fetch, diffid)
+        return self._futures[diffid]
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
 class Revision:
     def __init__(self, entry, all_projects, all_revisions, diff):
         self.entry = entry
@@ -341,7 +456,11 @@ class Revision:
             if phid in all_revisions:
                 self.depends_on.append(all_revisions[phid]["id"])
 
-        self.diff = diff
+        self._diff = diff
+
+    @property
+    def diff(self):
+        return self._diff.result()
 
     @property
     def assigned_to(self):
@@ -390,13 +509,24 @@ class Revision:
         return self.entry[key]
 
 
+class PhabArchiveTarget(archive.ArchiveTarget, PhabGitLab):
+    """PhabGitLab writing the tasks to a project export archive"""
+
+    def journal(self, kind):
+        # An archive is written in one go, nothing of it is in GitLab yet
+        return common.Journal(None)
+
+
 class Phab:
 
     FILES_REGEX = re.compile(r'\{F[0-9\(\)]+\}', re.MULTILINE)
 
     def __init__(self, options, gitlab):
         self._phabricator = None
+        self._conduit = None
         self.arcrc = None
+        self.snapshot = options.snapshot
+        self.export_snapshot = options.export_snapshot
         self.phabricator_uri = "https://phab.enlightenment.org/"
         self.projects = options.projects
         self.callsigns = options.callsigns
@@ -406,21 +536,71 @@ class Phab:
         self.rev_start_at = options.rev_start_at
         if not self.rev_start_at:
             self.rev_start_at = 1
+        self.page_size = options.page_size
+        self.fetch_jobs = options.fetch_jobs
+        self.transaction_batch = options.transaction_batch
+        # Snapshots must record every diff, so they don't use the cache
+        self.diffs = DiffFetcher(
+            self, options.fetch_jobs,
+            None if self.export_snapshot else options.cache_dir)
 
         self.users = {}
+        self.unknown_users = set()
+        # File ID -> future of its GitLab upload markdown
+        self.migrated_files = {}
+        self._files_lock = threading.Lock()
+        self._files_executor = concurrent.futures.ThreadPoolExecutor(
+            options.fetch_jobs)
         self.gitlab = gitlab
         self.ensure_project_phids()
-        self.retrieve_all_tasks()
-        self.retrieve_all_revisions()
+        task_pages = self.fetch_all_tasks()
+        revision_pages = self.fetch_all_revisions()
+        # The projects of every page are resolved at once, before any of
+        # the pages is evaluated
+        self.resolve_projects(itertools.chain(
+            (phid for page in task_pages for task in page
+             for phid in task['projectPHIDs']),
+            (phid for page in revision_pages for rev in page
+             for phid in rev['auxiliary']['phabricator:projects'])))
+        self.retrieve_all_tasks(*self.evaluate_pages(task_pages,
+                                                     self.evaluate_tasks))
+        self.retrieve_all_revisions(
+            *self.evaluate_pages(revision_pages, self.evaluate_revisions))
 
     def migrate_attachment(self, fileid):
         finfo = self.phabricator.file.info(id=int(fileid))
-        attfile = self.phabricator.file.download(phid=finfo["phid"])
-        ret = self.gitlab.upload_file(
-            finfo["name"], base64.b64decode(attfile.response))
+
+        # While decoding, the whole base64 download and the decoded data up
+        # to the spill size are both in memory
+        size = int(finfo.get("byteSize") or 0)
+        with buffers.BUDGET.reserve(-(-size * 4 // 3) +
+                                    min(size, buffers.SPILL_SIZE)):
+            data = self.phabricator.file.download(
+                phid=finfo["phid"]).response
+
+            # Decode piecewise so that large files end up on disk rather
+            # than in a second full copy in memory
+            with buffers.spill_buffer() as f:
+                for i in range(0, len(data), BASE64_CHUNK):
+                    f.write(base64.b64decode(data[i:i + BASE64_CHUNK]))
+                del data
+                f.seek(0)
+                ret = self.gitlab.upload_file(finfo["name"], f)
 
         return ret['markdown']
 
+    def migrate_attachments(self, fileids):
+        """Starts migrating the files in @fileids which haven't been yet,
+        returns the futures of their markdown"""
+        futures = {}
+        with self._files_lock:
+            for fileid in fileids:
+                if fileid not in self.migrated_files:
+                    self.migrated_files[fileid] = self._files_executor.submit(
+                        self.migrate_attachment, fileid)
+                futures[fileid] = self.migrated_files[fileid]
+        return futures
+
     def escape_markdown(self, markdown):
         markdown = bt.quote_stack_traces(markdown)
 
@@ -428,14 +608,19 @@ class Phab:
         markdown = re.sub(re.compile(
             r'```\n```\n', re.MULTILINE), '\n```\n', markdown)
 
-        for filelink in re.findall(Phab.FILES_REGEX, markdown):
-            fileid = filelink.strip("{F").strip("}")
+        filelinks = set(re.findall(Phab.FILES_REGEX, markdown))
+        futures = self.migrate_attachments(
+            set(filelink.strip("{F").strip("}") for filelink in filelinks))
+        uploads = {}
+        for filelink in filelinks:
             try:
-                markdown = markdown.replace(
-                        filelink, self.migrate_attachment(fileid))
+                uploads[filelink] = \
+                    futures[filelink.strip("{F").strip("}")].result()
             except phabricator.APIError:
                 print("WARNING: Could not migrate file: %s" % filelink)
-                pass
+        if uploads:
+            markdown = Phab.FILES_REGEX.sub(
+                lambda m: uploads.get(m.group(0), m.group(0)), markdown)
 
         # Prevent spurious links to other GitLab issues
         markdown = re.sub(r'([Cc]omment) #([0-9]+)', '\\1 \\2', markdown)
@@ -481,9 +666,27 @@ class Phab:
     def diff_url(self, garbage, task_id):
         return os.path.join(self.phabricator_uri, "D" + task_id)
 
-    def retrieve_all_comments(self, ids, users):
-        all_transactions = self.phabricator.maniphest.gettasktransactions(
-            ids=ids)
+    def fetch_transactions(self, ids):
+        """Returns the transactions of the tasks @ids, trying again if
+        Phabricator fails to answer"""
+        for attempt in range(1, TRANSACTION_ATTEMPTS + 1):
+            try:
+                return self.phabricator.maniphest.gettasktransactions(
+                    ids=ids)
+            except Exception as e:
+                if attempt == TRANSACTION_ATTEMPTS:
+                    raise
+                print("WARNING: Could not fetch the transactions of tasks "
+                      "%d to %d (%s), retrying" % (ids[0], ids[-1], e))
+                time.sleep(TRANSACTION_RETRY_DELAY * attempt)
+
+    def attach_transactions(self, all_transactions):
+        """Adds the comments among @all_transactions to their tasks"""
+        # Commenters are not necessarily among the users of the tasks
+        self.retrieve_all_users(
+            transaction["authorPHID"]
+            for transactions in all_transactions.values()
+            for transaction in transactions)
         for tid, transactions in all_transactions.items():
             for transaction in sorted(transactions,
                                       key=lambda x: x['dateCreated']):
@@ -497,49 +700,143 @@ class Phab:
                     self.tasks[int(tid)].entry.setdefault(
                         "comments", []).append(transaction)
 
+    def retrieve_all_comments(self, ids, users):
+        """Fetches the transactions of the tasks @ids in batches, --fetch-jobs
+        at a time, and attaches each batch as soon as it arrives"""
+        batches = [ids[i:i + self.transaction_batch]
+                   for i in range(0, len(ids), self.transaction_batch)]
+        with concurrent.futures.ThreadPoolExecutor(
+                self.fetch_jobs) as executor:
+            futures = [executor.submit(self.fetch_transactions, batch)
+                       for batch in batches]
+            for future in concurrent.futures.as_completed(futures):
+                self.attach_transactions(future.result())
+
+    def query_pages(self, method, **params):
+        """Yields the entries returned by a Conduit *.query @method one
+        page at a time"""
+        offset = 0
+        while True:
+            page = method(limit=self.page_size, offset=offset,
+                          **params).response
+            # Results keyed by PHID come back as [] when empty
+            if isinstance(page, dict):
+                page = list(page.values())
+            if page:
+                yield page
+            if len(page) < self.page_size:
+                return
+            offset += self.page_size
+
+    def search(self, method, **params):
+        """Yields every entry returned by a Conduit *.search @method,
+        following the result cursor"""
+        after = None
+        while True:
+            if after:
+                params['after'] = after
+            result = method(limit=min(self.page_size, 100), **params)
+            for entry in result.data:
+                yield entry
+            after = result.cursor['after']
+            if not after:
+                return
+
     def retrieve_all_users(self, usersphids):
-        all_users = self.phabricator.user.query(limit=99999999)
-        for user in all_users:
-            user = users.User(email=user["phid"],
-                              real_name=user["realName"],
-                              username=user["userName"], id=None)
-            self.users[user.email] = user
-
-    def retrieve_all_tasks(self):
-        ids = []
+        """Looks up the users in @usersphids which haven't been seen yet"""
+        phids = sorted(set(phid for phid in usersphids
+                           if phid and phid.startswith('PHID-USER-') and
+                           phid not in self.users and
+                           phid not in self.unknown_users))
+        for i in range(0, len(phids), 100):
+            batch = phids[i:i + 100]
+            for user in self.search(self.phabricator.user.search,
+                                    constraints={'phids': batch}):
+                user = users.User(email=user["phid"],
+                                  real_name=user["fields"]["realName"],
+                                  username=user["fields"]["username"],
+                                  id=None)
+                self.users[user.email] = user
+            self.unknown_users.update(phid for phid in batch
+                                      if phid not in self.users)
+
+    def resolve_projects(self, projphids):
+        """Looks up the projects in @projphids which aren't known yet"""
+        phids = sorted(set(projphids) - set(self.all_projects))
+        for i in range(0, len(phids), 100):
+            for project in self.search(
+                    self.phabricator.project.search,
+                    constraints={'phids': phids[i:i + 100]}):
+                print("Adding additional project: %s" %
+                      project['fields']['name'])
+                self.all_projects[project['phid']] = project
+
+    def find_existing(self, items, find):
+        """Returns the IDs of the tasks or revisions in @items which were
+        already imported, looked up all together with @find"""
+        if not self.gitlab:
+            return set()
+        keys = {}
+        for item in items:
+            keys[item['id']] = (item['title'],
+                                datetime.datetime.fromtimestamp(
+                                    int(item["dateCreated"])
+                                ).strftime('%Y-%m-%d %H:%M:%S'))
+        found = find(sorted(set(keys.values())))
+        return set(id for id, key in keys.items() if found[key])
+
+    def evaluate_task(self, task, existing=()):
+        print("Evaluating task %s: %s" % (task['id'], task['title']))
+        if task['id'] in existing:
+            print("Task already exists: %s" % task["title"])
+            return False
+        for projphid in task['projectPHIDs']:
+            if self.all_projects[projphid]['fields']['name'] == 'Spam':
+                return False
+        return True
 
-        self.tasks = {}
-        users = set()
-        all_tasks = {}
+    def evaluate_pages(self, pages, evaluate):
+        """Evaluates the @pages of tasks or revisions one at a time with
+        @evaluate. Returns every item by PHID, which the dependencies are
+        resolved from, and the items to import."""
+        all_items = {}
+        evaluated = []
+        for page in pages:
+            for item in page:
+                all_items[item['phid']] = item
+            evaluated.extend(evaluate(page))
+        return all_items, evaluated
+
+    def evaluate_tasks(self, tasks):
+        """Returns the @tasks to import"""
+        existing = self.find_existing(
+            tasks, self.gitlab and self.gitlab.find_issues)
+        return [task for task in tasks if self.evaluate_task(task, existing)]
+
+    def fetch_all_tasks(self):
+        """Fetches the tasks of the projects page by page. Returns the
+        pages, without the tasks already seen on an earlier one."""
+        seen = set()
+        pages = []
         for phid in self.project_phids:
             phidlist = []
             phidlist.append(phid)
             print("fetching tasks for %s (%s)" % (self.all_projects[phid]['fields']['slug'], phidlist))
-            cur_tasks = self.phabricator.maniphest.query(limit=9999999999, order='created', projectPHIDs=phidlist)
-            all_tasks = {**all_tasks, **cur_tasks}
-        for task in sorted(all_tasks.items(), key=lambda t: int(t[1]['id'])):
-            print("Evaluating task %s: %s" % (task[1]['id'], task[1]['title']))
-            creation_time = datetime.datetime.fromtimestamp(
-                int(task[1]["dateCreated"])
-                ).strftime('%Y-%m-%d %H:%M:%S')
+            for page in self.query_pages(self.phabricator.maniphest.query,
+                                         order='created',
+                                         projectPHIDs=phidlist):
+                # Tasks may be tagged with several of our projects
+                page = [task for task in page if task['phid'] not in seen]
+                seen.update(task['phid'] for task in page)
+                pages.append(page)
+        return pages
+
+    def retrieve_all_tasks(self, all_tasks, evaluated):
+        ids = []
 
-            if self.gitlab.find_issue(task[1]["title"], creation_time):
-                print("Task already exists: %s" % task[1]["title"])
-                continue
-            skip = False
-            for projphid in task[1]['projectPHIDs']:
-                if not projphid in self.all_projects:
-                    projphidlist = []
-                    projphidlist.append(projphid)
-                    projects = self.phabricator.project.search(limit=100, constraints=({'phids': projphidlist}))
-                    self.all_projects[projphid] = projects.data[0]
-                    if projects.data[0]['fields']['name'] == 'Spam':
-                        skip = True
-                        break
-                    print("Adding additional project: %s" % (projects.data[0]['fields']['name']))
-            if skip:
-                continue
-            task = task[1]
+        self.tasks = {}
+        users = set()
+        for task in sorted(evaluated, key=lambda t: int(t['id'])):
             id = int(task["id"])
             if self.start_at and id >= self.start_at:
                 ids.append(id)
@@ -548,58 +845,63 @@ class Phab:
             users.update(task["ccPHIDs"])
             users.add(task["ownerPHID"])
 
-
         self.retrieve_all_users(users)
         self.retrieve_all_comments(ids, users)
 
-    def retrieve_all_revisions(self):
+    def evaluate_revision(self, rev, existing=()):
+        print("Evaluating revision %s: %s" % (rev['id'], rev['title']), end='')
+        if rev['id'] in existing:
+            print(" || Rev already exists--skipping")
+            return False
 
+        print(" || Rev doesn't exist--creating")
+        return True
+
+    def evaluate_revisions(self, revisions):
+        """Returns the @revisions to import, and starts downloading their
+        diffs"""
+        candidates = [rev for rev in revisions
+                      if not (self.rev_start_at and
+                              int(rev["id"]) < self.rev_start_at)]
+        existing = self.find_existing(
+            candidates, self.gitlab and self.gitlab.find_patches)
+        evaluated = []
+        for rev in candidates:
+            if self.evaluate_revision(rev, existing):
+                # Only the diffs of revisions to import are downloaded
+                self.diffs.fetch(int(rev['diffs'][0]))
+                evaluated.append(rev)
+        return evaluated
+
+    def fetch_all_revisions(self):
+        """Fetches the revisions page by page. Returns the pages."""
+        return list(self.query_pages(self.phabricator.differential.query,
+                                     order='created',
+                                     paths=list(zip(self.callsigns, [""]))))
+
+    def retrieve_all_revisions(self, all_revisions, evaluated):
         users = set()
         self.revisions = {}
-        revs = {}
-        all_revisions = self.phabricator.differential.query(limit=9999999999, order='created', paths=list(zip(self.callsigns, [""])))
-        for rev in all_revisions:
-            revs[rev['id']] = rev
-        for rev in sorted(all_revisions, key=lambda t: int(t['id'])):
+        for rev in sorted(evaluated, key=lambda t: int(t['id'])):
             id = int(rev["id"])
-            if self.rev_start_at and id < self.rev_start_at:
-                continue
-            print("Evaluating revision %s: %s" % (rev['id'], rev['title']), end='')
-            creation_time = datetime.datetime.fromtimestamp(
-                int(rev["dateCreated"])
-                ).strftime('%Y-%m-%d %H:%M:%S')
-
-            if self.gitlab.find_patch(rev["title"], creation_time):
-                print(" || Rev already exists--skipping")
-                continue
-
-            for projphid in rev["auxiliary"]['phabricator:projects']:
-                if not projphid in self.all_projects:
-                    projphidlist = []
-                    projphidlist.append(projphid)
-                    projects = self.phabricator.project.search(limit=100, constraints=({'phids': projphidlist}))
-                    print("Adding additional project: %s" % (projects.data[0]['fields']['name']))
-                    self.all_projects[projphid] = projects.data[0]
-
-            diffid = int(rev['diffs'][0])
-            diff = self.phabricator.differential.getrawdiff(diffID=str(diffid))
-            self.revisions[id] = Revision(rev, self.all_projects, revs, diff.response)
+            diff = self.diffs.fetch(int(rev['diffs'][0]))
+            self.revisions[id] = Revision(rev, self.all_projects,
+                                          all_revisions, diff)
             users.add(rev["authorPHID"])
             users.update(rev["ccs"])
             users.update(rev["reviewers"])
-            print(" || Rev doesn't exist--creating")
 
         self.retrieve_all_users(users)
 
     def ensure_project_phids(self):
         if len(self.projects) == 1:
-          projects = self.phabricator.project.search(limit=100, constraints=({'isMilestone': False, 'name': self.projects[0]}))
+          projects = self.search(self.phabricator.project.search, constraints=({'isMilestone': False, 'name': self.projects[0]}))
         else:
-          projects = self.phabricator.project.search(limit=100, constraints=({'isMilestone': False}))
+          projects = self.search(self.phabricator.project.search, constraints=({'isMilestone': False}))
         self.all_projects = {}
         self.project_phids = []
         # add base project phids
-        for project in projects.data:
+        for project in projects:
             if project['fields']["color"]['key'] != "disabled" and \
                  project['phid'] not in self.project_phids and \
                  (project['fields']['slug'] in self.projects or project['fields']['name'] in self.projects):
@@ -607,8 +909,8 @@ class Phab:
               self.project_phids.append(project['phid'])
               self.all_projects[project['phid']] = project
         try:
-            subprojects = self.phabricator.project.search(limit=100, constraints=({'isMilestone': False, 'ancestors': self.project_phids}))
-            for subproject in subprojects.data:
+            subprojects = self.search(self.phabricator.project.search, constraints=({'isMilestone': False, 'ancestors': self.project_phids}))
+            for subproject in subprojects:
                if subproject['fields']["color"]['key'] != "disabled" and subproject['phid'] not in self.project_phids:
                   print("Adding %s" % (subproject['fields']['slug']))
                   self.project_phids.append(subproject['phid'])
@@ -669,6 +971,22 @@ Paste API Token from that page and press <enter>: """ % self.phabricator_uri)
 
     @property
     def phabricator(self):
+        if self._conduit:
+            return self._conduit
+
+        if self.snapshot:
+            print("Reading Phabricator snapshot from %s" % self.snapshot)
+            self._conduit = conduit.SnapshotConduit(
+                self.snapshot, lambda: self.live_phabricator)
+        elif self.export_snapshot:
+            self._conduit = conduit.RecordingConduit(self.live_phabricator,
+                                                     self.export_snapshot)
+        else:
+            self._conduit = self.live_phabricator
+        return self._conduit
+
+    @property
+    def live_phabricator(self):
         if self._phabricator:
             return self._phabricator
 
@@ -684,7 +1002,8 @@ Paste API Token from that page and press <enter>: """ % self.phabricator_uri)
             host = self.phabricator_uri + "/api/"
             self._phabricator = phabricator.Phabricator(timeout=120, host=host)
 
-            if not self.phabricator.token and not self.phabricator.certificate:
+            if not self._phabricator.token and \
+                    not self._phabricator.certificate:
                 needs_credential = True
 
             # FIXME, workaround
@@ -722,7 +1041,7 @@ def options():
     parser.add_argument('--automate', action='store_true',
                         help="don't wait on user input and answer \'Y\' (yes) \
                               to any question")
-    parser.add_argument('--token', help="gitlab token API", required=True)
+    parser.add_argument('--token', help="gitlab token API")
     parser.add_argument(
         '--close-tasks', help="Close phabricator tasks", action='store_true')
     parser.add_argument('--project', help="phab project name", dest="projects",
@@ -739,7 +1058,54 @@ def options():
     parser.add_argument('--rev-start-at',
                         help="The ID of the first revision to import",
                         type=int)
-    return parser.parse_args()
+    parser.add_argument('--page-size', type=int, default=100,
+                        help="number of entries requested per Conduit query \
+                              (*.search queries are capped at 100)")
+    parser.add_argument('--fetch-jobs', type=int, default=8,
+                        help="number of parallel downloads from Phabricator")
+    parser.add_argument('--transaction-batch', type=int,
+                        default=TRANSACTION_BATCH, metavar="TASKS",
+                        help="number of tasks whose comments are fetched \
+                              by a single request")
+    parser.add_argument('--cache-dir', metavar="DIR", default="phab_cache",
+                        help="directory where downloaded diffs are kept \
+                              between runs")
+    parser.add_argument('--journal', metavar="DIR",
+                        help="record the imported tasks and revisions in \
+                              DIR, and skip them when run again")
+    parser.add_argument('--import-jobs', type=int, default=1,
+                        help="number of tasks and revisions imported into \
+                              GitLab in parallel")
+    parser.add_argument('--users-directory', metavar="FILE",
+                        help="keep the list of GitLab users in FILE and \
+                              reuse it for a day")
+    parser.add_argument('--graphql', action='store_true',
+                        help="batch the lookups of GitLab users, labels and \
+                              existing issues and merge requests into \
+                              GraphQL requests")
+    parser.add_argument('--graphql-batch', type=int,
+                        default=common.GRAPHQL_BATCH, metavar="LOOKUPS",
+                        help="lookups sent in a single GraphQL request")
+    parser.add_argument('--snapshot', metavar="DIR",
+                        help="answer Conduit queries from a snapshot written \
+                              by --export-snapshot")
+    parser.add_argument('--attachment-memory', type=int, metavar="BYTES",
+                        default=buffers.MEMORY_BUDGET,
+                        help="file data held in memory at once by all the \
+                              transfers together")
+    parser.add_argument('--archive', metavar="FILE",
+                        help="write the tasks to a GitLab project export \
+                              archive to be loaded with \
+                              bztogl-import-archive, instead of creating them")
+    parser.add_argument('--export-snapshot', metavar="DIR",
+                        help="save the projects, tasks, users and revisions \
+                              to a snapshot and exit without importing")
+    args = parser.parse_args()
+    if not args.token and not args.export_snapshot:
+        parser.error("the following arguments are required: --token")
+    if args.archive and args.close_tasks:
+        parser.error("--close-tasks can't be used with --archive")
+    return args
 
 
 def check_if_target_project_exists(target):
@@ -756,18 +1122,37 @@ def check_if_target_project_exists(target):
 
 def main():
     args = options()
-
-    target = PhabGitLab("https://gitlab-prototype.s-opensource.org/",
-                        "https://git.enlightenment.org/",
-                        args.token, args.projects[0],
-                        args.target_project,
-                        args.automate, args.close_tasks)
+    buffers.BUDGET.limit = args.attachment_memory
+
+    if args.export_snapshot:
+        phab = Phab(args, None)
+        phab.diffs.close()
+        phab.phabricator.close()
+        print("Snapshot written to %s" % args.export_snapshot)
+        return
+
+    target_args = ("https://gitlab-prototype.s-opensource.org/",
+                   "https://git.enlightenment.org/",
+                   args.token, args.projects[0],
+                   args.target_project,
+                   args.automate, args.close_tasks,
+                   args.import_jobs, args.journal,
+                   args.users_directory)
+    if args.archive:
+        target = PhabArchiveTarget(archive.ArchiveWriter(args.archive),
+                                   *target_args)
+    else:
+        target = PhabGitLab(*target_args)
 
     target.connect()
-    if not args.recreate and args.target_project is not None:
+    if args.graphql and not target.dry_run:
+        target.enable_graphql(args.graphql_batch)
+    if target.dry_run:
+        print("GitLab issues will be written to " + args.archive)
+    elif not args.recreate and args.target_project is not None:
         check_if_target_project_exists(target)
 
-    if not args.target_project and args.recreate:
+    if not args.target_project and args.recreate and not target.dry_run:
         target.import_project()
 
     phab = Phab(args, target)
@@ -775,7 +1160,12 @@ def main():
     if phab.tasks:
         target.import_tasks_from_phab(phab, args.start_at)
 
-    if phab.revisions:
+    if target.dry_run:
+        if phab.revisions:
+            print("Skipping %d revisions, merge requests can't be written "
+                  "to an archive" % len(phab.revisions))
+        target.close()
+    elif phab.revisions:
         target.import_revisions_from_phab(phab, args.rev_start_at)
 
 
@@ -0,0 +1,46 @@
+import concurrent.futures
+
+# Texts shorter than this are rendered in-process, pickling them to a worker
+# process costs more than the regular expressions
+RENDER_THRESHOLD = 64 * 1024
+
+
+class RenderPool:
+    """Hands the long texts of a bug to worker processes for rendering, so
+    that the regular expressions don't hold the GIL against the threads
+    waiting on Bugzilla and GitLab. With no @jobs, everything is rendered
+    in-process."""
+
+    def __init__(self, jobs=0, threshold=RENDER_THRESHOLD):
+        self.threshold = threshold
+        self._executor = None
+        if jobs:
+            self._executor = concurrent.futures.ProcessPoolExecutor(jobs)
+
+    def render(self, function, items, *args, size=len):
+        """Returns function(@items, *@args), a list with a result per item.
+
+        The items of at least self.threshold @size are sent to a worker
+        process in a single batch, while the others are rendered here in
+        the meantime. @function must be picklable."""
+        large = []
+        if self._executor is not None:
+            large = [i for i, item in enumerate(items)
+                     if size(item) >= self.threshold]
+        if not large:
+            return function(items, *args)
+
+        future = self._executor.submit(function,
+                                       [items[i] for i in large], *args)
+        small = sorted(set(range(len(items))) - set(large))
+        results = [None] * len(items)
+        for i, result in zip(small, function([items[i] for i in small],
+                                             *args)):
+            results[i] = result
+        for i, result in zip(large, future.result()):
+            results[i] = result
+        return results
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
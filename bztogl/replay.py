@@ -0,0 +1,247 @@
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import threading
+
+import bugzilla
+
+from . import bztogl, common, spool
+
+
+class Checkpoint:
+    """Byte offset in the spool before which every issue has been replayed,
+    plus the offsets of the issues past it which are already done"""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.done = set()
+
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        self.offset = state['offset']
+        self.done = set(state['done'])
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'offset': self.offset, 'done': sorted(self.done)}, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class Replayer:
+    """Creates the issues recorded in a --dry-run spool in GitLab"""
+
+    def __init__(self, target, spool_path, bzurl=None, jobs=4):
+        self.target = target
+        self.spool_path = spool_path
+        self.blob_dir = spool_path + '.blobs'
+        self.bzurl = bzurl
+        self.jobs = jobs
+        self.uploads = {}
+        self.can_subscribe = True
+        self._bugzilla = None
+        self._uploaded = {}
+        self._lock = threading.Lock()
+
+    @property
+    def bugzilla(self):
+        with self._lock:
+            if self._bugzilla is None:
+                print("Connecting to %s" % self.bzurl)
+                self._bugzilla = bugzilla.Bugzilla(self.bzurl, tokenfile=None)
+        return self._bugzilla
+
+    def _upload(self, key):
+        record = self.uploads[key]
+        if 'blob' in record:
+            with open(os.path.join(self.blob_dir, record['blob']), 'rb') as f:
+                ret = self.target.upload_file(record['filename'], f)
+        else:
+            ret = self.target.upload_bugzilla_attachment(
+                self.bugzilla, record['attachment_id'], record['filename'])
+        return ret['markdown']
+
+    def upload(self, key):
+        """Returns the markdown of upload @key. The first caller uploads
+        it, the others wait for its result."""
+        with self._lock:
+            future = self._uploaded.get(key)
+            owner = future is None
+            if owner:
+                future = self._uploaded[key] = concurrent.futures.Future()
+        if not owner:
+            return future.result()
+
+        try:
+            future.set_result(self._upload(key))
+        except Exception as e:
+            # Leave it to the next issue needing it to try again
+            with self._lock:
+                del self._uploaded[key]
+            future.set_exception(e)
+        return future.result()
+
+    def replay_issue(self, record):
+        def resolve(text):
+            return spool.resolve_placeholders(text, self.upload)
+
+        payload = record['issue']
+        issue = self.target.create_issue(record['source_id'],
+                                         payload['title'],
+                                         resolve(payload['description']),
+                                         payload['labels'],
+                                         payload.get('milestone'),
+                                         payload['created_at'],
+                                         assignee_id=record['assignee_id'],
+                                         confidential=payload.get(
+                                             'confidential', False))
+
+        for note in record['notes']:
+            issue.notes.create(dict(note, body=resolve(note['body'])))
+
+        for username in record['subscribers']:
+            if not self.can_subscribe:
+                break
+            if not common.subscribe_user(issue, username):
+                self.can_subscribe = False
+
+        self.target.finish_issue(issue, record['state_event'])
+
+        print("Replayed {}: {}".format(record['source_id'], issue.web_url))
+
+    def _advance(self, pending, checkpoint, block):
+        running = [p[2] for p in pending if not p[2].done()]
+        if block and running:
+            concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+
+        for start, end, future in pending:
+            if future.done() and future.exception() is None:
+                checkpoint.done.add(start)
+
+        # Move the offset over the leading run of replayed issues; a failed
+        # issue holds it back so that a later run retries it
+        while pending and pending[0][0] in checkpoint.done:
+            start, end, future = pending.popleft()
+            checkpoint.done.discard(start)
+            checkpoint.offset = end
+
+        checkpoint.save()
+
+    def run(self, checkpoint):
+        pending = collections.deque()
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor, \
+                open(self.spool_path, 'rb') as f:
+            offset = 0
+            for line in f:
+                start = offset
+                offset += len(line)
+
+                # Uploads are always read, an issue past the checkpoint may
+                # refer to a file recorded before it
+                record = json.loads(line.decode('utf-8'))
+                if record['type'] == 'upload':
+                    self.uploads[record['key']] = record
+                    continue
+
+                if start < checkpoint.offset or start in checkpoint.done:
+                    continue
+
+                pending.append((start, offset,
+                                executor.submit(self.replay_issue, record)))
+                running = sum(1 for p in pending if not p[2].done())
+                self._advance(pending, checkpoint,
+                              block=running >= 2 * self.jobs)
+
+            concurrent.futures.wait([p[2] for p in pending])
+            self._advance(pending, checkpoint, block=False)
+
+        failed = 0
+        for start, end, future in pending:
+            if future.exception() is not None:
+                failed += 1
+                print("Failed to replay the issue at offset {}: {}".format(
+                    start, future.exception()))
+        return failed
+
+
+def options():
+    parser = argparse.ArgumentParser(
+        description="Create the GitLab issues recorded by bztogl --dry-run")
+    parser.add_argument('spool', help="NDJSON spool written by bztogl")
+    parser.add_argument('--production', action='store_true',
+                        help="target production (gitlab.gnome.org) instead \
+                              of testing (gitlab-test.gnome.org)")
+    parser.add_argument('--fdo', action='store_true',
+                        help="import for freedesktop.org rather than GNOME")
+    parser.add_argument('--token', help="gitlab token API", required=True)
+    parser.add_argument('--target-project', metavar="USERNAME/PROJECT",
+                        help="project name for gitlab, like \
+                              'username/project'", required=True)
+    parser.add_argument('--jobs', type=int, default=4,
+                        help="number of issues created in parallel")
+    parser.add_argument('--checkpoint', metavar="FILE",
+                        help="file recording the replay progress, \
+                              SPOOL.checkpoint by default")
+    return parser.parse_args()
+
+
+def main():
+    args = options()
+
+    glurl, bzurl, giturl, instance, bzresolution = \
+        bztogl.instance_urls(args.fdo, args.production)
+
+    target = common.GitLab(glurl, giturl, args.token,
+                           args.target_project.split('/')[-1],
+                           args.target_project)
+    target.connect()
+    bztogl.check_if_target_project_exists(target)
+
+    checkpoint = Checkpoint(args.checkpoint or args.spool + '.checkpoint')
+    if checkpoint.offset:
+        print("Resuming {} from byte {}".format(args.spool, checkpoint.offset))
+
+    replayer = Replayer(target, args.spool, bzurl, args.jobs)
+    if replayer.run(checkpoint):
+        exit(1)
+
+
+def import_archive_options():
+    parser = argparse.ArgumentParser(
+        description="Import a project export archive written by bztogl or "
+                    "phabtogl --archive")
+    parser.add_argument('archive', help="archive written with --archive")
+    parser.add_argument('--production', action='store_true',
+                        help="target production (gitlab.gnome.org) instead \
+                              of testing (gitlab-test.gnome.org)")
+    parser.add_argument('--fdo', action='store_true',
+                        help="import for freedesktop.org rather than GNOME")
+    parser.add_argument('--token', help="gitlab token API", required=True)
+    parser.add_argument('--target-project', metavar="NAMESPACE/PROJECT",
+                        help="project the archive is imported as, it must \
+                              not exist yet", required=True)
+    return parser.parse_args()
+
+
+def import_archive_main():
+    args = import_archive_options()
+
+    glurl = bztogl.instance_urls(args.fdo, args.production)[0]
+    target = common.GitLab(glurl, None, args.token,
+                           args.target_project.split('/')[-1],
+                           args.target_project)
+    target.connect()
+
+    print("Importing {} as {}".format(args.archive, args.target_project))
+    target.import_archive(args.archive)
+    print("Imported {}{}".format(glurl, args.target_project))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+import collections
+import contextlib
+import json
+import sqlite3
+import time
+
+# Seconds a worker owns a lease for without renewing it
+LEASE_TIME = 600
+WARM_LEASE = 'warm'
+
+Lease = collections.namedtuple('Lease', 'name first last')
+
+
+def shard_ranges(bug_ids, count):
+    """Splits @bug_ids into at most @count (first, last) ranges of about
+    the same number of bugs"""
+    ids = sorted(bug_ids)
+    if not ids:
+        return []
+    size = -(-len(ids) // count)
+    return [(ids[i], ids[min(i + size, len(ids)) - 1])
+            for i in range(0, len(ids), size)]
+
+
+class LeaseTable:
+    """Shards of the bug ID space which bztogl workers claim for a limited
+    time. It lives in an SQLite database, which can be on a filesystem
+    shared by the hosts running the workers.
+
+    A worker which stops renewing its lease, because it crashed or lost
+    its host, lets another worker reclaim the shard. Bugs are marked as
+    migrated one by one, so a reclaimed shard is not migrated twice."""
+
+    def __init__(self, path, lease_time=LEASE_TIME):
+        self.path = path
+        self.lease_time = lease_time
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                   check_same_thread=False)
+        with self._transaction():
+            self._db.execute("""CREATE TABLE IF NOT EXISTS leases (
+                                    name TEXT PRIMARY KEY,
+                                    first INTEGER,
+                                    last INTEGER,
+                                    owner TEXT,
+                                    expires REAL,
+                                    done INTEGER DEFAULT 0)""")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS migrated (
+                                    bug_id INTEGER PRIMARY KEY)""")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS caches (
+                                    name TEXT PRIMARY KEY,
+                                    value TEXT)""")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def add_shards(self, ranges):
+        """Creates the shards, unless another worker already did"""
+        with self._transaction():
+            if self._db.execute("SELECT COUNT(*) FROM leases").fetchone()[0]:
+                return
+            self._db.execute("INSERT INTO leases (name) VALUES (?)",
+                             (WARM_LEASE,))
+            self._db.executemany(
+                "INSERT INTO leases (name, first, last) VALUES (?, ?, ?)",
+                (('shard-{}'.format(i), first, last)
+                 for i, (first, last) in enumerate(ranges)))
+
+    def claim(self, owner, name=None):
+        """Returns a free or expired lease, the lease @name if given, now
+        owned by @owner, or None"""
+        now = time.time()
+        query = """SELECT name, first, last FROM leases
+                   WHERE done = 0 AND (owner IS NULL OR expires < ?)"""
+        if name is None:
+            query += " AND name != ? ORDER BY first LIMIT 1"
+            params = (now, WARM_LEASE)
+        else:
+            query += " AND name = ?"
+            params = (now, name)
+
+        with self._transaction():
+            row = self._db.execute(query, params).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE leases SET owner = ?, expires = ? WHERE name = ?",
+                (owner, now + self.lease_time, row[0]))
+        return Lease(*row)
+
+    def renew(self, lease, owner):
+        """Extends @lease, returns False if it was reclaimed meanwhile"""
+        with self._transaction():
+            cursor = self._db.execute(
+                "UPDATE leases SET expires = ? WHERE name = ? AND owner = ?",
+                (time.time() + self.lease_time, lease.name, owner))
+        return cursor.rowcount == 1
+
+    def complete(self, lease, owner):
+        with self._transaction():
+            self._db.execute(
+                "UPDATE leases SET done = 1 WHERE name = ? AND owner = ?",
+                (lease.name, owner))
+
+    def pending(self):
+        """Returns the number of shards not migrated yet"""
+        return self._db.execute(
+            "SELECT COUNT(*) FROM leases WHERE done = 0 AND name != ?",
+            (WARM_LEASE,)).fetchone()[0]
+
+    def mark_migrated(self, bug_id, lease, owner):
+        """Records that @bug_id is migrated, returns False without
+        recording it if @owner no longer holds @lease"""
+        with self._transaction():
+            held = self._db.execute(
+                """SELECT 1 FROM leases
+                   WHERE name = ? AND owner = ? AND expires >= ?""",
+                (lease.name, owner, time.time())).fetchone()
+            if held is None:
+                return False
+            self._db.execute(
+                "INSERT OR IGNORE INTO migrated (bug_id) VALUES (?)",
+                (bug_id,))
+        return True
+
+    def is_migrated(self, bug_id):
+        return self._db.execute(
+            "SELECT 1 FROM migrated WHERE bug_id = ?",
+            (bug_id,)).fetchone() is not None
+
+    def get_cache(self, name):
+        row = self._db.execute("SELECT value FROM caches WHERE name = ?",
+                               (name,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put_cache(self, name, value):
+        with self._transaction():
+            self._db.execute(
+                "INSERT OR REPLACE INTO caches (name, value) VALUES (?, ?)",
+                (name, json.dumps(value)))
+
+    def close(self):
+        self._db.close()
+
+
+def shared_caches(leases, owner, warm, poll=5):
+    """Returns the caches every worker shares read-only. The first worker
+    to claim the warm-up lease builds them with @warm, the others wait."""
+    while True:
+        caches = leases.get_cache(WARM_LEASE)
+        if caches is not None:
+            return caches
+
+        lease = leases.claim(owner, WARM_LEASE)
+        if lease is not None:
+            print("Warming the shared caches")
+            caches = warm()
+            leases.put_cache(WARM_LEASE, caches)
+            leases.complete(lease, owner)
+            return caches
+
+        print("Waiting for another worker to warm the shared caches")
+        time.sleep(poll)
+
+
+def run_worker(leases, owner, bzbugs, migrate, poll=None):
+    """Claims shards until all of them are migrated, calling @migrate on
+    each bug of @bzbugs in the claimed shard"""
+    if poll is None:
+        poll = leases.lease_time / 10
+
+    while True:
+        lease = leases.claim(owner)
+        if lease is None:
+            if not leases.pending():
+                return
+            # Shards claimed by other workers can still expire
+            time.sleep(poll)
+            continue
+
+        print("Claimed bugs {} to {}".format(lease.first, lease.last))
+        for bzbug in bzbugs:
+            if not lease.first <= bzbug.id <= lease.last or \
+                    leases.is_migrated(bzbug.id):
+                continue
+            # Renewing before each bug gives it the whole lease time
+            if leases.renew(lease, owner):
+                migrate(bzbug)
+                if leases.mark_migrated(bzbug.id, lease, owner):
+                    continue
+            print("Lost the lease on bugs {} to {}".format(
+                lease.first, lease.last))
+            break
+        else:
+            leases.complete(lease, owner)
@@ -0,0 +1,170 @@
+import collections
+import copy
+import datetime
+import gzip
+import hashlib
+import json
+import os
+
+BUGS_FILE = 'bugs.jsonl.gz'
+USERS_FILE = 'users.jsonl.gz'
+COMPONENTS_FILE = 'components.json'
+BLOBS_DIR = 'blobs'
+# XML-RPC DateTime as stored in snapshots, and what --since may be given as
+TIME_FORMATS = ('%Y%m%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%d %H:%M', '%Y-%m-%d')
+
+
+def _dump(obj):
+    # XML-RPC DateTime values are stored as the string bztogl renders them to
+    return json.dumps(obj, default=str, sort_keys=True, ensure_ascii=False)
+
+
+def parse_time(value):
+    """Returns the datetime of an XML-RPC or ISO 8601 date @value"""
+    value = str(value).rstrip('Z')
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            pass
+    raise Exception("Could not parse date: {}".format(value))
+
+
+def _blob_path(path, digest):
+    return os.path.join(path, BLOBS_DIR, digest[:2], digest)
+
+
+def _write_blob(path, data):
+    digest = hashlib.sha256(data).hexdigest()
+    blob_path = _blob_path(path, digest)
+    if not os.path.exists(blob_path):
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        with open(blob_path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(blob_path + '.tmp', blob_path)
+    return digest
+
+
+def export_product(bgo, product, bzbugs, path):
+    """Writes @bzbugs, with their comments, attachments and users, and the
+    components of @product to a snapshot in the @path directory"""
+    os.makedirs(path, exist_ok=True)
+    # pylint: disable=protected-access
+    proxy = bgo._proxy
+    # pylint: enable=protected-access
+
+    emails = set()
+    with gzip.open(os.path.join(path, BUGS_FILE), 'wt',
+                   encoding='utf-8') as f:
+        for count, bzbug in enumerate(bzbugs, 1):
+            print("[{}/{}] Exporting bug #{}: {}".format(
+                count, len(bzbugs), bzbug.id, bzbug.summary))
+            bug = bzbug.get_raw_data()
+            bug['comments'] = bzbug.getcomments()
+
+            rawret = proxy.Bug.attachments(
+                {"ids": [bzbug.bug_id], "exclude_fields": ["data"]})
+            bug['attachments'] = rawret["bugs"][str(bzbug.bug_id)]
+            for at in bug['attachments']:
+                data = bgo.openattachment(at['id']).read()
+                at['blob'] = _write_blob(path, data)
+
+            emails.update([bzbug.creator, bzbug.assigned_to])
+            emails.update(bzbug.cc)
+            for comment in bug['comments']:
+                emails.add(comment.get('author', comment.get('creator')))
+
+            f.write(_dump(bug) + '\n')
+
+    emails.discard(None)
+    print("Exporting {} users".format(len(emails)))
+    with gzip.open(os.path.join(path, USERS_FILE), 'wt',
+                   encoding='utf-8') as f:
+        for user in bgo.getusers(sorted(emails)):
+            f.write(_dump({'email': user.email,
+                           'real_name': user.real_name}) + '\n')
+
+    with open(os.path.join(path, COMPONENTS_FILE), 'w') as f:
+        f.write(_dump({product: bgo.getcomponentsdetails(product)}))
+
+
+SnapshotUser = collections.namedtuple('SnapshotUser', 'email real_name')
+
+
+class SnapshotBug:
+    """A bug read from a snapshot, with the attributes of a python-bugzilla
+    Bug that bztogl uses"""
+
+    def __init__(self, bugzilla, data):
+        self.__dict__.update(copy.deepcopy(data))
+        self._comments = self.__dict__.pop('comments')
+        self.bug_id = self.id
+        self.bugzilla = bugzilla
+
+    def getcomments(self):
+        return copy.deepcopy(self._comments)
+
+
+class BugzillaSnapshot:
+    """Read-only stand-in for bugzilla.Bugzilla serving a product exported
+    with export_product()"""
+
+    logged_in = False
+
+    def __init__(self, path):
+        self.path = path
+
+        self._bugs = []
+        with gzip.open(os.path.join(path, BUGS_FILE), 'rt',
+                       encoding='utf-8') as f:
+            for line in f:
+                self._bugs.append(json.loads(line))
+
+        self._users = {}
+        with gzip.open(os.path.join(path, USERS_FILE), 'rt',
+                       encoding='utf-8') as f:
+            for line in f:
+                user = SnapshotUser(**json.loads(line))
+                self._users[user.email] = user
+
+        with open(os.path.join(path, COMPONENTS_FILE)) as f:
+            self._components = json.load(f)
+
+        self._blobs = {}
+        for bug in self._bugs:
+            for at in bug['attachments']:
+                self._blobs[at['id']] = at['blob']
+
+    def build_query(self, product=None, component=None, **kwargs):
+        return {'product': product, 'component': component}
+
+    def query(self, query):
+        def matches(bug, key):
+            value = query.get(key)
+            if not value:
+                return True
+            if isinstance(value, str):
+                value = [value]
+            return bug[key] in value
+
+        since = query.get('last_change_time')
+        if since:
+            since = parse_time(since)
+
+        def changed(bug):
+            return not since or parse_time(bug['last_change_time']) >= since
+
+        return [SnapshotBug(self, bug) for bug in self._bugs
+                if changed(bug) and all(
+                    matches(bug, key)
+                    for key in ('product', 'component', 'status'))]
+
+    def getuser(self, email):
+        return self._users.get(email, SnapshotUser(email, ''))
+
+    def getcomponentsdetails(self, product):
+        return self._components[product]
+
+    def openattachment(self, atid):
+        return open(_blob_path(self.path, self._blobs[atid]), 'rb')
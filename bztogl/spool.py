@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+from . import common
+
+# Uploads are not performed in dry-run mode; the markdown GitLab would return
+# is replaced by a link with this scheme, which the replayer resolves once the
+# file has actually been uploaded.
+PLACEHOLDER_SCHEME = 'bztogl-upload'
+PLACEHOLDER_REGEX = re.compile(
+    r'\[[^\]\n]*\]\(' + PLACEHOLDER_SCHEME + r'://([^)\s]+)\)')
+
+
+def placeholder_markdown(key, filename):
+    return '[{}]({}://{})'.format(filename, PLACEHOLDER_SCHEME, key)
+
+
+def resolve_placeholders(text, upload):
+    """Replaces every upload placeholder in @text by the markdown returned
+    by @upload for its key"""
+    if not text:
+        return text
+    return PLACEHOLDER_REGEX.sub(lambda m: upload(m.group(1)), text)
+
+
+class SpoolWriter:
+    """Append-only NDJSON file of rendered GitLab payloads"""
+
+    def __init__(self, path):
+        self.path = path
+        self.blob_dir = path + '.blobs'
+        self._lock = threading.Lock()
+        self._fp = open(path, 'a', encoding='utf-8')
+
+    def write(self, record):
+        line = json.dumps(record, sort_keys=True, ensure_ascii=False)
+        with self._lock:
+            self._fp.write(line + '\n')
+            self._fp.flush()
+
+    def write_blob(self, f):
+        data = f.read() if hasattr(f, 'read') else f
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.blob_dir, digest)
+        if not os.path.exists(path):
+            os.makedirs(self.blob_dir, exist_ok=True)
+            with open(path + '.tmp', 'wb') as fp:
+                fp.write(data)
+            os.replace(path + '.tmp', path)
+        return digest
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+
+class SpoolNotes:
+    def __init__(self):
+        self.payloads = []
+
+    def create(self, payload, sudo=None):
+        self.payloads.append(dict(payload))
+
+
+class SpoolIssue:
+    """Stands in for a python-gitlab issue, recording the calls made on it.
+
+    The record is written to the spool when the issue is saved, which is
+    always the last GitLab request of a migrated issue."""
+
+    def __init__(self, spool, source_id, payload):
+        self._spool = spool
+        self.source_id = source_id
+        self.payload = payload
+        self.attributes = {'title': payload['title']}
+        self.assignee_id = None
+        self.state_event = None
+        self.notes = SpoolNotes()
+        self.subscribers = []
+        self.web_url = None
+
+    def get_id(self):
+        return None
+
+    def subscribe(self, sudo=None):
+        self.subscribers.append(sudo)
+
+    def save(self, state_event=None, **kwargs):
+        if state_event is not None:
+            self.state_event = state_event
+        self._spool.write({
+            'type': 'issue',
+            'source_id': self.source_id,
+            'issue': self.payload,
+            'assignee_id': self.assignee_id,
+            'notes': self.notes.payloads,
+            'subscribers': self.subscribers,
+            'state_event': self.state_event,
+        })
+
+
+class SpoolTarget(common.GitLab):
+    """GitLab target which renders everything but sends nothing.
+
+    Reads (the user directory) still go to GitLab, but issues, notes,
+    subscriptions and uploads are streamed to a SpoolWriter instead."""
+
+    dry_run = True
+
+    def __init__(self, spool, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.spool = spool
+
+    def create_issue(self, id, summary, description, labels,
+                     milestone, creation_time, sudo=None, assignee_id=None,
+                     confidential=False):
+        payload = {
+            'title': summary,
+            'description': description,
+            'labels': labels,
+            'created_at': creation_time
+        }
+        if confidential:
+            payload['confidential'] = True
+
+        if milestone:
+            if not isinstance(milestone, str):
+                milestone = milestone.title
+            payload['milestone'] = milestone
+
+        issue = SpoolIssue(self.spool, id, payload)
+        issue.assignee_id = assignee_id
+        return issue
+
+    def finish_issue(self, issue, state_event):
+        # The record is only written once the issue is saved
+        issue.save(state_event=state_event)
+
+    def upload_bugzilla_attachment(self, bugzilla, atid, filename,
+                                   size=None):
+        key = 'bugzilla-{}'.format(atid)
+        self.spool.write({
+            'type': 'upload',
+            'key': key,
+            'filename': filename,
+            'attachment_id': atid,
+        })
+        return {'markdown': placeholder_markdown(key, filename)}
+
+    def upload_file(self, filename, f):
+        key = self.spool.write_blob(f)
+        self.spool.write({
+            'type': 'upload',
+            'key': key,
+            'filename': filename,
+            'blob': key,
+        })
+        return {'markdown': placeholder_markdown(key, filename)}
+
+    def close(self):
+        self.spool.close()
+
+
+class MilestoneTitles(dict):
+    """Milestone cache for dry runs: milestones are spooled by title"""
+
+    def __missing__(self, title):
+        return title
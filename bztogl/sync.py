@@ -0,0 +1,57 @@
+import json
+import os
+
+from . import snapshot
+
+# ISO 8601, which Bugzilla accepts for last_change_time in queries
+WATERMARK_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+class SyncState:
+    """What a --sync run has migrated so far: the GitLab issue of every
+    bug, the last Bugzilla comment and labels put on it, and the
+    last_change_time of the most recently changed bug"""
+
+    def __init__(self, path):
+        self.path = path
+        self.watermark = None
+        self.bugs = {}
+
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        self.watermark = state['watermark']
+        self.bugs = {int(bug_id): entry
+                     for bug_id, entry in state['bugs'].items()}
+
+    def __contains__(self, bug_id):
+        return bug_id in self.bugs
+
+    def __getitem__(self, bug_id):
+        return self.bugs[bug_id]
+
+    def record(self, bzbug, iid, comments, labels):
+        """Records that @bzbug is migrated to issue @iid, up to the last of
+        its @comments and with the bztogl @labels"""
+        self.bugs[bzbug.id] = {
+            'iid': iid,
+            'last_comment': comments[-1]['id'] if comments else 0,
+            'labels': labels,
+        }
+        self.advance(bzbug.last_change_time)
+
+    def advance(self, last_change_time):
+        """Moves the watermark forward to @last_change_time, an XML-RPC
+        DateTime or its string form, if it is more recent"""
+        changed = snapshot.parse_time(last_change_time)
+        if self.watermark is None or \
+                changed > snapshot.parse_time(self.watermark):
+            self.watermark = changed.strftime(WATERMARK_FORMAT)
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'watermark': self.watermark, 'bugs': self.bugs}, f,
+                      sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
@@ -76,6 +76,13 @@ def _autolink_markdown(instance_base, text):
     return text
 
 
+def autolink_texts(texts, instance_base):
+    """Returns @texts with bug links and quoting applied, long texts are
+    rendered this way in a render.RenderPool process"""
+    return [_autolink_markdown(instance_base, text) if text else text
+            for text in texts]
+
+
 def _body_to_markdown_quote(body):
     if not body:
         return '\n'
@@ -84,7 +91,7 @@ def _body_to_markdown_quote(body):
 
 def render_issue_description(
         instance_base, bug, text, user_cache, importing_address=None,
-        bug_url_function=_bugzilla_url):
+        bug_url_function=_bugzilla_url, autolink=True):
     if not text:
         text = ""
     if not importing_address:
@@ -136,7 +143,7 @@ def render_issue_description(
     dependencies = DEPENDENCIES_TEMPLATE.format(depends_on=deps,
                                                 blocks=blocks,
                                                 see_also=see_also)
-    if bug_url_function == _bugzilla_url:
+    if bug_url_function == _bugzilla_url and autolink:
         body = _autolink_markdown(instance_base, text)
     else:
         body = text
@@ -163,9 +170,9 @@ def render_bugzilla_migration_comment(instance, gl_issue):
 
 
 def render_comment(instance_base, emoji, author, action, body, attachment,
-                   bug_url_function=_bugzilla_url):
+                   bug_url_function=_bugzilla_url, autolink=True):
 
-    if bug_url_function == _bugzilla_url and body:
+    if bug_url_function == _bugzilla_url and autolink and body:
         body = _autolink_markdown(instance_base, body)
 
     body = _body_to_markdown_quote(body)
@@ -14,19 +14,46 @@ class User(collections.namedtuple('User', 'email username real_name id')):
 
 
 class UserCache:
-    def __init__(self, target, bugzilla, product):
+    def __init__(self, target, bugzilla, product, gitlab_emails=None):
         self._target = target
         self._bugzilla = bugzilla
         self._gitlab_emails_cache = {}
         self._users_cache = {}
 
-        self._gitlab_emails_cache = self._retrieve_gitlab_emails_cache()
-        self._save_gitlab_emails_cache()
+        if gitlab_emails is not None:
+            # Shared by another bztogl process, which already saved it
+            self._gitlab_emails_cache = gitlab_emails
+        else:
+            self._gitlab_emails_cache = self._retrieve_gitlab_emails_cache()
+            self._save_gitlab_emails_cache()
 
         components = self._bugzilla.getcomponentsdetails(product)
         self._default_emails = set(c['initialowner']
                                    for c in components.values())
 
+    @property
+    def gitlab_emails(self):
+        return self._gitlab_emails_cache
+
+    def prefetch(self, emails):
+        """Looks up the GitLab users of @emails at once, for example all
+        the people involved in a bug"""
+        missing = {}
+        for email in set(emails):
+            if email not in self._users_cache and \
+                    email in self._gitlab_emails_cache:
+                missing[email] = self._gitlab_emails_cache[email]
+        if not missing:
+            return
+
+        gitlab_users = self._target.find_users(sorted(set(missing.values())))
+        for email, gitlab_user_id in missing.items():
+            gitlab_user = gitlab_users.get(gitlab_user_id)
+            if gitlab_user:
+                self._users_cache[email] = User(
+                    email=email, username=gitlab_user.username,
+                    real_name=gitlab_user.name, id=gitlab_user.id)
+
     def __getitem__(self, email):
         # Default assignees on GNOME projects don't correspond to a GitLab
         # user, and effectively mean unassigned
@@ -65,12 +92,12 @@ class UserCache:
             all_gitlab_users = self._target.get_all_users()
             print('Downloading secondary emails')
             for i, user in enumerate(all_gitlab_users):
-                emails = user.emails.list()
                 # Main email is accesible directly
-                gitlab_emails_cache[user.email] = user.id
-                for email in emails:
-                    # Secondary emails need this hop
-                    gitlab_emails_cache[email.email] = email.user_id
+                if user.email:
+                    gitlab_emails_cache[user.email] = user.id
+                # Secondary emails need this hop
+                for email in self._target.get_user_emails(user.id):
+                    gitlab_emails_cache[email] = user.id
 
                 print('[' + str(i) + '/' + str(len(all_gitlab_users)) +
                       '] users processed')
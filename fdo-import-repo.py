@@ -21,16 +21,27 @@
 # Author: Daniel Stone <daniels@collabora.com>
 
 import argparse
+import concurrent.futures
 import json
 import os
+import shlex
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
 import urllib.parse
 
 import gitlab
 
+# Prefix of the per-repo result lines printed by the batched kemper scripts
+BATCH_RESULT = "fdo-import-result"
+
+# Import status polling backs off from POLL_MIN to POLL_MAX seconds per repo
+POLL_MIN = 2
+POLL_MAX = 60
+
 class Config:
     def __init__(self):
         self.gitlab_token = None
@@ -39,6 +50,35 @@ class Config:
         self.issues = False
         self.merge_requests = False
         self.gitlab = None
+        self.ssh_jobs = 8
+        self.ssh_batch = True
+        self.create_jobs = 4
+        self.timeout = 3600
+        self.ssh_control_path = None
+        self.namespaces = {}
+        self.namespaces_lock = threading.Lock()
+
+    def ssh_cmd(self, *args):
+        cmd = ["ssh"]
+        if self.ssh_control_path:
+            cmd += ["-o", "ControlPath=%s" % self.ssh_control_path]
+        return cmd + [self.kemper_host] + list(args)
+
+    def start_ssh_master(self):
+        # All the repos are prepared over one multiplexed connection, instead
+        # of a full SSH handshake each
+        self.ssh_control_path = os.path.join(tempfile.mkdtemp(), "kemper")
+        subprocess.run(["ssh", "-o", "ControlMaster=yes",
+                        "-o", "ControlPath=%s" % self.ssh_control_path,
+                        "-o", "ControlPersist=yes", "-f", "-N",
+                        self.kemper_host], check=True)
+
+    def stop_ssh_master(self):
+        if self.ssh_control_path:
+            subprocess.run(self.ssh_cmd("-O", "exit"),
+                           stderr=subprocess.DEVNULL)
+            os.rmdir(os.path.dirname(self.ssh_control_path))
+            self.ssh_control_path = None
 
 class Repo:
     def __init__(self, config, url_fdo, url_gitlab):
@@ -47,6 +87,9 @@ class Repo:
         self.url_fdo = url_fdo
         self.project = None
         self.imported = False
+        self.import_status = None
+        self.poll_interval = POLL_MIN
+        self.next_poll = 0
 
     def gitlab_repo_file_path(self):
         return "/gitlab-data/git-data/repositories/%s.git" % self.url_gitlab
@@ -60,25 +103,43 @@ class Repo:
     def legacy_clone_path(self):
         return "git://anongit.freedesktop.org/git/%s" % self.url_fdo
 
-    def prepare_repo_kemper(self):
+    def prepare_kemper_cmd(self):
         # Accept non-fast-forwards (to make a perfect mirror), and disable
         # direct user pushes, as the only pushes will come from GitLab.
-        cmd = ["ssh", self.config.kemper_host, "sh", "-c",
-               "'GIT_DIR=%s git config --local receive.denynonfastforwards false && ln -s /srv/git.freedesktop.org/hooks/pre-receive-gitlab %s/hooks/pre-receive'" % (self.legacy_file_path(), self.legacy_file_path())] 
+        path = shlex.quote(self.legacy_file_path())
+        return ("GIT_DIR=%s git config --local "
+                "receive.denynonfastforwards false && "
+                "ln -s /srv/git.freedesktop.org/hooks/pre-receive-gitlab "
+                "%s/hooks/pre-receive" % (path, path))
+
+    def rollback_kemper_cmd(self):
+        # Deny non-fast-forwards and accept direct user pushes again.
+        path = shlex.quote(self.legacy_file_path())
+        return ("GIT_DIR=%s git config --local "
+                "receive.denynonfastforwards true && "
+                "rm -f %s/hooks/pre-receive" % (path, path))
+
+    def prepare_repo_kemper(self):
+        cmd = self.config.ssh_cmd("sh", "-c",
+                                  shlex.quote(self.prepare_kemper_cmd()))
         subprocess.run(cmd, check=True)
 
     def rollback_repo_kemper(self):
-        # Accept non-fast-forwards (to make a perfect mirror), and disable
-        # direct user pushes, as the only pushes will come from GitLab.
-        cmd = ["ssh", self.config.kemper_host, "sh", "-c",
-               "'GIT_DIR=%s git config --local receive.denynonfastforwards true && rm -f %s/hooks/pre-receive'" % (self.legacy_file_path(), self.legacy_file_path())] 
+        cmd = self.config.ssh_cmd("sh", "-c",
+                                  shlex.quote(self.rollback_kemper_cmd()))
         subprocess.run(cmd, check=True)
 
     def get_namespace_id(self):
         # Surely there has to be a cleaner way to do this ... ?
         namespace = self.url_gitlab.split('/')[:-1]
+        full_path = "/".join(namespace)
+        with self.config.namespaces_lock:
+            if full_path in self.config.namespaces:
+                return self.config.namespaces[full_path]
         for ns in self.config.gitlab.namespaces.list(search=namespace[-1]):
-            if ns.full_path == "/".join(namespace):
+            if ns.full_path == full_path:
+                with self.config.namespaces_lock:
+                    self.config.namespaces[full_path] = ns.id
                 return ns.id
         raise Exception("Couldn't find GitLab namespace %s" % namespace)
 
@@ -95,13 +156,132 @@ class Repo:
         })
 
     def get_import_status(self):
-        self.config.gitlab.session.headers = { "PRIVATE-TOKEN": self.config.gitlab_token }
         url = "https://gitlab.freedesktop.org/api/v4/projects/%d" % self.project.id
-        ret = self.config.gitlab.session.get(url)
+        ret = self.config.gitlab.session.get(
+            url, headers={"PRIVATE-TOKEN": self.config.gitlab_token})
         if ret.status_code != 200:
             raise Exception("Status query for %s failed: %s" % (self.url_gitlab, ret.text))
-        return json.loads(ret.text).get("import_status") == "finished"
-        
+        return json.loads(ret.text).get("import_status")
+
+    def poll(self):
+        try:
+            self.import_status = self.get_import_status()
+        except Exception as e:
+            print("Failed to query import status of %s: '%s'" %
+                  (self.url_gitlab, e))
+        self.imported = self.import_status == "finished"
+        self.next_poll = time.monotonic() + self.poll_interval
+        self.poll_interval = min(self.poll_interval * 2, POLL_MAX)
+
+    def pending(self):
+        return self.project and not self.imported and \
+            self.import_status != "failed"
+
+
+def kemper_batch_script(cmds):
+    """Returns a shell script running each of @cmds and printing a result
+    line for it, the output of failed commands is kept on that line"""
+    script = ""
+    for i, cmd in enumerate(cmds):
+        script += """if out=$( (%s) 2>&1 ); then
+    echo "%s %d ok"
+else
+    echo "%s %d failed $? $(echo "$out" | tr '\\n' ' ')"
+fi
+""" % (cmd, BATCH_RESULT, i, BATCH_RESULT, i)
+    return script
+
+
+def parse_kemper_batch_output(output, count):
+    """Returns a list with the error of each of the @count commands of a
+    batch script, None for those which succeeded"""
+    errors = ["no result from kemper"] * count
+    for line in output.splitlines():
+        fields = line.split(" ", 4)
+        if len(fields) < 3 or fields[0] != BATCH_RESULT:
+            continue
+        i = int(fields[1])
+        if fields[2] == "ok":
+            errors[i] = None
+        else:
+            errors[i] = "exit status %s: %s" % (
+                fields[3], " ".join(fields[4:]).strip())
+    return errors
+
+
+def run_kemper_batch(config, repos, method, what):
+    """Runs the command returned by @method for each of @repos in a single
+    SSH session to kemper, returns the repos it succeeded for"""
+    if not repos:
+        return []
+    script = kemper_batch_script(method(repo) for repo in repos)
+    ret = subprocess.run(config.ssh_cmd("sh", "-s"), input=script,
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    if ret.returncode != 0:
+        print("SSH session to %s exited with status %d" %
+              (config.kemper_host, ret.returncode))
+
+    succeeded = []
+    errors = parse_kemper_batch_output(ret.stdout, len(repos))
+    for repo, error in zip(repos, errors):
+        if error:
+            print("Failed to %s %s to %s: '%s'" %
+                  (what, repo.url_fdo, repo.url_gitlab, error))
+        else:
+            succeeded.append(repo)
+    return succeeded
+
+
+def run_jobs(function, repos, jobs, what):
+    """Runs @function on each of @repos, @jobs at a time, returns the repos
+    it succeeded for"""
+    succeeded = []
+    with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+        futures = [(repo, pool.submit(function, repo)) for repo in repos]
+        for repo, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print("Failed to %s %s to %s: '%s'" %
+                      (what, repo.url_fdo, repo.url_gitlab, e))
+                traceback.print_exception(type(e), e, e.__traceback__)
+                continue
+            succeeded.append(repo)
+    return succeeded
+
+
+def print_progress(repos, started):
+    print("")
+    print("[%ds] import status:" % (time.monotonic() - started))
+    for repo in repos:
+        if repo.project:
+            if repo.imported:
+                status = "finished"
+            else:
+                status = repo.import_status or "unknown"
+            print("  %-50s %s" % (repo.url_gitlab, status))
+
+
+def wait_for_imports(config, repos):
+    started = time.monotonic()
+    deadline = started + config.timeout
+    with concurrent.futures.ThreadPoolExecutor(config.create_jobs) as pool:
+        while any(repo.pending() for repo in repos):
+            now = time.monotonic()
+            if now >= deadline:
+                print("Giving up waiting for imports after %ds" %
+                      config.timeout)
+                break
+            due = [repo for repo in repos
+                   if repo.pending() and repo.next_poll <= now]
+            list(pool.map(Repo.poll, due))
+            if due:
+                print_progress(repos, started)
+
+            waiting = [repo.next_poll for repo in repos if repo.pending()]
+            if waiting:
+                wakeup = min(min(waiting), deadline)
+                time.sleep(max(0, wakeup - time.monotonic()))
 
 
 def main():
@@ -120,8 +300,9 @@ wayland/wayland-web wayland/wayland.freedesktop.org
 
 You will need SSH access to kemper (either being in the group, or being root),
 as well as a GitLab access token (user menu -> settings -> access tokens) for
-an admin account. To make this quicker, you almost certainly want a master
-connection active.
+an admin account. The repos are prepared by a single script run over one SSH
+session, which the script opens itself, and it gives up waiting for the
+imports after --timeout seconds.
 
 The script will create the GitLab project itself, as well as disabling pushes
 to the old repository. It will _not_ set up mirroring from GitLab to the old
@@ -147,6 +328,26 @@ a copy of the repository list you imported.
                         default=False,
                         action="store_true",
                         help="Enable merge requests on migrated repos")
+    parser.add_argument("--ssh-jobs",
+                        type=int,
+                        default=8,
+                        help="Number of repos prepared on kemper in "
+                             "parallel with --no-ssh-batch")
+    parser.add_argument("--no-ssh-batch",
+                        dest="ssh_batch",
+                        default=True,
+                        action="store_false",
+                        help="Prepare and roll back each repo over its "
+                             "own SSH command rather than one script for "
+                             "all of them")
+    parser.add_argument("--create-jobs",
+                        type=int,
+                        default=4,
+                        help="Number of GitLab projects created in parallel")
+    parser.add_argument("--timeout",
+                        type=int,
+                        default=3600,
+                        help="Seconds to wait for all the imports to finish")
     config = Config()
     parser.parse_args(namespace=config)
     config.gitlab = gitlab.Gitlab("https://gitlab.freedesktop.org",
@@ -162,48 +363,52 @@ a copy of the repository list you imported.
             print("Malformed line '%s': must be in format fdorepo/name gitlabgroup/gitlabproject" % line[:-1])
             continue
 
-        repo = Repo(config, url_fdo, url_gitlab)
-        repos.append(repo)
+        repos.append(Repo(config, url_fdo, url_gitlab))
 
-        try:
-            repo.prepare_repo_kemper()
-        except Exception as e:
-            print("Failed to migrate %s to %s: '%s'" % (url_fdo, url_gitlab, e))
-            traceback.print_exc()
-            continue
+    config.start_ssh_master()
+    try:
+        if config.ssh_batch:
+            prepared = run_kemper_batch(config, repos, Repo.prepare_kemper_cmd,
+                                        "prepare")
+        else:
+            prepared = run_jobs(Repo.prepare_repo_kemper, repos,
+                                config.ssh_jobs, "prepare")
+        run_jobs(Repo.begin_gitlab_import, prepared, config.create_jobs,
+                 "migrate")
 
-        try:
-            repo.begin_gitlab_import()
-        except Exception as e:
-            print("Failed to migrate %s to %s: '%s'" % (url_fdo, url_gitlab, e))
-            traceback.print_exc()
-            continue
+        wait_for_imports(config, repos)
 
-    all_imported = False
-    while not all_imported:
-        time.sleep(2)
-        all_imported = True
+        print("SUCCESSFULLY MIGRATED:")
+        print("")
+        print("")
         for repo in repos:
-            if repo.project and not repo.imported:
-                repo.imported = repo.get_import_status()
-                if not repo.imported:
-                    all_imported = False
+            if repo.imported:
+                print("%s -> %s" % (repo.url_fdo, repo.url_gitlab))
 
-    print("SUCCESSFULLY MIGRATED:")
-    print("")
-    print("")
-    for repo in repos:
-        if repo.project:
-            print("%s -> %s" % (repo.url_fdo, repo.url_gitlab))
-
-    print("")
-    print("")
-    print("")
-    print("FAILED MIGRATION:")
-    for repo in repos:
-        if not repo.project:
+        print("")
+        print("")
+        print("")
+        print("STILL IMPORTING:")
+        for repo in repos:
+            if repo.pending():
+                print("%s -> %s" % (repo.url_fdo, repo.url_gitlab))
+
+        print("")
+        print("")
+        print("")
+        print("FAILED MIGRATION:")
+        failed = [repo for repo in repos
+                  if not repo.project or repo.import_status == "failed"]
+        for repo in failed:
             print("%s -> %s" % (repo.url_fdo, repo.url_gitlab))
-            repo.rollback_repo_kemper()
+        if config.ssh_batch:
+            run_kemper_batch(config, failed, Repo.rollback_kemper_cmd,
+                             "roll back")
+        else:
+            run_jobs(Repo.rollback_repo_kemper, failed, config.ssh_jobs,
+                     "roll back")
+    finally:
+        config.stop_ssh_master()
 
     print("")
     print("")
@@ -25,6 +25,9 @@ setup(
     packages=['bztogl'],
     entry_points={
         'console_scripts': ['bztogl=bztogl.bztogl:main',
+                            'bztogl-replay=bztogl.replay:main',
+                            'bztogl-import-archive='
+                            'bztogl.replay:import_archive_main',
                             'phabtogl=bztogl.phabtogl:main'],
     },
 
@@ -0,0 +1,76 @@
+import io
+import json
+import tarfile
+
+from bztogl import archive, common
+
+
+def _target(path):
+    target = archive.ArchiveTarget(archive.ArchiveWriter(path),
+                                   'https://gitlab.example.com/', None,
+                                   'token', 'zenity', 'GNOME/zenity')
+    target.all_users = [common.DirectoryUser('jsparks', 7, 'J. Sparks',
+                                             'jsparks@example.com')]
+    return target
+
+
+def _read(tar, name):
+    return [json.loads(line) for line in
+            tar.extractfile(name).read().decode('utf-8').splitlines()]
+
+
+def test_issues_are_archived(tmp_path):
+    path = str(tmp_path / 'zenity.tar.gz')
+    target = _target(path)
+
+    upload = target.upload_file('screenshot.png', io.BytesIO(b'png'))
+    assert upload['markdown'].startswith('![screenshot.png](/uploads/')
+
+    issue = target.create_issue(1, 'Crash', 'It crashes ' + upload['markdown'],
+                                ['bugzilla', '1. Crash'], '3.30',
+                                '2017-01-01 00:00:00', assignee_id=7,
+                                confidential=True)
+    issue.notes.create({'body': 'Me too', 'created_at': '2017-01-02'})
+    target.finish_issue(issue, 'close')
+
+    issue = target.create_issue(2, 'Typo', 'Typo', ['bugzilla'], '3.30',
+                                '2017-01-03 00:00:00')
+    target.finish_issue(issue, 'reopen')
+    target.close()
+
+    with tarfile.open(path) as tar:
+        names = tar.getnames()
+        assert tar.extractfile('VERSION').read() == b'0.2.4'
+        issues = _read(tar, 'tree/project/issues.ndjson')
+        labels = _read(tar, 'tree/project/labels.ndjson')
+        milestones = _read(tar, 'tree/project/milestones.ndjson')
+        members = _read(tar, 'tree/project/project_members.ndjson')
+
+    assert [(i['iid'], i['state']) for i in issues] == \
+        [(1, 'closed'), (2, 'opened')]
+    assert [i['confidential'] for i in issues] == [True, False]
+    assert issues[0]['notes'][0]['note'] == 'Me too'
+    assert issues[0]['issue_assignees'] == [{'user_id': 7}]
+    assert issues[0]['milestone']['title'] == '3.30'
+    assert [link['label']['title'] for link in issues[0]['label_links']] == \
+        ['bugzilla', '1. Crash']
+    assert sorted(label['title'] for label in labels) == \
+        ['1. Crash', 'bugzilla']
+    assert [m['title'] for m in milestones] == ['3.30']
+    assert members[0]['user']['email'] == 'jsparks@example.com'
+
+    url = issues[0]['description'].split('(', 1)[1].rstrip(')')
+    assert url.lstrip('/') in names
+
+
+def test_bugzilla_attachments_are_embedded(tmp_path):
+    path = str(tmp_path / 'zenity.tar.gz')
+    target = _target(path)
+
+    class Bugzilla:
+        def openattachment(self, atid):
+            return io.BytesIO(b'log')
+
+    upload = target.upload_bugzilla_attachment(Bugzilla(), 3, 'log.txt')
+    assert upload['markdown'].startswith('[log.txt](/uploads/')
+    target.close()
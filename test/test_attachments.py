@@ -0,0 +1,50 @@
+from unittest import mock
+
+from bztogl import attachments, bztogl
+
+BZURL = 'https://bugzilla.gnome.org'
+
+
+def _metadata(**kwargs):
+    metadata = {'file_name': 'core.gz', 'summary': 'core dump',
+                'content_type': 'application/gzip', 'size': 1000,
+                'is_patch': False, 'is_obsolete': False}
+    metadata.update(kwargs)
+    return metadata
+
+
+def test_decide():
+    policy = attachments.AttachmentPolicy(
+        max_size=100, obsolete=attachments.SKIP,
+        deny=['application/*'])
+    assert policy.decide(_metadata(size=10, content_type='text/plain')) == \
+        attachments.UPLOAD
+    assert policy.decide(_metadata(size=1000,
+                                   content_type='text/plain')) == \
+        attachments.LINK
+    assert policy.decide(_metadata(size=10)) == attachments.LINK
+    assert policy.decide(_metadata(is_obsolete=True)) == attachments.SKIP
+
+    policy = attachments.AttachmentPolicy(allow=['image/*', 'text/plain'])
+    assert policy.decide(_metadata(content_type='image/png')) == \
+        attachments.UPLOAD
+    assert policy.decide(_metadata()) == attachments.LINK
+    assert attachments.AttachmentPolicy().decide(_metadata()) == \
+        attachments.UPLOAD
+
+
+def test_linked_attachments_are_not_transferred():
+    target = mock.Mock()
+    policy = attachments.AttachmentPolicy(max_size=100)
+    comment = {'attachment_id': 12}
+
+    markdown = bztogl.migrate_attachment(None, BZURL, target, comment,
+                                         {12: _metadata()}, policy)
+    assert '[core.gz]({}/attachment.cgi?id=12)'.format(BZURL) in markdown
+    assert not target.upload_bugzilla_attachment.called
+
+    policy = attachments.AttachmentPolicy(obsolete=attachments.SKIP)
+    assert bztogl.migrate_attachment(None, BZURL, target, comment,
+                                     {12: _metadata(is_obsolete=True)},
+                                     policy) == ''
+    assert not target.upload_bugzilla_attachment.called
@@ -0,0 +1,34 @@
+import io
+import threading
+import time
+
+from bztogl import buffers
+
+
+def test_budget_limits_concurrent_transfers():
+    budget = buffers.MemoryBudget(100)
+    peak = []
+    lock = threading.Lock()
+
+    def transfer(size):
+        with budget.reserve(size):
+            with lock:
+                peak.append(budget.used)
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=transfer, args=(size,))
+               for size in (60, 60, 30, 500)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) <= 100
+    assert budget.used == 0
+
+
+def test_spill_buffer():
+    with buffers.spill_buffer(spill_size=4) as f:
+        assert buffers.copy(io.BytesIO(b'0123456789'), f) == 10
+        f.seek(0)
+        assert f.read() == b'0123456789'
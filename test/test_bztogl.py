@@ -1,4 +1,6 @@
+import argparse
 import collections
+from unittest import mock
 
 from bztogl import bztogl, users
 
@@ -56,6 +58,39 @@ def test_close_bug():
     bztogl.close_bug("GNOME", bug, issue, "OBSOLETE")
 
 
+def test_queries_only_read_fields():
+    bgo = mock.Mock()
+    bgo.build_query.side_effect = lambda **kwargs: dict(kwargs)
+    bgo.query.return_value = []
+
+    bztogl.query_open_bugs(bgo, 'zenity', None)
+    query, = bgo.query.call_args[0]
+    assert query['include_fields'] is bztogl.BUG_FIELDS
+    bztogl.query_changed_bugs(bgo, 'zenity', None, '2017-01-01')
+    query, = bgo.query.call_args[0]
+    assert query['include_fields'] is bztogl.BUG_FIELDS
+
+
+@mock.patch.object(bztogl, 'processbug')
+@mock.patch.object(bztogl, 'warm_caches')
+@mock.patch.object(bztogl.users, 'UserCache')
+@mock.patch.object(bztogl.milestones, 'MilestoneCache')
+def test_shards_skip_closed_bugs(milestone_cache, user_cache, warm_caches,
+                                 processbug, tmp_path):
+    warm_caches.return_value = {'gitlab_emails': {}, 'labels': [],
+                                'milestones': {}}
+    bzbugs = [mock.Mock(id=1, status='NEW'),
+              mock.Mock(id=2, status='RESOLVED')]
+    args = argparse.Namespace(shards_db=str(tmp_path / 'leases.db'),
+                              lease_time=60, worker_id='a', shards=2,
+                              product='zenity')
+
+    bztogl.migrate_shards(args, None, None, None, None, mock.Mock(labels={}),
+                          bzbugs, None, None)
+    migrated, = processbug.call_args_list
+    assert migrated[0][7] is bzbugs[0]
+
+
 class Bugzilla:
 
     def __init__(self):
@@ -109,6 +144,9 @@ class Gitlab:
         issue.description = args[2]
         return issue
 
+    def finish_issue(self, issue, state_event):
+        issue.save(state_event=state_event)
+
 
 class Issue:
 
@@ -0,0 +1,228 @@
+import http.server
+import json
+import os
+import re
+import threading
+import time
+from unittest import mock
+
+import gitlab
+import pytest
+
+from bztogl import common
+
+GITLAB_URL = 'https://gitlab.example.com/'
+
+
+def _gitlab_user(id, username=None, email=None):
+    user = mock.Mock(spec=['id', 'username', 'name', 'email'])
+    user.id = id
+    user.username = username or 'user{}'.format(id)
+    # mock.Mock() takes name= for itself
+    user.name = 'User {}'.format(id)
+    user.email = email or 'user{}@example.com'.format(id)
+    return user
+
+
+def _target(count, users_directory=None):
+    target = common.GitLab(GITLAB_URL, None, 'token', 'zenity',
+                           users_directory=users_directory)
+    users = [_gitlab_user(i) for i in range(count)]
+    target.gl = mock.Mock()
+    target.gl.users.list.side_effect = lambda page, per_page: \
+        users[(page - 1) * per_page:page * per_page]
+    return target
+
+
+def test_users_are_paged():
+    target = _target(common.USERS_PAGE_SIZE * 2 + 1)
+
+    users = target.get_all_users()
+    assert len(users) == common.USERS_PAGE_SIZE * 2 + 1
+    assert target.gl.users.list.call_count == 3
+    user = target.find_user_by_nick('user42')
+    assert isinstance(user, common.DirectoryUser)
+    assert (user.id, user.email) == (42, 'user42@example.com')
+    assert target.all_users_emails['user7@example.com'].id == 7
+
+    target.get_all_users()
+    assert target.gl.users.list.call_count == 3
+
+
+def test_users_directory_is_reused(tmp_path):
+    path = str(tmp_path / 'users.json')
+    _target(3, path).get_all_users()
+
+    target = _target(3, path)
+    assert target.find_user_by_nick('user2').id == 2
+    assert not target.gl.users.list.called
+
+    stale = time.time() - common.USERS_DIRECTORY_MAX_AGE - 1
+    os.utime(path, (stale, stale))
+    target = _target(3, path)
+    assert target.find_user_by_nick('user2').id == 2
+    assert target.gl.users.list.called
+
+
+def test_provisioned_users_are_saved(tmp_path):
+    path = str(tmp_path / 'users.json')
+    target = _target(1, path)
+    target.create_user = mock.Mock(
+        side_effect=lambda nick: _gitlab_user(100, nick))
+
+    target.provision_users(['user0', 'newbie'])
+    target.create_user.assert_called_once_with('newbie')
+
+    target = _target(1, path)
+    assert target.find_user_by_nick('newbie').id == 100
+
+
+def test_issue_is_created_in_one_request():
+    target = _target(0)
+    project = target.get_project()
+    issue = project.issues.create.return_value
+
+    target.create_issue(1, 'title', 'desc', None, None, '2017-01-01',
+                        assignee_id=7, confidential=True)
+    target.finish_issue(issue, 'reopen')
+
+    project.issues.create.assert_called_once_with({
+        'title': 'title',
+        'description': 'desc',
+        'labels': None,
+        'created_at': '2017-01-01',
+        'assignee_ids': [7],
+        'confidential': True,
+    }, sudo=None)
+    assert not issue.save.called
+
+    target.finish_issue(issue, 'close')
+    issue.save.assert_called_once_with(state_event='close')
+
+
+class GraphQLHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for the GitLab GraphQL endpoint, answering the aliased
+    lookups the GraphQL client sends"""
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        request = json.loads(self.rfile.read(length).decode('utf-8'))
+        self.server.requests.append(request)
+
+        data = {}
+        for alias, field in re.findall(r'(q\d+): (\w+)\(', request['query']):
+            arguments = {name[len(alias) + 1:]: value
+                         for name, value in request['variables'].items()
+                         if name.startswith(alias + '_')}
+            data[alias] = self.server.resolve(field, arguments)
+        if 'project(fullPath: $project)' in request['query']:
+            data = {'project': data}
+
+        body = json.dumps({'data': data}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _resolve(field, arguments):
+    if field == 'user':
+        id = int(arguments['id'].rsplit('/', 1)[1])
+        if id > 2:
+            return None
+        return {'username': 'user{}'.format(id), 'name': 'User {}'.format(id),
+                'publicEmail': ''}
+    if field in ('issues', 'mergeRequests'):
+        nodes = [{'iid': '1'}] if arguments['search'] == 'Crash' else []
+        return {'nodes': nodes}
+    if field == 'label':
+        return {'title': 'bugzilla'} if arguments['title'] == 'bugzilla' \
+            else None
+    raise Exception("Unknown field " + field)
+
+
+@pytest.fixture
+def graphql_server():
+    server = http.server.HTTPServer(('127.0.0.1', 0), GraphQLHandler)
+    server.requests = []
+    server.resolve = _resolve
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def _graphql_target(server, batch):
+    target = common.GitLab('http://127.0.0.1:{}/'.format(server.server_port),
+                           None, 'token', 'zenity', 'test/zenity')
+    target.gl = mock.Mock()
+    target.enable_graphql(batch)
+    return target
+
+
+def test_rest_lookups_return_iids():
+    target = _target(0)
+    project = target.get_project()
+    project.issues.list.side_effect = lambda search, created_after: \
+        [mock.Mock(iid=1)] if search == 'Crash' else []
+    project.mergerequests.list.return_value = [mock.Mock(iid=3)]
+
+    items = [('Crash', '2017-01-01 00:00:00'), ('Typo', '2017-01-01 00:00:00')]
+    assert target.find_issues(items) == {items[0]: [1], items[1]: []}
+    assert target.find_patches(items[:1]) == {items[0]: [3]}
+
+
+def test_graphql_lookups_are_batched(graphql_server):
+    target = _graphql_target(graphql_server, 2)
+
+    users = target.find_users([1, 2, 3])
+    assert len(graphql_server.requests) == 2
+    assert (users[1].username, users[1].name) == ('user1', 'User 1')
+    assert users[1].email is None
+    assert users[3] is None
+
+    issues = target.find_issues([('Crash', '2017-01-01 00:00:00'),
+                                 ('Typo', '2017-01-01 00:00:00')])
+    assert issues == {('Crash', '2017-01-01 00:00:00'): [1],
+                      ('Typo', '2017-01-01 00:00:00'): []}
+    request = graphql_server.requests[-1]
+    assert request['variables']['project'] == 'test/zenity'
+    assert request['variables']['q1_search'] == 'Typo'
+    assert not target.gl.method_calls
+
+
+def _get_user(id):
+    if id > 2:
+        raise gitlab.GitlabGetError('404 User Not Found', 404)
+    return _gitlab_user(id)
+
+
+@pytest.mark.parametrize('batch', [None, 10])
+def test_unknown_users_are_none(graphql_server, batch):
+    if batch is None:
+        target = _target(0)
+        target.gl.users.get.side_effect = _get_user
+    else:
+        target = _graphql_target(graphql_server, batch)
+
+    users = target.find_users([1, 3])
+    assert users[1].username == 'user1'
+    assert users[3] is None
+
+
+def test_existing_labels_are_not_created(graphql_server):
+    target = _graphql_target(graphql_server, 10)
+
+    target.create_labels(['bugzilla', '1. Crash'])
+    target.get_project().labels.create.assert_called_once_with(
+        {'name': '1. Crash', 'color': '#428BCA'})
+    assert len(graphql_server.requests) == 1
+
+    target.create_labels(['bugzilla', '1. Crash'])
+    assert len(graphql_server.requests) == 1
@@ -0,0 +1,88 @@
+import gzip
+import os
+from unittest import mock
+
+import phabricator
+
+from bztogl import conduit
+
+PROJECTS = [
+    {'phid': 'PHID-PROJ-1', 'fields': {'name': 'efl'}},
+    {'phid': 'PHID-PROJ-2', 'fields': {'name': 'Spam'}},
+]
+
+
+def _live():
+    live = mock.Mock()
+    live.maniphest.gettasktransactions.side_effect = \
+        lambda ids: phabricator.Result(
+            {str(i): [{'taskID': str(i)}] for i in ids})
+    live.project.search.side_effect = \
+        lambda limit, constraints: phabricator.Result({
+            'data': [p for p in PROJECTS
+                     if p['phid'] in constraints['phids']],
+            'cursor': {'after': None}})
+    live.differential.getrawdiff.side_effect = \
+        lambda diffID: phabricator.Result('diff ' + diffID)
+    return live
+
+
+def _record(path):
+    recorder = conduit.RecordingConduit(_live(), path)
+    recorder.maniphest.gettasktransactions(ids=[1, 2, 3])
+    recorder.project.search(
+        limit=100, constraints={'phids': ['PHID-PROJ-1', 'PHID-PROJ-2']})
+    assert recorder.differential.getrawdiff(diffID='7').response == 'diff 7'
+    recorder.close()
+
+
+def test_snapshot_replays_recorded_calls(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    _record(path)
+    live = mock.Mock()
+    snapshot = conduit.SnapshotConduit(path, lambda: live)
+
+    assert snapshot.differential.getrawdiff(diffID='7').response == 'diff 7'
+    result = snapshot.maniphest.gettasktransactions(ids=[1, 2, 3])
+    assert sorted(result.keys()) == ['1', '2', '3']
+    assert not live.method_calls
+
+
+def test_snapshot_answers_subsets(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    _record(path)
+    live = mock.Mock()
+    snapshot = conduit.SnapshotConduit(path, lambda: live)
+
+    result = snapshot.maniphest.gettasktransactions(ids=[3, 1])
+    assert dict(result) == {'3': [{'taskID': '3'}], '1': [{'taskID': '1'}]}
+    projects = snapshot.project.search(
+        limit=100, constraints={'phids': ['PHID-PROJ-2']})
+    assert projects.data == [PROJECTS[1]]
+    assert not live.method_calls
+
+
+def test_snapshot_falls_back_to_live(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    _record(path)
+    live = _live()
+    snapshot = conduit.SnapshotConduit(path, lambda: live)
+
+    snapshot.maniphest.gettasktransactions(ids=[4])
+    live.maniphest.gettasktransactions.assert_called_once_with(ids=[4])
+    snapshot.maniphest.update(id=1, status='resolved')
+    live.maniphest.update.assert_called_once_with(id=1, status='resolved')
+
+
+def test_exporting_again_replaces_the_snapshot(tmp_path):
+    path = str(tmp_path / 'snapshot')
+    _record(path)
+    recorder = conduit.RecordingConduit(_live(), path)
+    recorder.maniphest.gettasktransactions(ids=[1, 2, 3])
+    recorder.close()
+
+    with gzip.open(os.path.join(path, conduit.TRANSACTIONS_METHOD +
+                                '.jsonl.gz'), 'rt') as f:
+        assert len(f.readlines()) == 1
+    assert sorted(os.listdir(path)) == [conduit.TRANSACTIONS_METHOD +
+                                        '.jsonl.gz']
@@ -0,0 +1,501 @@
+import argparse
+import base64
+import os
+from unittest import mock
+
+import phabricator
+
+from bztogl import phabtogl
+
+
+def _project(phid, name, parent=None):
+    return {'phid': phid,
+            'fields': {'name': name, 'slug': name.lower(),
+                       'color': {'key': 'blue'}, 'milestone': None,
+                       'parent': parent}}
+
+
+def _task(id, projects=('PHID-PROJ-efl',)):
+    return {'id': str(id), 'phid': 'PHID-TASK-%d' % id,
+            'title': 'Task %d' % id, 'description': '',
+            'authorPHID': 'PHID-USER-%d' % (id % 3),
+            'ownerPHID': None, 'ccPHIDs': [], 'priority': 'Normal',
+            'isClosed': False, 'projectPHIDs': list(projects),
+            'dependsOnTaskPHIDs': [], 'uri': '', 'dateCreated': '1500000000'}
+
+
+def _revision(id):
+    return {'id': str(id), 'phid': 'PHID-DREV-%d' % id,
+            'title': 'Revision %d' % id, 'summary': '',
+            'authorPHID': 'PHID-USER-1', 'ccs': [], 'reviewers': {},
+            'diffs': [str(100 + id)], 'commits': [], 'statusName': 'Closed',
+            'uri': '', 'dateCreated': '1500000000',
+            'auxiliary': {'phabricator:projects': ['PHID-PROJ-efl'],
+                          'phabricator:depends-on': []}}
+
+
+class FakeConduit:
+    """In-memory Conduit serving the calls Phab makes, recording them"""
+
+    def __init__(self, tasks=(), revisions=(), projects=(), users=3):
+        self.tasks = list(tasks)
+        self.revisions = list(revisions)
+        self.projects = [_project('PHID-PROJ-efl', 'efl')] + list(projects)
+        self.users = [{'phid': 'PHID-USER-%d' % i, 'userName': 'user%d' % i,
+                       'realName': 'User %d' % i} for i in range(users)]
+        self.calls = []
+        # Task ID -> its transactions
+        self.transactions = {}
+        # gettasktransactions calls failing before the next one succeeds
+        self.transaction_failures = 0
+
+        self.maniphest = mock.Mock()
+        self.maniphest.query.side_effect = self._maniphest_query
+        self.maniphest.gettasktransactions.side_effect = \
+            self._gettasktransactions
+        self.project = mock.Mock()
+        self.project.search.side_effect = self._project_search
+        self.user = mock.Mock()
+        self.user.search.side_effect = self._user_search
+        self.differential = mock.Mock()
+        self.differential.query.side_effect = self._differential_query
+        self.differential.getrawdiff.side_effect = self._getrawdiff
+        self.phid = mock.Mock()
+        self.phid.query.side_effect = self._phid_query
+        self.file = mock.Mock()
+        self.file.info.side_effect = self._file_info
+        self.file.download.side_effect = self._file_download
+
+    def _page(self, entries, limit, offset):
+        return entries[offset:offset + limit]
+
+    def _maniphest_query(self, limit, offset, order, projectPHIDs):
+        self.calls.append(('maniphest.query', offset))
+        tasks = [t for t in self.tasks
+                 if set(t['projectPHIDs']) & set(projectPHIDs)]
+        page = self._page(tasks, limit, offset)
+        return phabricator.Result({t['phid']: t for t in page} or [])
+
+    def _gettasktransactions(self, ids):
+        self.calls.append(('maniphest.gettasktransactions', tuple(ids)))
+        if self.transaction_failures:
+            self.transaction_failures -= 1
+            raise phabricator.APIError('ERR-CONDUIT-CORE', 'Timed out')
+        return phabricator.Result({str(i): self.transactions.get(i, [])
+                                   for i in ids})
+
+    def _project_search(self, limit, constraints, after=None):
+        self.calls.append(('project.search', after))
+        projects = self.projects
+        if 'phids' in constraints:
+            projects = [p for p in projects
+                        if p['phid'] in constraints['phids']]
+        elif 'ancestors' in constraints:
+            projects = []
+        start = int(after or 0)
+        page = projects[start:start + limit]
+        more = start + limit < len(projects)
+        return phabricator.Result({
+            'data': page,
+            'cursor': {'after': str(start + limit) if more else None}})
+
+    def _user_search(self, limit, constraints):
+        phids = constraints['phids']
+        self.calls.append(('user.search', tuple(phids)))
+        assert len(phids) <= limit
+        return phabricator.Result({
+            'data': [{'phid': u['phid'],
+                      'fields': {'username': u['userName'],
+                                 'realName': u['realName']}}
+                     for u in self.users if u['phid'] in phids],
+            'cursor': {'after': None}})
+
+    def _differential_query(self, limit, offset, order, paths):
+        self.calls.append(('differential.query', offset))
+        return phabricator.Result(self._page(self.revisions, limit, offset))
+
+    def _file_info(self, id):
+        self.calls.append(('file.info', id))
+        if id == 404:
+            raise phabricator.APIError('ERR-CONDUIT-CORE', 'No such file')
+        return phabricator.Result({'phid': 'PHID-FILE-%d' % id,
+                                   'name': 'file%d.png' % id})
+
+    def _file_download(self, phid):
+        self.calls.append(('file.download', phid))
+        data = ('contents of ' + phid).encode('utf-8') * 1000
+        return phabricator.Result(base64.b64encode(data).decode('ascii'))
+
+    def _phid_query(self, phids):
+        self.calls.append(('phid.query', tuple(phids)))
+        return phabricator.Result({
+            phid: {'fullName': 'rEFL%s: Commit' % phid[-1]} for phid in phids
+            if not phid.endswith('-deleted')})
+
+    def _getrawdiff(self, diffID):
+        self.calls.append(('differential.getrawdiff', diffID))
+        return phabricator.Result('diff ' + diffID)
+
+
+def _options(**kwargs):
+    options = argparse.Namespace(projects=['efl'], callsigns=['EFL'],
+                                 start_at=None, rev_start_at=None,
+                                 page_size=100, snapshot=None,
+                                 export_snapshot=None, fetch_jobs=2,
+                                 transaction_batch=100, cache_dir=None)
+    vars(options).update(kwargs)
+    return options
+
+
+def make_phab(conduit, **kwargs):
+    with mock.patch.object(phabtogl.Phab, 'live_phabricator', conduit):
+        return phabtogl.Phab(_options(**kwargs), None)
+
+
+def test_tasks_are_fetched_page_by_page():
+    conduit = FakeConduit(tasks=[_task(i) for i in range(1, 8)])
+
+    phab = make_phab(conduit, page_size=3)
+
+    assert list(phab.tasks) == list(range(1, 8))
+    assert [c for c in conduit.calls if c[0] == 'maniphest.query'] == \
+        [('maniphest.query', 0), ('maniphest.query', 3),
+         ('maniphest.query', 6)]
+
+
+def test_revisions_are_fetched_page_by_page():
+    conduit = FakeConduit(revisions=[_revision(i) for i in range(1, 5)])
+
+    phab = make_phab(conduit, page_size=2)
+
+    assert list(phab.revisions) == [1, 2, 3, 4]
+    assert phab.revisions[1].diff == 'diff 101'
+    assert [c for c in conduit.calls if c[0] == 'differential.query'] == \
+        [('differential.query', 0), ('differential.query', 2),
+         ('differential.query', 4)]
+
+
+def test_project_search_follows_cursor():
+    projects = [_project('PHID-PROJ-%d' % i, 'other%d' % i)
+                for i in range(4)]
+    conduit = FakeConduit(projects=projects)
+
+    phab = make_phab(conduit, page_size=2)
+
+    found = list(phab.search(conduit.project.search, constraints={}))
+    assert len(found) == 5
+
+
+def test_only_referenced_users_are_fetched():
+    conduit = FakeConduit(tasks=[_task(1), _task(2)],
+                          revisions=[_revision(1)], users=250)
+
+    phab = make_phab(conduit)
+
+    assert sorted(phab.users) == ['PHID-USER-1', 'PHID-USER-2']
+    assert phab.users['PHID-USER-2'].username == 'user2'
+    # Revision authors were already known from the tasks
+    assert [c for c in conduit.calls if c[0] == 'user.search'] == \
+        [('user.search', ('PHID-USER-1', 'PHID-USER-2'))]
+
+
+def test_user_lookups_are_batched():
+    conduit = FakeConduit(users=250)
+    phab = make_phab(conduit)
+
+    phab.retrieve_all_users(['PHID-USER-%d' % i for i in range(250)] +
+                            ['PHID-APPS-herald', None, 'PHID-USER-nobody'])
+
+    assert len(phab.users) == 250
+    assert phab.unknown_users == {'PHID-USER-nobody'}
+    assert len([c for c in conduit.calls if c[0] == 'user.search']) == 3
+    phab.retrieve_all_users(['PHID-USER-1', 'PHID-USER-nobody'])
+    assert len([c for c in conduit.calls if c[0] == 'user.search']) == 3
+
+
+def _comment(task_id, date, text):
+    return {'taskID': str(task_id), 'authorPHID': 'PHID-USER-1',
+            'transactionType': 'core:comment', 'dateCreated': date,
+            'comments': text}
+
+
+def test_transactions_are_fetched_in_batches():
+    conduit = FakeConduit(tasks=[_task(i) for i in range(1, 8)])
+    conduit.transactions = {
+        i: [_comment(i, '2', 'second'), _comment(i, '1', 'first')]
+        for i in range(1, 8)}
+    conduit.transactions[4].append(_comment(4, '3', ''))
+
+    phab = make_phab(conduit, transaction_batch=3)
+
+    assert sorted(c[1] for c in conduit.calls
+                  if c[0] == 'maniphest.gettasktransactions') == \
+        [(1, 2, 3), (4, 5, 6), (7,)]
+    assert [c['comments'] for c in phab.tasks[4].entry['comments']] == \
+        ['first', 'second']
+
+
+@mock.patch.object(phabtogl, 'TRANSACTION_RETRY_DELAY', 0)
+def test_transaction_batches_are_retried():
+    conduit = FakeConduit(tasks=[_task(i) for i in range(1, 3)])
+    conduit.transactions = {2: [_comment(2, '1', 'first')]}
+    conduit.transaction_failures = phabtogl.TRANSACTION_ATTEMPTS - 1
+
+    phab = make_phab(conduit)
+
+    assert len([c for c in conduit.calls
+                if c[0] == 'maniphest.gettasktransactions']) == \
+        phabtogl.TRANSACTION_ATTEMPTS
+    assert phab.tasks[2].entry['comments'][0]['comments'] == 'first'
+
+
+def _diff_calls(conduit):
+    return sorted(c[1] for c in conduit.calls
+                  if c[0] == 'differential.getrawdiff')
+
+
+def test_only_imported_diffs_are_fetched():
+    conduit = FakeConduit(revisions=[_revision(i) for i in range(1, 5)])
+
+    phab = make_phab(conduit, rev_start_at=3)
+
+    assert [r.diff for r in phab.revisions.values()] == ['diff 103',
+                                                         'diff 104']
+    assert _diff_calls(conduit) == ['103', '104']
+
+
+def test_diffs_are_cached_on_disk(tmp_path):
+    revisions = [_revision(i) for i in range(1, 3)]
+    conduit = FakeConduit(revisions=revisions)
+    phab = make_phab(conduit, cache_dir=str(tmp_path))
+    phab.diffs.close()
+    assert _diff_calls(conduit) == ['101', '102']
+
+    conduit = FakeConduit(revisions=revisions)
+    phab = make_phab(conduit, cache_dir=str(tmp_path))
+    assert phab.revisions[2].diff == 'diff 102'
+    assert _diff_calls(conduit) == []
+
+
+def test_projects_are_resolved_once_for_all_pages():
+    projects = [_project('PHID-PROJ-%d' % i, 'other%d' % i)
+                for i in range(3)] + [_project('PHID-PROJ-spam', 'Spam')]
+    tasks = [_task(1, ['PHID-PROJ-efl', 'PHID-PROJ-0']),
+             _task(2, ['PHID-PROJ-efl', 'PHID-PROJ-1']),
+             _task(3, ['PHID-PROJ-efl', 'PHID-PROJ-spam'])]
+    revision = _revision(1)
+    revision['auxiliary']['phabricator:projects'].append('PHID-PROJ-2')
+    conduit = FakeConduit(tasks=tasks, revisions=[revision],
+                          projects=projects)
+
+    phab = make_phab(conduit)
+
+    assert list(phab.tasks) == [1, 2]
+    assert 'PHID-PROJ-1' in phab.tasks[2].projects
+    assert 'PHID-PROJ-2' in phab.revisions[1].projects
+    # One search for the base project, one for its subprojects, then one
+    # for what all the pages of tasks and revisions refer to
+    assert len([c for c in conduit.calls if c[0] == 'project.search']) == 3
+
+
+def test_task_pages_are_evaluated_one_at_a_time():
+    # All by the same author, users are searched 2 at a time too
+    conduit = FakeConduit(tasks=[_task(i) for i in range(3, 18, 3)])
+    gitlab = mock.Mock()
+    gitlab.find_issues.side_effect = \
+        lambda items: {item: item[0] == 'Task 12' for item in items}
+    gitlab.find_patches.return_value = {}
+
+    with mock.patch.object(phabtogl.Phab, 'live_phabricator', conduit):
+        phab = phabtogl.Phab(_options(page_size=2), gitlab)
+
+    assert list(phab.tasks) == [3, 6, 9, 15]
+    assert [len(c[0][0]) for c in gitlab.find_issues.call_args_list] == \
+        [2, 2, 1]
+
+
+class GitLab:
+    def __init__(self):
+        self.uploads = []
+
+    def upload_file(self, filename, f):
+        self.uploads.append((filename, f.read()))
+        return {'markdown': '![%s](/uploads/%s)' % (filename, filename)}
+
+
+def test_files_are_migrated_once():
+    conduit = FakeConduit()
+    phab = make_phab(conduit)
+    phab.gitlab = GitLab()
+
+    markdown = phab.escape_markdown('See {F1} and {F2}, {F1} again')
+    assert markdown == ('See ![file1.png](/uploads/file1.png) and '
+                        '![file2.png](/uploads/file2.png), '
+                        '![file1.png](/uploads/file1.png) again')
+    markdown = phab.escape_markdown('Also {F2}, but not {F404}')
+    assert markdown == 'Also ![file2.png](/uploads/file2.png), but not {F404}'
+
+    assert sorted(name for name, data in phab.gitlab.uploads) == \
+        ['file1.png', 'file2.png']
+    assert (b'contents of PHID-FILE-1' * 1000) in \
+        [data for name, data in phab.gitlab.uploads]
+    assert len([c for c in conduit.calls if c[0] == 'file.info']) == 3
+
+
+@mock.patch.object(phabtogl.buffers, 'BUDGET')
+def test_attachment_budget_covers_base64_and_decoded_data(budget):
+    conduit = FakeConduit()
+    conduit.file.info.side_effect = lambda id: phabricator.Result(
+        {'phid': 'PHID-FILE-1', 'name': 'file1.png', 'byteSize': '30000000'})
+    phab = make_phab(conduit)
+    phab.gitlab = GitLab()
+
+    phab.migrate_attachment('1')
+    budget.reserve.assert_called_once_with(
+        40000000 + phabtogl.buffers.SPILL_SIZE)
+
+
+class Issue:
+    def __init__(self, title):
+        self.attributes = {'title': title}
+        self.notes = mock.Mock()
+        self.web_url = ''
+
+    def get_id(self):
+        return 1
+
+    def save(self, state_event=None):
+        self.state_event = state_event
+
+
+class Target(phabtogl.PhabGitLab):
+    """PhabGitLab creating issues and users in memory"""
+
+    def __init__(self, fail=(), **kwargs):
+        super().__init__('https://gitlab.example.com/', None, 'token', 'efl',
+                         'test/efl', **kwargs)
+        self.all_users = []
+        self.issues = {}
+        self.created_users = []
+        self.provisioned = {}
+        self.fail = fail
+
+    def create_issue(self, id, summary, description, labels, milestone,
+                     creation_time, sudo=None, assignee_id=None):
+        if id in self.fail:
+            raise Exception("Could not create issue")
+        self.issues[id] = Issue(summary)
+        return self.issues[id]
+
+    def create_mergerequest(self, id, summary, description, labels,
+                            milestone, sudo=None):
+        return self.create_issue(id, summary, description, labels, milestone,
+                                 None)
+
+    def create_user(self, user_id):
+        self.created_users.append(user_id)
+        if user_id in self.fail:
+            raise Exception("Could not create user")
+        user = mock.Mock(spec=['id', 'username', 'name', 'email'])
+        user.id = len(self.created_users)
+        user.username = user_id
+        # mock.Mock() takes name= for itself
+        user.name = user_id.title()
+        user.email = None
+        self.provisioned[user_id] = user
+        return user
+
+
+def test_tasks_are_imported_in_parallel(tmp_path):
+    conduit = FakeConduit(tasks=[_task(i) for i in range(1, 21)])
+    phab = make_phab(conduit)
+
+    target = Target(import_jobs=4, journal_dir=str(tmp_path), fail=(7,))
+    target.import_tasks_from_phab(phab, None)
+
+    assert sorted(target.issues) == [i for i in range(1, 21) if i != 7]
+    assert sorted(target.created_users) == ['user0', 'user1', 'user2']
+
+    # Only the failed task is imported again
+    target = Target(import_jobs=4, journal_dir=str(tmp_path))
+    target.import_tasks_from_phab(phab, None)
+    assert list(target.issues) == [7]
+
+
+def test_journal_is_removed_with_the_project(tmp_path):
+    conduit = FakeConduit(tasks=[_task(i) for i in range(1, 4)])
+    phab = make_phab(conduit)
+    Target(journal_dir=str(tmp_path)).import_tasks_from_phab(phab, None)
+
+    target = Target(journal_dir=str(tmp_path))
+    target.remove_project(mock.Mock())
+    target.import_tasks_from_phab(phab, None)
+    assert sorted(target.issues) == [1, 2, 3]
+
+
+def test_archive_runs_are_not_journaled(tmp_path):
+    target = phabtogl.PhabArchiveTarget(
+        mock.Mock(), 'https://gitlab.example.com/', None, 'token', 'efl',
+        'test/efl', journal_dir=str(tmp_path))
+    target.journal('tasks').add(1)
+    assert not os.listdir(str(tmp_path))
+
+
+def test_revisions_are_imported_in_parallel():
+    revisions = [_revision(i) for i in range(1, 11)]
+    for i, revision in enumerate(revisions):
+        revision['commits'] = ['PHID-CMIT-%d' % i]
+    revisions[3]['statusName'] = 'Abandoned'
+    revisions[5]['commits'] = ['PHID-CMIT-deleted']
+    conduit = FakeConduit(revisions=revisions)
+    phab = make_phab(conduit)
+
+    target = Target(import_jobs=4)
+    target.import_revisions_from_phab(phab, None)
+
+    assert sorted(target.issues) == list(range(1, 11))
+    assert not target.issues[6].notes.create.called
+    assert target.issues[6].state_event == 'close'
+    issue = target.issues[1]
+    issue.notes.create.assert_called_once_with({'body': '0: Commit'})
+    assert issue.state_event == 'close'
+    assert not target.issues[4].notes.create.called
+    phid_queries = [c for c in conduit.calls if c[0] == 'phid.query']
+    assert len(phid_queries) == 1
+    assert 'PHID-CMIT-3' not in phid_queries[0][1]
+
+
+def test_revisions_without_reviewers_are_imported():
+    revisions = [_revision(1), _revision(2)]
+    # Conduit returns empty maps as lists
+    revisions[0]['reviewers'] = []
+    revisions[1]['reviewers'] = {'PHID-USER-2': 'PHID-USER-2'}
+    conduit = FakeConduit(revisions=revisions)
+    phab = make_phab(conduit)
+
+    target = Target()
+    target.import_revisions_from_phab(phab, None)
+
+    assert sorted(target.issues) == [1, 2]
+    assert sorted(target.created_users) == ['user1', 'user2']
+
+
+def test_users_are_provisioned_once():
+    tasks = [_task(i) for i in range(1, 10)]
+    for task in tasks:
+        task['ownerPHID'] = 'PHID-USER-0'
+    conduit = FakeConduit(tasks=tasks, revisions=[_revision(1)])
+    phab = make_phab(conduit)
+
+    target = Target(import_jobs=4, fail=('user1',))
+    target.all_users_map['user2'] = mock.Mock(id=42)
+    target.import_tasks_from_phab(phab, None)
+    target.import_revisions_from_phab(phab, None)
+
+    assert sorted(target.created_users) == ['user0', 'user1']
+    assert target.unprovisioned_users == {'user1'}
+    assert target.find_user_by_nick('user0').username == 'user0'
+    assert target.find_user_by_nick('user0').id == \
+        target.provisioned['user0'].id
+    assert target.find_user_by_nick('user1') is None
+    assert len(target.issues) == 9
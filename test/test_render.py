@@ -0,0 +1,46 @@
+import os
+
+from bztogl import bztogl, render, template
+
+BZURL = 'https://bugzilla.gnome.org'
+
+
+def _pids(texts):
+    return [(text, os.getpid()) for text in texts]
+
+
+def test_long_texts_are_rendered_in_a_process():
+    pool = render.RenderPool(1, threshold=10)
+    try:
+        results = pool.render(_pids, ['short', 'a rather long text', 'tiny'])
+    finally:
+        pool.close()
+
+    assert [text for text, pid in results] == \
+        ['short', 'a rather long text', 'tiny']
+    assert [pid == os.getpid() for text, pid in results] == \
+        [True, False, True]
+
+
+def test_without_jobs_everything_is_rendered_in_process():
+    results = render.RenderPool(threshold=1).render(_pids, ['a', 'b'])
+    assert results == [('a', os.getpid()), ('b', os.getpid())]
+
+
+def test_comments_render_the_same_in_a_process():
+    comments = [
+        {'text': 'See bug 123', 'creator': 'jsparks@src.gnome.org'},
+        {'text': 'Review of attachment 5:\n\n@@ -1 +1 @@\n-a\n+b',
+         'creator': 'jsparks@src.gnome.org'},
+    ]
+    expected = bztogl.render_comments(comments, BZURL, {})
+    assert expected[0][2] == template.autolink_texts(['See bug 123'],
+                                                     BZURL)[0]
+    assert expected[1][0] == 'mag'
+
+    pool = render.RenderPool(2, threshold=20)
+    try:
+        assert pool.render(bztogl.render_comments, comments, BZURL, {},
+                           size=bztogl.comment_size) == expected
+    finally:
+        pool.close()
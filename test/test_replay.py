@@ -0,0 +1,134 @@
+import json
+import threading
+import time
+
+from bztogl import common, replay, spool
+
+
+class Notes:
+    def __init__(self):
+        self.payloads = []
+
+    def create(self, payload, sudo=None):
+        self.payloads.append(payload)
+
+
+class Issue:
+    def __init__(self, title, description, assignee_id=None):
+        self.title = title
+        self.description = description
+        self.notes = Notes()
+        self.assignee_id = assignee_id
+        self.state_event = None
+        self.saves = 0
+        self.web_url = ''
+
+    def save(self, state_event=None):
+        self.state_event = state_event
+        self.saves += 1
+
+
+class Target:
+    finish_issue = common.GitLab.finish_issue
+
+    def __init__(self, fail=()):
+        self.issues = []
+        self.uploads = []
+        self.fail = fail
+
+    def create_issue(self, id, summary, description, labels, milestone,
+                     creation_time, sudo=None, assignee_id=None,
+                     confidential=False):
+        if id in self.fail:
+            raise Exception("Could not create issue")
+        issue = Issue(summary, description, assignee_id)
+        self.issues.append(issue)
+        return issue
+
+    def upload_file(self, filename, f):
+        self.uploads.append((filename, f.read()))
+        return {'markdown': '[{}](/uploads/x/{})'.format(filename, filename)}
+
+
+def _write_spool(path):
+    writer = spool.SpoolWriter(str(path))
+    target = spool.SpoolTarget(writer, 'https://gitlab.example.com/', None,
+                               'token', 'zenity', 'test/zenity')
+    for i in range(1, 6):
+        markdown = target.upload_file('{}.txt'.format(i), b'data')['markdown']
+        issue = target.create_issue(i, 'Issue {}'.format(i), markdown, [],
+                                    None, '2017-01-01', assignee_id=i)
+        issue.notes.create({'body': 'see ' + markdown})
+        target.finish_issue(issue, 'close' if i == 2 else 'reopen')
+    writer.close()
+
+
+def test_replay_resolves_uploads(tmp_path):
+    path = tmp_path / 'out.ndjson'
+    _write_spool(path)
+    target = Target()
+    checkpoint = replay.Checkpoint(str(tmp_path / 'checkpoint'))
+
+    failed = replay.Replayer(target, str(path), jobs=2).run(checkpoint)
+
+    assert failed == 0
+    assert sorted(i.title for i in target.issues) == \
+        ['Issue {}'.format(i) for i in range(1, 6)]
+    issue = next(i for i in target.issues if i.title == 'Issue 1')
+    assert issue.description == '[1.txt](/uploads/x/1.txt)'
+    assert issue.notes.payloads == [{'body': 'see [1.txt](/uploads/x/1.txt)'}]
+    assert issue.assignee_id == 1
+    # Issues are created open, only closing them needs another request
+    assert issue.saves == 0
+    issue = next(i for i in target.issues if i.title == 'Issue 2')
+    assert issue.state_event == 'close'
+    # Identical blobs are only uploaded once
+    assert len(target.uploads) == 1
+    assert checkpoint.offset == path.stat().st_size
+
+
+def test_replay_resumes_after_failure(tmp_path):
+    path = tmp_path / 'out.ndjson'
+    _write_spool(path)
+    checkpoint_path = str(tmp_path / 'checkpoint')
+
+    target = Target(fail=(3,))
+    failed = replay.Replayer(target, str(path), jobs=2).run(
+        replay.Checkpoint(checkpoint_path))
+    assert failed == 1
+    assert len(target.issues) == 4
+
+    with open(checkpoint_path) as f:
+        state = json.load(f)
+    assert 0 < state['offset'] < path.stat().st_size
+    assert len(state['done']) == 2
+
+    target = Target()
+    failed = replay.Replayer(target, str(path), jobs=2).run(
+        replay.Checkpoint(checkpoint_path))
+    assert failed == 0
+    assert [i.title for i in target.issues] == ['Issue 3']
+
+
+def test_concurrent_uploads_are_shared(tmp_path):
+    (tmp_path / 'out.ndjson.blobs').mkdir()
+    (tmp_path / 'out.ndjson.blobs' / 'blob').write_bytes(b'data')
+    target = Target()
+    upload_file = target.upload_file
+
+    def slow_upload_file(filename, f):
+        time.sleep(0.1)
+        return upload_file(filename, f)
+    target.upload_file = slow_upload_file
+
+    replayer = replay.Replayer(target, str(tmp_path / 'out.ndjson'))
+    replayer.uploads['key'] = {'blob': 'blob', 'filename': 'a.txt'}
+    threads = [threading.Thread(target=replayer.upload, args=('key',))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert target.uploads == [('a.txt', b'data')]
+    assert replayer.upload('key') == '[a.txt](/uploads/x/a.txt)'
@@ -0,0 +1,74 @@
+from unittest import mock
+
+from bztogl import shards
+
+
+def _bugs(*ids):
+    return [mock.Mock(id=i) for i in ids]
+
+
+def test_shard_ranges():
+    assert shards.shard_ranges([5, 1, 3, 9, 7], 2) == [(1, 5), (7, 9)]
+    assert shards.shard_ranges([1, 2], 4) == [(1, 1), (2, 2)]
+    assert shards.shard_ranges([], 4) == []
+
+
+def test_workers_claim_different_shards(tmp_path):
+    path = str(tmp_path / 'leases.db')
+    first = shards.LeaseTable(path)
+    second = shards.LeaseTable(path)
+    first.add_shards([(1, 5), (7, 9)])
+    second.add_shards([(1, 9)])
+
+    assert first.claim('a') == shards.Lease('shard-0', 1, 5)
+    assert second.claim('b') == shards.Lease('shard-1', 7, 9)
+    assert second.claim('b') is None
+    assert first.pending() == 2
+
+
+def test_expired_leases_are_reclaimed(tmp_path):
+    path = str(tmp_path / 'leases.db')
+    crashed = shards.LeaseTable(path)
+    crashed.add_shards([(1, 9)])
+    lease = crashed.claim('crashed')
+    assert crashed.mark_migrated(1, lease, 'crashed')
+    crashed.lease_time = -1
+    crashed.renew(lease, 'crashed')
+
+    leases = shards.LeaseTable(path)
+    migrated = []
+    shards.run_worker(leases, 'b', _bugs(1, 5, 9, 12),
+                      lambda bzbug: migrated.append(bzbug.id))
+    assert migrated == [5, 9]
+    assert not leases.pending()
+    assert not crashed.renew(lease, 'crashed')
+
+
+def test_lost_leases_are_not_recorded(tmp_path):
+    path = str(tmp_path / 'leases.db')
+    leases = shards.LeaseTable(path, lease_time=-1)
+    leases.add_shards([(1, 9)])
+    other = shards.LeaseTable(path)
+    migrated = []
+
+    def migrate(bzbug):
+        # The lease expires while the bug is migrated, and another worker
+        # reclaims the shard
+        migrated.append(bzbug.id)
+        other.complete(other.claim('b'), 'b')
+
+    shards.run_worker(leases, 'a', _bugs(1, 5), migrate)
+    assert migrated == [1]
+    assert not leases.is_migrated(1)
+
+
+def test_caches_are_warmed_once(tmp_path):
+    path = str(tmp_path / 'leases.db')
+    leases = shards.LeaseTable(path)
+    leases.add_shards([(1, 9)])
+    warm = mock.Mock(return_value={'labels': ['bugzilla']})
+
+    assert shards.shared_caches(leases, 'a', warm) == {'labels': ['bugzilla']}
+    other = shards.LeaseTable(path)
+    assert shards.shared_caches(other, 'b', warm) == {'labels': ['bugzilla']}
+    warm.assert_called_once_with()
@@ -0,0 +1,136 @@
+import collections
+import io
+import xmlrpc.client
+from unittest import mock
+
+from bztogl import bztogl, snapshot, spool
+
+
+def _bug(id, status='NEW', component='general'):
+    data = {
+        'id': id,
+        'product': 'zenity',
+        'component': component,
+        'status': status,
+        'summary': 'Bug {}'.format(id),
+        'creator': 'jsparks@src.gnome.org',
+        'assigned_to': 'zenity-maint@gnome.bugs',
+        'cc': ['swoods@src.gnome.org'],
+        'creation_time': xmlrpc.client.DateTime('20170101T00:00:00'),
+    }
+    bug = mock.Mock(bug_id=id, **data)
+    bug.get_raw_data.return_value = dict(data)
+    bug.getcomments.return_value = [{
+        'creator': 'jsparks@src.gnome.org',
+        'text': 'Created attachment {}\nlog\n\nhere is the log'.format(id),
+        'attachment_id': id,
+        'creation_time': xmlrpc.client.DateTime('20170101T00:00:00'),
+    }]
+    return bug
+
+
+def _bugzilla():
+    bgo = mock.Mock()
+    bgo._proxy.Bug.attachments.side_effect = lambda q: {'bugs': {
+        str(q['ids'][0]): [{'id': q['ids'][0], 'file_name': 'log.txt',
+                            'summary': 'log', 'is_patch': False,
+                            'is_obsolete': False}]
+    }}
+    bgo.openattachment.side_effect = lambda atid: io.BytesIO(b'log')
+    bgo.getusers.side_effect = lambda emails: [
+        mock.Mock(email=email, real_name=email.split('@')[0].title())
+        for email in emails]
+    bgo.getcomponentsdetails.return_value = {
+        'general': {'initialowner': 'zenity-maint@gnome.bugs'},
+    }
+    return bgo
+
+
+def test_export_and_read_snapshot(tmp_path):
+    path = str(tmp_path / 'zenity')
+    bzbugs = [_bug(1), _bug(2, 'NEEDINFO', 'docs')]
+    snapshot.export_product(_bugzilla(), 'zenity', bzbugs, path)
+
+    bgo = snapshot.BugzillaSnapshot(path)
+    assert not bgo.logged_in
+
+    bugs = bgo.query(bgo.build_query(product='zenity'))
+    assert [bug.id for bug in bugs] == [1, 2]
+    bug = bugs[0]
+    assert bug.bug_id == 1
+    assert bug.bugzilla is bgo
+    assert bug.cc == ['swoods@src.gnome.org']
+    assert str(bug.creation_time) == '20170101T00:00:00'
+    comment, = bug.getcomments()
+    assert str(comment['creation_time']) == '20170101T00:00:00'
+    assert bug.attachments[0]['file_name'] == 'log.txt'
+    assert bgo.openattachment(1).read() == b'log'
+
+    query = bgo.build_query(product='zenity', component='docs')
+    assert [bug.id for bug in bgo.query(query)] == [2]
+    query['status'] = ['NEW']
+    assert bgo.query(query) == []
+
+    assert bgo.getuser('swoods@src.gnome.org').real_name == 'Swoods'
+    assert bgo.getuser('nobody@example.com').real_name == ''
+    assert bgo.getcomponentsdetails('zenity')['general']['initialowner'] == \
+        'zenity-maint@gnome.bugs'
+
+
+def test_attachments_are_content_addressed(tmp_path):
+    path = tmp_path / 'zenity'
+    snapshot.export_product(_bugzilla(), 'zenity', [_bug(1), _bug(2)],
+                            str(path))
+
+    blobs = [p for p in (path / snapshot.BLOBS_DIR).rglob('*') if p.is_file()]
+    assert len(blobs) == 1
+
+
+def test_changed_bugs_are_compared_by_date(tmp_path):
+    path = str(tmp_path / 'zenity')
+    bzbugs = [_bug(1), _bug(2)]
+    bzbugs[0].get_raw_data.return_value['last_change_time'] = \
+        xmlrpc.client.DateTime('20161231T12:00:00')
+    bzbugs[1].get_raw_data.return_value['last_change_time'] = \
+        xmlrpc.client.DateTime('20170102T00:00:00')
+    snapshot.export_product(_bugzilla(), 'zenity', bzbugs, path)
+    bgo = snapshot.BugzillaSnapshot(path)
+
+    query = bgo.build_query(product='zenity')
+    for since in ('2017-01-01', '2017-01-01 00:00:00', '20170101T00:00:00'):
+        query['last_change_time'] = since
+        assert [bug.id for bug in bgo.query(query)] == [2]
+    query['last_change_time'] = '2016-12-31T06:00:00Z'
+    assert [bug.id for bug in bgo.query(query)] == [1, 2]
+
+
+class Users(collections.defaultdict):
+    """UserCache which knows no GitLab user"""
+
+    def __init__(self):
+        super().__init__(lambda: None)
+
+    def prefetch(self, emails):
+        pass
+
+
+def test_snapshot_bugs_are_migrated(tmp_path):
+    path = str(tmp_path / 'zenity')
+    bug = _bug(1)
+    bug.get_raw_data.return_value.update(
+        keywords=[], version=None, target_milestone='---', depends_on=[],
+        blocks=[], see_also=[])
+    snapshot.export_product(_bugzilla(), 'zenity', [bug], path)
+    bgo = snapshot.BugzillaSnapshot(path)
+    bzbug, = bgo.query(bgo.build_query(product='zenity'))
+
+    metadata = bztogl.get_attachments_metadata(bzbug)
+    assert metadata[1]['file_name'] == 'log.txt'
+
+    target = spool.SpoolTarget(spool.SpoolWriter(str(tmp_path / 'spool')),
+                               'https://gitlab.example.com/', None, 'token',
+                               'zenity', 'test/zenity')
+    issue = bztogl.processbug(bgo, 'https://bugzilla.gnome.org', 'GNOME',
+                              'OBSOLETE', target, Users(),
+                              spool.MilestoneTitles(), bzbug)
+    assert issue.payload['title'] == 'Bug 1'
@@ -0,0 +1,125 @@
+import collections
+import json
+
+from bztogl import bztogl, spool
+
+
+def _read(path):
+    with open(str(path)) as f:
+        return [json.loads(line) for line in f]
+
+
+def _target(path):
+    writer = spool.SpoolWriter(str(path))
+    return spool.SpoolTarget(writer, 'https://gitlab.example.com/', None,
+                             'token', 'zenity', 'test/zenity')
+
+
+class Users(collections.defaultdict):
+    """UserCache which knows no GitLab user"""
+
+    def __init__(self):
+        super().__init__(lambda: None)
+
+    def prefetch(self, emails):
+        pass
+
+
+class Bugzilla:
+    logged_in = False
+
+    def __init__(self):
+        self._proxy = object()
+
+
+class Bug:
+    def __init__(self, bugzilla):
+        self.id = self.bug_id = 12345
+        self.bugzilla = bugzilla
+        self.summary = 'It crashes'
+        self.creator = 'test@example.com'
+        self.creation_time = '20170101T00:00:00'
+        self.assigned_to = 'test@example.com'
+        self.cc = []
+        self.status = 'NEEDINFO'
+        self.component = 'General'
+        self.version = None
+        self.target_milestone = '3.28'
+        self.keywords = []
+        self.depends_on = []
+        self.blocks = []
+        self.see_also = []
+        self.attachments = [{
+            'id': 1, 'file_name': 'crash.txt', 'summary': 'log',
+            'is_patch': False, 'is_obsolete': False,
+        }]
+
+    def getcomments(self):
+        return [
+            {'creator': self.creator, 'text': 'first comment',
+             'creation_time': '20170101T00:00:00'},
+            {'creator': self.creator,
+             'text': 'Created attachment 1\nlog\n\nhere is the log',
+             'attachment_id': 1, 'creation_time': '20170102T00:00:00'},
+        ]
+
+
+def test_spool_issue_is_written_on_save(tmp_path):
+    path = tmp_path / 'out.ndjson'
+    target = _target(path)
+
+    issue = target.create_issue(1, 'title', 'desc', ['bugzilla'], '3.28',
+                                '2017-01-01')
+    issue.assignee_id = 5
+    issue.notes.create({'body': 'note', 'created_at': '2017-01-02'})
+    issue.subscribe(sudo='jamars')
+    assert _read(path) == []
+
+    issue.save(state_event='reopen')
+    target.spool.close()
+
+    record, = _read(path)
+    assert record['type'] == 'issue'
+    assert record['source_id'] == 1
+    assert record['issue']['milestone'] == '3.28'
+    assert record['assignee_id'] == 5
+    assert record['notes'] == [{'body': 'note', 'created_at': '2017-01-02'}]
+    assert record['subscribers'] == ['jamars']
+    assert record['state_event'] == 'reopen'
+
+
+def test_upload_file_is_stored_as_blob(tmp_path):
+    path = tmp_path / 'out.ndjson'
+    target = _target(path)
+
+    ret = target.upload_file('a.txt', b'contents')
+    target.spool.close()
+
+    record, = _read(path)
+    assert ret['markdown'] == spool.placeholder_markdown(record['key'],
+                                                         'a.txt')
+    with open(str(tmp_path / 'out.ndjson.blobs' / record['blob']), 'rb') as f:
+        assert f.read() == b'contents'
+
+
+def test_processbug_dry_run(tmp_path):
+    path = tmp_path / 'out.ndjson'
+    target = _target(path)
+    user_cache = Users()
+    bug = Bug(Bugzilla())
+
+    bztogl.processbug(None, 'https://bugzilla.gnome.org', 'GNOME',
+                      'OBSOLETE', target, user_cache, spool.MilestoneTitles(),
+                      bug)
+    target.spool.close()
+
+    upload, issue = _read(path)
+    assert upload == {'type': 'upload', 'key': 'bugzilla-1',
+                      'filename': 'crash.txt', 'attachment_id': 1}
+    assert issue['issue']['title'] == 'It crashes'
+    assert issue['issue']['milestone'] == '3.28'
+    assert bztogl.NEEDINFO_LABEL in issue['issue']['labels']
+    assert 'first comment' in issue['issue']['description']
+    note, = issue['notes']
+    assert 'bztogl-upload://bugzilla-1' in note['body']
+    assert issue['state_event'] == 'reopen'
@@ -0,0 +1,96 @@
+import collections
+import xmlrpc.client
+from unittest import mock
+
+from bztogl import bztogl, sync
+
+
+def _comment(id, text):
+    return {'id': id, 'creator': 'jsparks@src.gnome.org', 'text': text,
+            'creation_time': '20170101T00:00:00'}
+
+
+def _bug(status, comments, keywords=()):
+    bug = mock.Mock(id=1, bug_id=1, summary='Crash', status=status,
+                    component='general', keywords=list(keywords),
+                    last_change_time='20170102T00:00:00', attachments=[])
+    bug.getcomments.return_value = comments
+    return bug
+
+
+def test_state_is_saved(tmp_path):
+    path = str(tmp_path / 'sync.json')
+    state = sync.SyncState(path)
+    assert state.watermark is None
+
+    state.record(_bug('NEW', [_comment(10, 'a'), _comment(11, 'b')]), 5,
+                 [_comment(10, 'a'), _comment(11, 'b')], ['bugzilla'])
+    state.advance('20170101T00:00:00')
+    state.save()
+
+    state = sync.SyncState(path)
+    assert 1 in state
+    assert state[1] == {'iid': 5, 'last_comment': 11, 'labels': ['bugzilla']}
+    assert state.watermark == '2017-01-02T00:00:00Z'
+
+
+def test_watermark_is_queried_as_iso_8601(tmp_path):
+    path = str(tmp_path / 'sync.json')
+    state = sync.SyncState(path)
+    state.advance(xmlrpc.client.DateTime('20170102T03:04:05'))
+    state.save()
+
+    state = sync.SyncState(path)
+    state.advance('20170101T23:00:00')
+    assert state.watermark == '2017-01-02T03:04:05Z'
+
+    bgo = mock.Mock()
+    bgo.build_query.return_value = {}
+    bgo.query.return_value = []
+    bztogl.query_changed_bugs(bgo, 'zenity', None, state.watermark)
+    query, = bgo.query.call_args[0]
+    assert query['last_change_time'] == '2017-01-02T03:04:05Z'
+
+
+def test_sync_appends_new_comments(tmp_path):
+    state = sync.SyncState(str(tmp_path / 'sync.json'))
+    state.bugs[1] = {'iid': 5, 'last_comment': 10,
+                     'labels': ['bugzilla', bztogl.NEEDINFO_LABEL]}
+
+    issue = mock.Mock(iid=5, labels=['bugzilla', bztogl.NEEDINFO_LABEL,
+                                     'Triaged'])
+    target = mock.Mock(product='zenity')
+    target.get_project.return_value.issues.get.return_value = issue
+    user_cache = collections.defaultdict(lambda: None)
+
+    bug = _bug('RESOLVED', [_comment(10, 'old'), _comment(12, 'new')],
+               ['newcomers'])
+    bztogl.syncbug(None, 'https://bugzilla.gnome.org', target, user_cache,
+                   state, bug)
+
+    target.get_project.return_value.issues.get.assert_called_once_with(5)
+    note, = issue.notes.create.call_args_list
+    assert 'new' in note[0][0]['body']
+    assert issue.labels == ['Triaged', 'bugzilla', '4. Newcomers']
+    issue.save.assert_called_once_with(state_event='close')
+    assert state[1]['last_comment'] == 12
+
+
+def test_sync_skips_unchanged_issues(tmp_path):
+    state = sync.SyncState(str(tmp_path / 'sync.json'))
+    state.bugs[1] = {'iid': 5, 'last_comment': 10, 'labels': ['bugzilla']}
+
+    issue = mock.Mock(iid=5, labels=['Triaged', 'bugzilla'], state='opened')
+    target = mock.Mock(product='zenity')
+    target.get_project.return_value.issues.get.return_value = issue
+    user_cache = collections.defaultdict(lambda: None)
+
+    bug = _bug('NEW', [_comment(10, 'old')])
+    bztogl.syncbug(None, 'https://bugzilla.gnome.org', target, user_cache,
+                   state, bug)
+    assert not issue.save.called
+
+    bug = _bug('RESOLVED', [_comment(10, 'old')])
+    bztogl.syncbug(None, 'https://bugzilla.gnome.org', target, user_cache,
+                   state, bug)
+    issue.save.assert_called_once_with(state_event='close')
@@ -51,6 +51,8 @@ def cache(save_mock_method, retrieve_mock_method):
     }
     gitlab = mock.Mock()
     gitlab.find_user = mock.Mock(side_effect=gitlab_users.get)
+    gitlab.find_users = mock.Mock(
+        side_effect=lambda ids: {id: gitlab_users.get(id) for id in ids})
 
     bugzilla_users = {
         'gjs-maint@gnome.bugs': BZU('gjs-maint@gnome.bugs', ''),
@@ -107,3 +109,11 @@ class TestUserCache:
     def test_lookup_bugzilla_user_with_junk_in_username(self, cache):
         user = cache['jbriggs@src.gnome.org']
         assert user.real_name == 'Jeffrey Briggs'
+
+    def test_prefetch_gitlab_users(self, cache):
+        cache.prefetch(['jsparks@src.gnome.org', 'swoods@src.gnome.org',
+                        'jsparks@src.gnome.org'])
+        cache._target.find_users.assert_called_once_with([1])
+
+        assert cache['jsparks@src.gnome.org'].username == 'jamars'
+        assert not cache._target.find_user.called